@@ -5,4 +5,8 @@
 cd /usr/local/chi2
 # edit the below with the correct path!
 export LD_LIBRARY_PATH=/usr/lib/oracle/12.1/client64/lib
+# append --pdo to read patient sets through the CRC cell's PDO service
+# (for sites where the crc user has no grant on qt_patient_set_collection)
+# append --pool to talk to the hive over pooled keep-alive connections
+# (a job's PM check and PDO pages then share one connection)
 python -m param_check http://localhost/webclient/index.php http://localhost:9090/i2b2/services/PMService/ /var/log/chi2
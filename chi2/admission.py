@@ -0,0 +1,289 @@
+'''admission -- admit chi2 jobs fairly, with bounds on concurrent work
+..................................................................
+
+Each CGI request is a process of its own, so jobs coordinate through
+files in a shared directory: a job holds an exclusive `flock` on one of
+its user's slot files and one of the global slot files while it runs,
+and waits for a global slot with a ticket file, whose name orders the
+queue by priority (0 first), then by arrival. A lock dies with its
+process, so a crashed job frees its slots, and its ticket is seen to
+be stale.
+
+  >>> import os, tempfile, shutil, fcntl
+  >>> import lafile
+  >>> tmp = tempfile.mkdtemp()
+  >>> now = [1000.0]
+  >>> def sleep(seconds):
+  ...     now[0] += seconds
+  >>> gate = Admission(lafile.Editable(tmp, os, open), fcntl.flock,
+  ...                  lambda: now[0], sleep,
+  ...                  per_user=1, slots=1, max_wait=5)
+
+While alice has a job running, another of hers is refused at once
+(HTTP 429), and bob waits in the queue, but not for ever (HTTP 503):
+
+  >>> with gate.admit('alice'):
+  ...     for who in ['alice', 'bob']:
+  ...         try:
+  ...             with gate.admit(who):
+  ...                 pass
+  ...         except Rejected as ex:
+  ...             print ex.status, ex
+  429 too many requests alice has 1 job(s) running
+  503 service unavailable no capacity for bob within 5s
+
+Once alice's job is done, bob gets in:
+
+  >>> with gate.admit('bob'):
+  ...     print 'running'
+  running
+
+A job that runs in the background (e.g. the exact run after a
+preview) can't be refused; it waits for one of its user's slots, too,
+rather than give up at once:
+
+  >>> with gate.admit('alice'):
+  ...     try:
+  ...         with gate.admit('alice', wait_user=True):
+  ...             pass
+  ...     except Rejected as ex:
+  ...         print ex.status, ex
+  503 service unavailable alice has 1 job(s) running after 5s
+
+Such a job runs in a process of its own, which takes its slots from
+the same directory, given these arguments (cf. `chinotype.admitted`):
+
+  >>> gate.process_args('alice')[2:]
+  ['--admit-as', 'alice', '--per-user', '1', '--slots', '1']
+
+Queue depth, jobs running, wait times and refusals are kept as
+metrics:
+
+  >>> m = gate.metrics()
+  >>> m['admitted'], m['rejected_user'], m['rejected_busy'], m['running']
+  (3, 1, 2, 0)
+  >>> m['queue_depth'], m['wait_max']
+  (0, 0.0)
+
+  >>> shutil.rmtree(tmp)
+
+'''
+
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# fcntl.LOCK_EX, fcntl.LOCK_NB, fcntl.LOCK_UN; so as not to import fcntl
+LOCK_EX, LOCK_NB, LOCK_UN = 2, 4, 8
+
+METRICS = 'metrics.json'
+RECENT_WAITS = 200
+
+
+class Rejected(IOError):
+    '''A job that can't be admitted now.
+    '''
+    status = '503 service unavailable'
+
+    def __init__(self, msg,
+                 retry_after=30):
+        IOError.__init__(self, msg)
+        self.retry_after = retry_after
+
+
+class TooManyJobs(Rejected):
+    status = '429 too many requests'
+
+
+class Busy(Rejected):
+    status = '503 service unavailable'
+
+
+class Admission(object):
+    '''Bound jobs per user and overall; queue the rest by priority.
+    '''
+    def __init__(self, dir_wr, flock, clock, sleep,
+                 per_user=2, slots=4, max_queue=20, max_wait=120.0,
+                 poll=0.5):
+        '''
+        :param lafile.Editable dir_wr: access to slot, ticket and
+                                       metrics files
+        :param flock: access to lock files, a la `fcntl.flock`
+        :param clock: access to the time, in seconds
+        :type clock: () => Float
+        :param sleep: access to wait, a la `time.sleep`
+        :param Int per_user: jobs each user may run at once
+        :param Int slots: jobs that may run at once, in all
+        :param Int max_queue: jobs that may wait at once
+        :param Float max_wait: seconds a job may wait
+        :param Float poll: seconds between checks of the queue
+        '''
+        self._dir = dir_wr
+        self._flock = flock
+        self._clock = clock
+        self._sleep = sleep
+        self._per_user = per_user
+        self._slots = slots
+        self._max_queue = max_queue
+        self._max_wait = max_wait
+        self._poll = poll
+
+    @contextmanager
+    def admit(self, username,
+              priority=1, wait_user=False):
+        '''Run the block once admitted.
+
+        :param Int priority: 0 for jobs expected to be quick (e.g. of
+                             stored results); higher for bigger ones
+        :param Boolean wait_user: wait (up to `max_wait`) for the user's
+                                  other jobs, rather than be refused
+        :raises TooManyJobs: if the user has `per_user` jobs running
+        :raises Busy: if the queue is full, or the wait is too long
+        '''
+        t0 = self._clock()
+        # hex: any username makes a safe file name
+        user_slots = ['user-%s.%d' % (username.encode('hex'), ix)
+                      for ix in range(self._per_user)]
+        mine = self._grab(user_slots)
+        while mine is None and wait_user:
+            if self._clock() - t0 >= self._max_wait:
+                self._count('rejected_busy')
+                raise Busy('%s has %d job(s) running after %gs' %
+                           (username, self._per_user, self._max_wait))
+            self._sleep(self._poll)
+            mine = self._grab(user_slots)
+        if mine is None:
+            self._count('rejected_user')
+            raise TooManyJobs('%s has %d job(s) running' %
+                              (username, self._per_user))
+        try:
+            slot = self._wait(username, priority, t0)
+            try:
+                self._count('admitted', wait=self._clock() - t0)
+                yield
+            finally:
+                self._release(slot)
+        finally:
+            self._release(mine)
+
+    def process_args(self, username):
+        '''chinotype arguments for a job of this user, in a process of
+        its own, to take its slots here.
+        '''
+        return ['--admission-dir', self._dir.ro().fullPath(),
+                '--admit-as', username,
+                '--per-user', str(self._per_user), '--slots', str(self._slots)]
+
+    def _wait(self, username, priority, t0):
+        tickets = self._tickets()
+        if len(tickets) >= self._max_queue:
+            self._count('rejected_busy')
+            raise Busy('%d jobs waiting' % len(tickets))
+        name = '%d-%017.6f-%d.ticket' % (priority, t0, os.getpid())
+        ticket_wr = self._dir / name
+        ticket = ticket_wr.appendChannel()
+        self._flock(ticket.fileno(), LOCK_EX | LOCK_NB)
+        try:
+            while True:
+                # first in line takes the next free slot
+                if self._tickets()[:1] == [name]:
+                    slot = self._grab(['slot.%d' % ix
+                                       for ix in range(self._slots)])
+                    if slot is not None:
+                        return slot
+                if self._clock() - t0 >= self._max_wait:
+                    self._count('rejected_busy')
+                    raise Busy('no capacity for %s within %gs' %
+                               (username, self._max_wait))
+                self._sleep(self._poll)
+        finally:
+            ticket_wr.delete()
+            ticket.close()
+
+    def _tickets(self):
+        '''Names of live tickets, in queue order; remove stale ones.
+        '''
+        live = []
+        for rd in self._dir.ro().subRdFiles():
+            name = rd.fullPath().rsplit('/', 1)[-1]
+            if not name.endswith('.ticket'):
+                continue
+            # A new ticket is locked just after it's made.
+            if self._clock() - float(name.split('-')[1]) < 2 * self._poll:
+                live.append(name)
+                continue
+            lock = self._grab([name])
+            if lock is None:
+                live.append(name)
+            else:  # nobody holds it: its process is gone
+                try:
+                    (self._dir / name).delete()
+                except OSError:
+                    pass
+                self._release(lock)
+        return sorted(live)
+
+    def _grab(self, names):
+        '''Lock the first of `names` that's free, without waiting.
+
+        :return: the open, locked file, or None
+        '''
+        for name in names:
+            f = (self._dir / name).appendChannel()
+            try:
+                self._flock(f.fileno(), LOCK_EX | LOCK_NB)
+            except IOError:
+                f.close()
+            else:
+                return f
+        return None
+
+    def _release(self, f):
+        self._flock(f.fileno(), LOCK_UN)
+        f.close()
+
+    def _count(self, counter,
+               wait=None):
+        '''Update the metrics file (under a lock).
+        '''
+        lock = (self._dir / 'metrics.lock').appendChannel()
+        self._flock(lock.fileno(), LOCK_EX)
+        try:
+            m = self._read_metrics()
+            m[counter] = m.get(counter, 0) + 1
+            if wait is not None:
+                m['waits'] = (m.get('waits', []) + [round(wait, 3)])[-RECENT_WAITS:]
+            (self._dir / METRICS).setBytes(json.dumps(m))
+        finally:
+            self._release(lock)
+
+    def _read_metrics(self):
+        rd = self._dir.ro() / METRICS
+        return json.loads(rd.getBytes()) if rd.exists() else {}
+
+    def metrics(self):
+        '''Counts of jobs admitted and refused; queue depth; jobs
+        running; wait times (seconds) of recent jobs admitted.
+        '''
+        m = self._read_metrics()
+        waits = sorted(m.pop('waits', []))
+        out = dict(admitted=0, rejected_user=0, rejected_busy=0)
+        out.update(m)
+        out['queue_depth'] = len(self._tickets())
+        running = 0
+        for ix in range(self._slots):
+            f = self._grab(['slot.%d' % ix])
+            if f is None:
+                running += 1
+            else:
+                self._release(f)
+        out['running'] = running
+        out['slots'] = self._slots
+        for label, q in [('wait_p50', 0.5), ('wait_p95', 0.95),
+                         ('wait_max', 1.0)]:
+            out[label] = (waits[min(len(waits) - 1, int(q * len(waits)))]
+                          if waits else None)
+        return out
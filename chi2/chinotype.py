@@ -8,6 +8,11 @@ Usage:
    chinotype.py [options][-f PATTERN]... -m QMID
    chinotype.py [options][-f PATTERN]... -p PSID
    chinotype.py [options][-f PATTERN]... -t PSID -r PSID
+   chinotype.py [options][-f PATTERN]... (-s PSID)...
+   chinotype.py [options][-f PATTERN]... -k RANK (-p PSID | -t PSID -r PSID)
+   chinotype.py [options] --snapshot
+   chinotype.py [options] --rebuild
+   chinotype.py [options] --bench-fill
 
 Options:
     -h --help           Show this screen
@@ -15,6 +20,26 @@ Options:
     -p PSID             Patient set ID to test, TOTAL population as reference
     -t PSID             Patient set ID to test
     -r PSID             Patient set ID for reference
+    -s PSID             Patient set ID for comparison matrix (give 2 or more)
+    -a --versus-first   Compare each -s set with the first, not all pairs
+    -k RANK             Page through stored results: the LIMIT rows after RANK
+    -d --direction=DIR  Page over- or under-represented facts [default: over]
+    -g --stratify       Compare within strata (e.g. age band and sex), by CMH
+    --since=DATE        Count only facts on or after DATE (YYYY-MM-DD)
+    --until=DATE        Count only facts on or before DATE (YYYY-MM-DD)
+    --preview=PCT       First answer from a PCT% sample of patients, then exactly
+    -l --similar        Find the concepts whose patients are most like the -p set
+    -y --pairs          Count co-occurring concept pairs in the -p set
+    --support=N         Least patients for a co-occurring pair [default: 10]
+    --snapshot          Write chi_pconcepts to a new snapshot (chi_snapshot)
+    --rebuild           Build the chi tables anew, aside, then switch to them
+    --bench-fill        Compare redo of cohort fills, UPDATE vs. MERGE, by sparsity
+    --cancel-file=FILE  Stop, and clean up, once FILE exists
+    --admission-dir=DIR Hold a job slot in DIR while running (see below)
+    --admit-as=USER     User whose slot to hold
+    --per-user=N        Jobs each user may run at once [default: 2]
+    --slots=N           Jobs that may run at once, in all [default: 4]
+    --project=NAME      Use the tables of i2b2 project NAME (see below)
     -v --verbose        Verbose/debug output (show all SQL)
     -c --config=FILE    Configuration file [default: config.ini]
     -o --output         Save chi2 csv output file
@@ -28,20 +53,204 @@ QMID is the query master ID (from i2b2 QT tables). The latest query
 instance/result for a given QMID will be used.
 
 PSID is the result instance ID (from i2b2 QT tables). 
+
+With -k, a page is read from the ranked results stored (in chi_results)
+by an earlier run, rather than ranking again; start with -k 0. The
+first page also tells how many rows there are in all, and after which
+rank each page starts, so that a client can go to any page.
+
+With -s, each patient set is compared with each other one (or, with -a,
+with the first one) and the statistics for all pairs are output as one
+matrix: a row per concept and a column per set or pair.
+
+With -g, the test set is compared with the rest of the reference set
+(or population) within strata of patient_dimension (chi_strata in the
+config file; by default, sex and 10-year age band), and concepts are
+ranked by the Mantel-Haenszel common odds ratio, with the
+Cochran-Mantel-Haenszel statistic in place of chi-squared. Against
+the population, its counts by stratum are made once per generation of
+the tables and reused, so each job reads only the test set's facts;
+ages, for test and population alike, are then as of the day the counts
+were made.
+
+With --since and/or --until, only facts in that date window count, for
+the test and the reference set alike. This needs the time-sliced
+concept store (chi_pconcepts_dated in the config file); windowed counts
+are computed for the request rather than stored as chi columns.
+
+With --preview, a uniform sample of the patient sets answers first,
+with approximate odds ratios, their 95% confidence bounds, and an
+UNCERTAIN flag where the bounds straddle 1 or the page's cut-off; the
+exact run follows (in the background, given a way to spawn one). The
+CGI passes the background run --cancel-file, the marker of its job,
+and --admission-dir, so that it waits its turn for a job slot like any
+other job (cf. admission.py).
+
+With -l, concepts are ranked instead by the Jaccard similarity of their
+patients to the -p patient set: candidates come from MinHash signatures
+and LSH bands (chi_minhash in the config file), and the LIMIT best
+(default 20) are checked exactly.
+
+With -y, pairs of concepts that at least N (--support) patients of the
+-p set have together are counted, over as many processes as CPUs, and
+stored with their lift and odds ratio (in chi_pairs); the LIMIT pairs
+with the greatest lift are output.
+
+With --snapshot, chi_pconcepts is written to memory-mappable files in
+the chi_snapshot directory, as a new version; -y reads the current
+version, if there is one, rather than the database.
+
+With --rebuild, chi_pats, chi_pconcepts, chi_pcounts and chi_schemes
+are built again under names of their own (a new generation; see
+chi_generations in the config file), while jobs go on using the
+current ones. If their row counts look right (none is empty, or has
+lost more than chi_rebuild_tolerance of its rows), the cohorts added
+so far are copied to the new chi_pcounts, and jobs that start from
+then on use the new tables. chi_pconcepts_dated and chi_minhash, if
+configured, are derived from the others, so they are built anew with
+them; stored rankings against the whole population and co-occurring
+pairs are cleared as of the switch, and the snapshot, if any, is
+written again. The generation before the current one is kept, for
+jobs still using it; older ones are dropped.
+
+With --project, the [project:NAME] section of the config file, if
+there is one, overrides settings of the [database] section; e.g. to
+give the project chi_pats, chi_pconcepts and chi_pcounts tables (or a
+chi_snapshot) of its own, maybe on another database host (chi_host,
+etc.). Projects can share such settings: `shard=S` in a project
+section takes them from a [shard:S] section, which the project section
+can in turn override. Projects without a section use [database]. So
+one project's tables can be rebuilt without touching the others.
+In the same schema as [database], a project with chi_pats,
+chi_pconcepts or chi_pcounts of its own must also name its own
+chischemes, chi_generations and optional derived tables (chi_results,
+etc.), which are rebuilt or cleared along with them; a config that
+doesn't is rejected.
+
+Read-only queries (patient set lookups in the QT tables, reading
+rankings) go to standby databases (crc_standbys, chi_standbys), if
+they are within the staleness allowed for their class of query
+(chi_standby_staleness), and have caught up with what the job itself
+wrote; otherwise, and if a standby fails, they go to the primary.
+Writes always go to the primary.
+
+Database calls are limited by phase (chi_call_timeouts in the config
+file); a job that runs out of time, or is cancelled, rolls back and
+drops what it had added for its cohort.
 '''
-from sys import argv
-from docopt import docopt
-from ConfigParser import SafeConfigParser
-import cx_Oracle as cx
+# docopt, ConfigParser and cx_Oracle are imported where they're used,
+# to keep the CGI's start-up cheap; cf. coldstart.py
+from sys import argv, executable
 from contextlib import contextmanager
 import logging
 import json
+import os
+from functools import partial as pf_
 import re
+import time
+import zlib
+
+from prefixfilter import in_list, scheme_sql
+from psets import PatientSets, SetStore
+import minhash
+import cooccur
+import snapshot
+from planwatch import PlanWatch
+import jobctl
+import replicas
+import generations
 
 log = logging.getLogger(__name__)
+
+# SQL for the stratum of a patient_dimension row: sex and 10-year age band
+STRATA_DEFAULT = (
+    "sex_cd || ':' || "
+    "least(floor(months_between(sysdate, birth_date) / 120), 9) * 10")
+
 config_default = './config.ini'
 
+# options that say which schema the chi tables are in
+CHI_SCHEMA_OPTIONS = ['chi_host', 'chi_port', 'chi_service_name', 'chi_user']
+# tables a project may have of its own (see project_options) ...
+OWN_TABLE_OPTIONS = ['chi_pats', 'chi_pconcepts', 'chi_pcounts']
+# ... and those made from them, or rebuilt or cleared with them
+DERIVED_TABLE_OPTIONS = ['chischemes', 'chi_generations', 'chi_results',
+                         'chi_pconcepts_dated', 'chi_minhash', 'chi_pairs',
+                         'chi_snapshot']
+
+
+def project_options(sections, project):
+    '''Database options for a project: those of [database], overridden
+    by those of the project's shard, if any, then its own.
+
+      >>> sections = {
+      ...     'database': {'chi_host': 'db0', 'chi_pcounts': 'chi_counts'},
+      ...     'shard:big': {'chi_host': 'db1'},
+      ...     'project:ACT': {'shard': 'big', 'chi_pcounts': 'act_counts'}}
+      >>> sorted(project_options(sections, 'ACT').items())
+      [('chi_host', 'db1'), ('chi_pcounts', 'act_counts')]
+      >>> sorted(project_options(sections, 'Demo').items())
+      [('chi_host', 'db0'), ('chi_pcounts', 'chi_counts')]
+
+      >>> project_options({'database': {}, 'project:X': {'shard': 'nil'}}, 'X')
+      Traceback (most recent call last):
+        ...
+      ValueError: project X: no [shard:nil] section
+
+    A project with tables of its own in the same schema as [database]
+    needs its own derived tables too; else a rebuild of its tables
+    would switch the generation of everyone's, and stored results and
+    signatures of one would be taken for the other's:
+
+      >>> sections = {
+      ...     'database': {'chi_user': 'chi', 'chi_pcounts': 'chi_counts',
+      ...                  'chi_generations': 'chi_gens',
+      ...                  'chi_results': 'chi_results'},
+      ...     'project:ACT': {'chi_pcounts': 'act_counts',
+      ...                     'chi_generations': 'act_gens'}}
+      >>> project_options(sections, 'ACT')
+      ... # doctest: +NORMALIZE_WHITESPACE
+      Traceback (most recent call last):
+        ...
+      ValueError: project ACT: chi_pcounts of its own in the chi schema
+      of [database] needs chi_results of its own too
+      >>> sections['project:ACT']['chi_results'] = 'act_results'
+      >>> project_options(sections, 'ACT')['chi_results']
+      'act_results'
+
+    :param sections: options by config file section
+    :type sections: Dict[String, Dict[String, String]]
+    :param String project: i2b2 project id, or None
+    :rtype: Dict[String, String]
+    '''
+    db = dict(sections['database'])
+    own = sections.get('project:{0}'.format(project), {}) if project else {}
+    if 'shard' in own:
+        shard = sections.get('shard:{0}'.format(own['shard']))
+        if shard is None:
+            raise ValueError('project {0}: no [shard:{1}] section'.format(
+                project, own['shard']))
+        db.update(shard)
+    db.update(own)
+    for k in ['__name__', 'shard']:
+        db.pop(k, None)
+    base = sections['database']
+    same_schema = all(db.get(k) == base.get(k) for k in CHI_SCHEMA_OPTIONS)
+    own_tables = [k for k in OWN_TABLE_OPTIONS if db.get(k) != base.get(k)]
+    if same_schema and own_tables:
+        shared = [k for k in DERIVED_TABLE_OPTIONS
+                  if base.get(k) and db.get(k) == base.get(k)]
+        if shared:
+            raise ValueError(
+                'project {0}: {1} of its own in the {2} schema of [database]'
+                ' needs {3} of its own too'.format(
+                    project, ', '.join(own_tables), db.get('chi_user'),
+                    ', '.join(shared)))
+    return db
+
+
 def config(arguments={}):
+    from ConfigParser import SafeConfigParser
     logging.basicConfig(format='%(asctime)s: %(message)s',
                         datefmt='%Y.%m.%d %H:%M:%S', level=logging.INFO)
     if arguments == {}:
@@ -64,6 +273,19 @@ def config(arguments={}):
         opt['filter'] = None
         opt['cutoff'] = None
         opt['exists'] = False
+        opt['matrix'] = []
+        opt['versus_first'] = False
+        opt['keyset'] = None
+        opt['direction'] = 'over'
+        opt['stratify'] = False
+        opt['since'] = None
+        opt['until'] = None
+        opt['preview'] = None
+        opt['similar'] = False
+        opt['pairs'] = False
+        opt['support'] = 10
+        opt['cancel_file'] = None
+        opt['project'] = None
     else:
         opt['qmid'] = arguments['-m'] or None
         opt['psid'] = arguments['-p'] or None
@@ -75,16 +297,71 @@ def config(arguments={}):
         if opt['limit'] == 'ALL' or opt['limit'] == 'all': opt['limit'] = None
         if opt['limit'] and not opt['limit'].isdigit():
             log.error('Invalid -n, --limit (must be integer): {0}'.format(opt['limit']))    
+            from docopt import docopt
             foo = docopt(__doc__, argv=['--help'])
         opt['filter'] = list(set(arguments['-f'])) or []  # set removes duplicates
         opt['cutoff'] = arguments['-x'] or None
         opt['exists'] = arguments['--exists'] or False
+        opt['matrix'] = arguments.get('-s') or []
+        opt['versus_first'] = arguments.get('--versus-first') or False
+        opt['keyset'] = arguments.get('-k') or None
+        if opt['keyset'] and not opt['keyset'].isdigit():
+            log.error('Invalid -k (must be integer): {0}'.format(opt['keyset']))
+            from docopt import docopt
+            foo = docopt(__doc__, argv=['--help'])
+        opt['direction'] = arguments.get('--direction') or 'over'
+        if opt['direction'] not in ('over', 'under'):
+            log.error('Invalid -d, --direction (over or under): {0}'.format(opt['direction']))
+            from docopt import docopt
+            foo = docopt(__doc__, argv=['--help'])
+        opt['stratify'] = arguments.get('--stratify') or False
+        for k in ['since', 'until']:
+            opt[k] = arguments.get('--' + k) or None
+            if opt[k] and not re.match(r'^\d{4}-\d\d-\d\d$', opt[k]):
+                log.error('Invalid --{0} (must be YYYY-MM-DD): {1}'.format(k, opt[k]))
+                from docopt import docopt
+                foo = docopt(__doc__, argv=['--help'])
+        opt['preview'] = arguments.get('--preview') or None
+        if opt['preview'] and not valid_percent(opt['preview']):
+            log.error('Invalid --preview (must be a percentage): {0}'.format(opt['preview']))
+            from docopt import docopt
+            foo = docopt(__doc__, argv=['--help'])
+        opt['similar'] = arguments.get('--similar') or False
+        opt['pairs'] = arguments.get('--pairs') or False
+        opt['support'] = arguments.get('--support') or '10'
+        if not opt['support'].isdigit():
+            log.error('Invalid --support (must be integer): {0}'.format(opt['support']))
+            from docopt import docopt
+            foo = docopt(__doc__, argv=['--help'])
+        opt['support'] = int(opt['support'])
+        opt['cancel_file'] = arguments.get('--cancel-file') or None
+        opt['project'] = arguments.get('--project') or None
+    opt['database'] = project_options(opt, opt['project'])
+    if opt['project']:
+        log.info('project={0}'.format(opt['project']))
     return opt
 
 
 class Chi2:
-    def __init__(self, listargs=[], args={}):
+    def __init__(self, listargs=[], args={}, patient_source=None, psets=None,
+                 spawn=None, cancelled=None, prep=True):
+        '''
+        :param patient_source: optional access to patient sets other than
+                               SELECT on qt_patient_set_collection,
+                               e.g. `i2b2hive.PDOPatientSet`
+        :type patient_source: (result_instance_id) => Iterable[Int]
+        :param psets: optional patient set cache to share between jobs
+        :type psets: psets.PatientSets
+        :param spawn: optional access to run chinotype in the background,
+                      for the exact run after a preview
+        :type spawn: (Seq[String]) => Unit
+        :param cancelled: optional access to whether the job is cancelled
+        :type cancelled: () => Boolean
+        :param prep: create the chi2 tables if needed; False to only
+                     look up what is there (see `hasColumns`)
+        '''
         if args == {}:
+            from docopt import docopt
             args = docopt(__doc__, listargs)
         opt = config(args)
         db=opt['database']
@@ -122,16 +399,80 @@ class Chi2:
         self.pobsfact = db['chi_pobsfact']
         self.pcounts = db['chi_pcounts']
         self.chipats = db['chi_pats']
+        # tables made anew by a rebuild, by config name; see useGeneration
+        self.base_tables = {'chi_pats': self.chipats,
+                            'chi_pconcepts': self.pconcepts,
+                            'chi_pcounts': self.pcounts,
+                            'chischemes': self.chischemes}
+        self.generations = (generations.Generations(db['chi_generations'])
+                            if db.get('chi_generations') else None)
+        self.rebuild_tolerance = float(db.get('chi_rebuild_tolerance',
+                                              generations.TOLERANCE_DEFAULT))
+        self.generation = 0
+        self.results = db.get('chi_results')  # optional ranked results store
+        self.strata = db.get('chi_strata', STRATA_DEFAULT)
+        self.dated = db.get('chi_pconcepts_dated')  # optional time-sliced store
+        self.minhash = db.get('chi_minhash')  # optional concept signatures
+        # derived from chi_pconcepts, so made anew with it too
+        for k, table in [('chi_pconcepts_dated', self.dated),
+                         ('chi_minhash', self.minhash)]:
+            if table:
+                self.base_tables[k] = table
+        self.pairs = db.get('chi_pairs')  # optional co-occurrence store
+        self.snapshot = db.get('chi_snapshot')  # optional snapshot directory
+        self.plans = (PlanWatch(db['chi_plans'],
+                                factor=float(db.get('chi_plan_regression', 3)))
+                      if db.get('chi_plans') else None)  # optional plan capture
+        self.budgets = jobctl.parse_budgets(
+            db.get('chi_call_timeouts', jobctl.BUDGETS_DEFAULT))
+        staleness = jobctl.parse_budgets(
+            db.get('chi_standby_staleness', replicas.STALENESS_DEFAULT))
+        self.routers = {  # optional read-only standbys
+            'crc': self.mkRouter(
+                self.crc_host, self.crc_port, self.crc_service, self.crc_user,
+                self.crc_pw, replicas.parse_standbys(db.get('crc_standbys', '')),
+                staleness),
+            'chi': self.mkRouter(
+                self.chi_host, self.chi_port, self.chi_service, self.chi_user,
+                self.chi_pw, replicas.parse_standbys(db.get('chi_standbys', '')),
+                staleness)}
+        if cancelled is None and opt['cancel_file']:
+            cancelled = pf_(os.path.exists, opt['cancel_file'])
+        self.cancelled = cancelled
+        self.undo = []  # SQL to undo changes made outside the transaction
         self.chi_name = None
         self.pats = []
+        self.patient_source = patient_source
+        if psets is None:
+            store = None
+            if db.get('chi_patient_sets'):  # optional cache shared by jobs
+                import lafile
+                store = SetStore(lafile.Editable(db['chi_patient_sets'], os, open))
+            psets = PatientSets(patient_source or self.readPatientSet, store=store)
+        self.psets = psets
         self.out_json = None
         self.limit = opt['limit']
         self.filter = opt['filter']
         self.cutoff = opt['cutoff']
         self.extant = opt['exists']  # return extant data only
+        self.matrix = opt['matrix']  # patient sets to compare pairwise
+        self.versus_first = opt['versus_first']
+        self.keyset = opt['keyset']  # page after this rank
+        self.direction = opt['direction']
+        self.stratify = opt['stratify']
+        self.since = opt['since']
+        self.until = opt['until']
+        self.preview = opt['preview']  # sample percentage
+        self.similar = opt['similar']
+        self.support = opt['support']
+        self.listargs = listargs
+        self.spawn = spawn
         self.ref = 'TOTAL'  # default reference patient set
         self.status = ''
-        self.prepChi()      # create the chi2 tables if needed
+        if prep:
+            self.prepChi()      # create the chi2 tables if needed
+        elif self.generations:
+            self.useGeneration(self.currentGeneration())
 
 
     def debug_dbopt(self, db):
@@ -164,58 +505,99 @@ class Chi2:
 
 
     def getOracleDBI(self, host, port, service, user, pw, temp_table=None):
-        dsn = cx.makedsn(host, int(port), service_name=service)
-        log.debug(dsn)
+        dbi = self.dbmgr(self.oracleConnect(host, port, service, user, pw),
+                         temp_table)
+        return dbi
+
+
+    def oracleConnect(self, host, port, service, user, pw):
+        '''Make access to connect (once) to an Oracle database.'''
         def theDB(it=[]):
             if not it:
+                import cx_Oracle as cx
+                dsn = cx.makedsn(host, int(port), service_name=service)
+                log.debug(dsn)
                 it.append(cx.connect(user, pw, dsn))
             return it[0]
-        dbi = self.dbmgr(theDB, temp_table)
-        return dbi
+        return theDB
+
+
+    def mkRouter(self, host, port, service, user, pw, standbys, staleness):
+        '''Route read-only queries to standbys of a database; see `replicas`.
+
+        Standbys take the same user and password as the primary.
+        '''
+        return replicas.Router(
+            self.oracleConnect(host, port, service, user, pw),
+            [self.oracleConnect(h, p, s, user, pw) for (h, p, s) in standbys],
+            staleness, clock=time.time, lag=replicas.apply_lag,
+            start=os.getpid(), fatal=(jobctl.JobCancelled,))
+
+
+    def readRouted(self, query_class, read, crc=False, found=lambda out: True):
+        '''Run read(db) on a standby fit for `query_class`, if any, else on
+        the primary (of the crc database, or else chi).
+        '''
+        def run(connect):
+            with self.dbmgr(connect)() as db:
+                return read(db)
+        return self.routers['crc' if crc else 'chi'].read(query_class, run, found)
+
+
+    def wrote(self):
+        '''Note a write, so that later reads see it.'''
+        for router in self.routers.values():
+            router.wrote()
 
 
     def runQMID(self):
         '''Run chi2 for an i2b2 query master id'''
-        pconcepts = self.pconcepts
-        pcounts = self.pcounts
-        host, port, service, user, pw = self.getCrcOpt()
-        dbi = self.getOracleDBI(host, port, service, user, pw)
-        with dbi() as db:
-            sql = '''
-                select ps.result_instance_id
-                    , qi.query_instance_id, qm.query_master_id
-                from {0}.qt_query_master qm
-                join {0}.qt_query_instance qi
-                    on qi.query_master_id = qm.query_master_id
-                join {0}.qt_query_result_instance ri 
-                    on ri.query_instance_id = qi.query_instance_id
-                join {0}.qt_patient_set_collection ps
-                    on ps.result_instance_id = ri.result_instance_id
-                where ri.result_type_id = 1     -- patient set
-                and qm.query_master_id={1} and rownum = 1
-                order by ps.result_instance_id desc, qi.query_instance_id desc
-            '''.format(self.schema, self.qmid)
-            cols, rows = do_log_sql(db, sql)
-            if len(rows) == 0:
-                str = 'ERROR, QMID {0} has no patient set result instance'.format(self.qmid)
-                #log.error(str)
-                return str
-            qdata = dict(zip([c.lower() for c in cols], list(rows[0])))
-            log.debug('qdata={0}'.format(qdata))
-            self.qiid = qdata['query_instance_id']
-            self.qrid = qdata['result_instance_id']
-            self.chi_name = 'M{0}_I{1}_R{2}'.format(self.qmid, self.qiid, self.qrid)
+        err = self.readRouted('qt', self.lookupQMID, crc=True,
+                              found=lambda err: err is None)
+        if err is not None:
+            return err
+        return self.runChi()
 
-            sql = '''
-                select distinct patient_num
-                from {0}.qt_patient_set_collection pc
-                join {2} chipat on chipat.pn = pc.patient_num
-                where result_instance_id = {1}
-            '''.format(self.schema, self.qrid, self.chipats)
-            cols, rows = do_log_sql(db, sql)
-            self.pats = rows
 
-        return self.runChi()
+    def lookupQMID(self, db):
+        '''Find the latest patient set of a query, and its patients.
+
+        :return: an error message, or None
+        '''
+        sql = '''
+            select ps.result_instance_id
+                , qi.query_instance_id, qm.query_master_id
+            from {0}.qt_query_master qm
+            join {0}.qt_query_instance qi
+                on qi.query_master_id = qm.query_master_id
+            join {0}.qt_query_result_instance ri 
+                on ri.query_instance_id = qi.query_instance_id
+            join {0}.qt_patient_set_collection ps
+                on ps.result_instance_id = ri.result_instance_id
+            where ri.result_type_id = 1     -- patient set
+            and qm.query_master_id={1} and rownum = 1
+            order by ps.result_instance_id desc, qi.query_instance_id desc
+        '''.format(self.schema, self.qmid)
+        cols, rows = do_log_sql(db, sql)
+        if len(rows) == 0:
+            str = 'ERROR, QMID {0} has no patient set result instance'.format(self.qmid)
+            #log.error(str)
+            return str
+        qdata = dict(zip([c.lower() for c in cols], list(rows[0])))
+        log.debug('qdata={0}'.format(qdata))
+        self.qiid = qdata['query_instance_id']
+        self.qrid = qdata['result_instance_id']
+        self.chi_name = 'M{0}_I{1}_R{2}'.format(self.qmid, self.qiid, self.qrid)
+
+        sql = '''
+            select distinct patient_num
+            from {0}.qt_patient_set_collection pc
+            join {2} chipat on chipat.pn = pc.patient_num
+            where result_instance_id = {1}
+        '''.format(self.schema, self.qrid, self.chipats)
+        cols, rows = do_log_sql(db, sql)
+        self.pats = rows
+        return None
 
 
     def runPSID_p2(self):
@@ -244,6 +626,63 @@ class Chi2:
                         self.status = json.dumps({'cols': [], 'rows': [], 'status': self.status})
         return self.status
 
+    def runMatrix(self):
+        '''Compare several patient sets pairwise, from one fetch of their counts.
+
+        Each set gets its chi columns (if it hasn't already) as with -p;
+        then one query reads all the sets' count columns together.
+        '''
+        psids = []
+        for psid in self.matrix:
+            if psid not in psids:
+                psids.append(psid)
+        if len(psids) < 2:
+            self.status = 'Job canceled, need at least 2 distinct patient sets'
+            return self.matrix_status([], [])
+
+        names = []
+        for psid in psids:
+            self.resetPS(psid)
+            self.runPSID()
+            if self.chi_name is None:
+                if not self.status:
+                    self.status = 'ERROR, no chi columns for PSID {0}'.format(psid)
+                return self.matrix_status([], [])
+            names.append(self.chi_name)
+
+        pairs = matrix_pairs(len(names), self.versus_first)
+
+        def read(db):
+            filterStr, params = self.filterCond(db)
+            sql = '''
+            select prefix, ccd, name, {1}, {2}
+            from {3}
+            where ccd != 'TOTAL'
+            and {0}
+            union all
+            select prefix, ccd, name, {1}, {2}
+            from {3} where ccd = 'TOTAL'
+            '''.format(filterStr, ', '.join(names),
+                       ', '.join(['frc_' + n for n in names]), self.pcounts)
+            cols, rows = do_log_sql(db, sql, params)
+            return rows
+        rows = self.readRouted('ranking', read)
+
+        cols, out = matrix_rows(names, pairs, rows, self.cutoff)
+        if self.to_file:
+            self.write_csv(cols, out)
+        self.status = 'Done, chi success!'
+        return self.matrix_status(cols, out, names, pairs)
+
+    def matrix_status(self, cols, rows, names=[], pairs=[]):
+        if not self.to_json:
+            return self.status
+        self.status = json.dumps({'sets': names, 'pairs': pairs,
+                                  'cols': cols, 'rows': rows,
+                                  'status': self.status})
+        return self.status
+
+
     def resetPS(self, psid):
         self.psid = psid
         self.psid_done = False
@@ -256,84 +695,112 @@ class Chi2:
 
     def runPSID(self):
         '''Run chi2 for an i2b2 patient set id'''
-        pconcepts = self.pconcepts
-        pcounts = self.pcounts
+        err = self.lookupPSID()
+        if err is not None:
+            return err
+
+        # read the patient set in runChi, only if it's needed
+        self.pats = None
+
+        return self.runChi()
+
+
+    def lookupPSID(self):
+        '''Find the chi column name for a patient set, from its columns,
+        if it has them yet, or else from the QT tables.
+
+        :return: an error message, or None
+        '''
+        # Columns of a cohort added just now may not be on a standby yet,
+        # so look for them on the primary.
         host, port, service, user, pw = self.getCrcOpt()
         dbi = self.getOracleDBI(host, port, service, user, pw)
         with dbi() as db:
-            # First check if chi2 results exists for patient set already
-            try:
-                log.debug('Checking if columns already exist for PSID {0}...'.format(self.psid))
-                table_info = pcounts.split('.')
-                owner, table_name = '', ''
-                if len(table_info) > 1:
-                    owner = 'and owner = \'{0}\''.format(table_info[0].upper())
-                    table_name = 'and table_name = \'{0}\''.format(table_info[1].upper())
-                elif len(table_info) > 0:
-                    table_name = 'and table_name = \'{0}\''.format(table_info[0].upper())
-                sql = '''
-                select column_name from all_tab_columns
-                where 1=1 {0} {1}
-                and column_name like '%_R{2}'
-                order by column_name desc
-                '''.format(owner, table_name, self.psid)
-                cols, rows = do_log_sql(db, sql)
-                if len(rows) > 0:
-                    self.chi_name = rows[0][0]
-                    self.psid_done = True
-                    log.info('Using preexisting chi columns for PSID {0}'.format(self.psid))
-                elif self.extant:
-                    self.status = 'No data for PSID {0}, try running without -e/--exists'.format(self.psid)
-                    return self.status
-            except:
-                raise
+            chi_name = self.findChiName(db, self.psid)
+        if chi_name is not None:
+            self.chi_name = chi_name
+            self.psid_done = True
+            log.info('Using preexisting chi columns for PSID {0}'.format(self.psid))
+            match = re.match('M(?P<qmid>\d+)_I(?P<qiid>\d+)_R(?P<qrid>\d+)', self.chi_name)
+            self.qmid = match.group('qmid')
+            self.qiid = match.group('qiid')
+            self.qrid = match.group('qrid')
+            return None
+        elif self.extant:
+            self.status = 'No data for PSID {0}, try running without -e/--exists'.format(self.psid)
+            return self.status
 
-            # Get QMID and QIID to make column names
-            if self.chi_name is None:
-                # Make sure patient set exists in i2b2
-                sql = '''
-                    select qm.query_master_id
-                        , qi.query_instance_id
-                        , ri.result_instance_id
-                    from {0}.qt_query_result_instance ri
-                    join {0}.qt_query_instance qi 
-                        on qi.query_instance_id = ri.query_instance_id
-                    join {0}.qt_query_master qm 
-                        on qm.query_master_id = qi.query_master_id
-                    where ri.result_type_id = 1     -- patient set
-                    and ri.result_instance_id = {1} and rownum = 1
-                    order by qi.query_instance_id desc, qm.query_master_id desc
-                '''.format(self.schema, self.psid)
-                cols, rows = do_log_sql(db, sql)
-                if len(rows) == 0:
-                    str = 'ERROR, patient set (PSID={0}) not found in QT tables'.format(self.psid)
-                    #log.error(str)
-                    return str
-                qdata = dict(zip([c.lower() for c in cols], list(rows[0])))
-                log.debug('qdata={0}'.format(qdata))
-                self.qmid = qdata['query_master_id']
-                self.qiid = qdata['query_instance_id']
-                self.qrid = qdata['result_instance_id']
-                self.chi_name = 'M{0}_I{1}_R{2}'.format(self.qmid, self.qiid, self.qrid)
-            else:
-                match = re.match('M(?P<qmid>\d+)_I(?P<qiid>\d+)_R(?P<qrid>\d+)', self.chi_name)
-                self.qmid = match.group('qmid')
-                self.qiid = match.group('qiid')
-                self.qrid = match.group('qrid')
+        # Get QMID and QIID to make column names; a patient set made
+        # just now may not be on a standby yet, so look again on the primary.
+        qdata = self.readRouted('qt', self.findQT, crc=True,
+                                found=lambda qdata: qdata is not None)
+        if qdata is None:
+            str = 'ERROR, patient set (PSID={0}) not found in QT tables'.format(self.psid)
+            #log.error(str)
+            return str
+        self.qmid = qdata['query_master_id']
+        self.qiid = qdata['query_instance_id']
+        self.qrid = qdata['result_instance_id']
+        self.chi_name = 'M{0}_I{1}_R{2}'.format(self.qmid, self.qiid, self.qrid)
+        return None
+
+
+    def findQT(self, db):
+        '''Find the query master and instance of a patient set, if it's
+        in the QT tables.
+
+        :rtype: Option[Dict[String, Int]]
+        '''
+        sql = '''
+            select qm.query_master_id
+                , qi.query_instance_id
+                , ri.result_instance_id
+            from {0}.qt_query_result_instance ri
+            join {0}.qt_query_instance qi 
+                on qi.query_instance_id = ri.query_instance_id
+            join {0}.qt_query_master qm 
+                on qm.query_master_id = qi.query_master_id
+            where ri.result_type_id = 1     -- patient set
+            and ri.result_instance_id = {1} and rownum = 1
+            order by qi.query_instance_id desc, qm.query_master_id desc
+        '''.format(self.schema, self.psid)
+        cols, rows = do_log_sql(db, sql)
+        if len(rows) == 0:
+            return None
+        qdata = dict(zip([c.lower() for c in cols], list(rows[0])))
+        log.debug('qdata={0}'.format(qdata))
+        return qdata
 
-            sql = '''
-                select distinct patient_num
-                from {0}.qt_patient_set_collection pc
-                join {2} chipat on chipat.pn = pc.patient_num
-                where result_instance_id = {1}
-            '''.format(self.schema, self.qrid, self.chipats)
-            cols, rows = do_log_sql(db, sql)
-            self.pats = rows
 
-            return self.runChi()
+    def hasColumns(self, psids):
+        '''Have these patient sets all got chi columns yet? Then a job
+        on them only reads stored counts.
+        '''
+        host, port, service, user, pw = self.getCrcOpt()
+        dbi = self.getOracleDBI(host, port, service, user, pw)
+        with dbi() as db:
+            return all(self.findChiName(db, psid) is not None
+                       for psid in psids)
 
 
-    def prepChi(self):
+    def findChiName(self, db, psid):
+        '''Find the chi column name for a patient set, if it has one yet.'''
+        log.debug('Checking if columns already exist for PSID {0}...'.format(psid))
+        owner, table_name = owner_conds(self.pcounts)
+        sql = '''
+        select column_name from all_tab_columns
+        where 1=1 {0} {1}
+        and column_name like '%_R{2}'
+        order by column_name desc
+        '''.format(owner, table_name, psid)
+        cols, rows = do_log_sql(db, sql)
+        return rows[0][0] if len(rows) > 0 else None
+
+
+    def prepChi(self, generation=None):
+        if self.generations:
+            self.useGeneration(self.currentGeneration()
+                               if generation is None else generation)
         schema = self.schema
         metaschema = self.metaschema
         pconcepts = self.pconcepts
@@ -343,6 +810,9 @@ class Chi2:
         host, port, service, user, pw, temp_table = self.getChiOpt()
         chi_dbi = self.getOracleDBI(host, port, service, user, pw, temp_table)
         with chi_dbi() as db:
+            self.phase(db, 'prep')
+            if self.plans:
+                self.prepPlans(db)
             # check if chipats exists
             try:
                 log.debug('Checking if chi_pats table exists...')
@@ -424,7 +894,7 @@ class Chi2:
                 {7} and valueflag_cd in ('H','L')
                 '''.format(pconcepts, self.schema, self.chipats, self.metaschema, self.termtable, self.branchnodes, self.vfnodes, self.allbranchnodes)
                 #.format(pconcepts, pobsfact, self.chipats, self.metaschema, self.termtable, self.branchnodes, self.vfnodes, self.allbranchnodes)
-                cols, rows = do_log_sql(db, sql)
+                cols, rows = do_log_sql(db, sql, tag='pconcepts', plans=self.plans)
                 sql = '''
                 alter table {0} add constraint {0}_pk primary key (ccd,pn)
                 '''.format(pconcepts)
@@ -509,7 +979,7 @@ class Chi2:
                 select 'TOTAL' prefix, 'TOTAL' ccd, 'All Patients in Population' name
                 , {8} total, 1 frc_total from dual
                 '''.format(pcounts, pconcepts, schema, self.metaschema, self.termtable, self.branchnodes, self.vfnodes, self.allbranchnodes, pat_totalcount)
-                cols, rows = do_log_sql(db, sql)
+                cols, rows = do_log_sql(db, sql, tag='pcounts', plans=self.plans)
 
                 sql = '''alter table {0} add constraint {0}_pk primary key (prefix,ccd,total)
                 '''.format(pcounts)
@@ -549,7 +1019,325 @@ class Chi2:
 		do_log_sql(db,'commit')
 		sql = '''create index {0}_idx on {0} (c_name)'''.format(chischemes)
 		cols, rows = do_log_sql(db,sql)
+            if self.results:
+                self.prepResults(db)
+            if self.dated:
+                self.prepDated(db)
+            if self.minhash:
+                self.prepMinhash(db)
+            if self.pairs:
+                self.prepPairs(db)
+
+
+    def useGeneration(self, generation):
+        '''Use a generation of the tables a rebuild makes anew.'''
+        self.generation = generation
+        name = lambda k: generations.table_name(self.base_tables[k], generation)
+        self.chipats = name('chi_pats')
+        self.pconcepts = name('chi_pconcepts')
+        self.pcounts = name('chi_pcounts')
+        self.chischemes = name('chischemes')
+        if self.dated:
+            self.dated = name('chi_pconcepts_dated')
+        if self.minhash:
+            self.minhash = name('chi_minhash')
+        if generation:
+            log.debug('generation {0}: {1}'.format(generation, self.pcounts))
+
 
+    def currentGeneration(self):
+        '''The generation of the chi tables that jobs use now.'''
+        host, port, service, user, pw, temp_table = self.getChiOpt()
+        chi_dbi = self.getOracleDBI(host, port, service, user, pw)
+        with chi_dbi() as db:
+            import cx_Oracle
+            try:
+                log.debug('Checking if chi_generations table exists...')
+                return self.generations.current(db)
+            except cx_Oracle.DatabaseError as ex:
+                if not missing_table(ex):
+                    raise
+                log.info('chi_generations table ({0}) does not exist, creating it...'.format(self.generations.table))
+                cols, rows = do_log_sql(db, self.generations.create_sql())
+                return 0
+
+
+    def runRebuild(self):
+        '''Build a new generation of the chi tables, check it, carry the
+        cohorts forward to it, and switch to it.
+        '''
+        if not self.generations:
+            raise ValueError('no chi_generations table in config')
+        old = self.generation
+        new = old + 1
+        host, port, service, user, pw, temp_table = self.getChiOpt()
+        chi_dbi = self.getOracleDBI(host, port, service, user, pw)
+        with chi_dbi() as db:
+            # left over from a rebuild that failed?
+            self.dropGeneration(db, new)
+        log.info('Building generation {0} of the chi tables'.format(new))
+        self.prepChi(generation=new)
+
+        with chi_dbi() as db:
+            self.phase(db, 'prep')
+            counts = {}
+            for k in ['chi_pats', 'chi_pconcepts', 'chi_pcounts']:
+                for g in [old, new]:
+                    sql = 'select count(*) from {0}'.format(
+                        generations.table_name(self.base_tables[k], g))
+                    cols, rows = do_log_sql(db, sql)
+                    counts[k, g] = rows[0][0]
+            by_gen = lambda g: dict((k, n) for ((k, gk), n) in counts.items() if gk == g)
+            problems = generations.check_counts(by_gen(old), by_gen(new),
+                                                self.rebuild_tolerance)
+            if problems:
+                self.status = 'Kept generation {0}; generation {1}: {2}'.format(
+                    old, new, '; '.join(problems))
+                log.error(self.status)
+                return self.status
+
+            carried = self.carryCohorts(db, old)
+            note = ', '.join(['{0} {1} rows'.format(k, n)
+                              for k, n in sorted(by_gen(new).items())] +
+                             ['{0} cohorts'.format(carried)])
+            # what the switch makes stale goes in the same transaction
+            if self.results:
+                # rankings against the whole population change with it
+                sql = "delete from {0} where ref_name = 'TOTAL'".format(self.results)
+                cols, rows = do_log_sql(db, sql)
+            if self.pairs:
+                cols, rows = do_log_sql(db, 'delete from {0}'.format(self.pairs))
+            self.generations.switch(db, new, note)
+            do_log_sql(db, 'commit')
+            # jobs that started before the switch may still use old
+            if old > 0:
+                self.dropGeneration(db, old - 1)
+        if self.snapshot:
+            # runPairs ignores a snapshot of another generation meanwhile
+            self.runSnapshot()
+        self.status = 'Done, generation {0}: {1}'.format(new, note)
+        return self.status
+
+
+    def carryCohorts(self, db, generation):
+        '''Copy the cohort columns of chi_pcounts of a generation to the
+        current chi_pcounts; return how many.
+        '''
+        source = generations.table_name(self.base_tables['chi_pcounts'], generation)
+        owner, table_name = owner_conds(source)
+        sql = '''
+        select column_name from all_tab_columns
+        where 1=1 {0} {1}
+        order by column_id
+        '''.format(owner, table_name)
+        cols, rows = do_log_sql(db, sql)
+        names = generations.cohort_columns([r[0] for r in rows])
+        log.info('Carrying {0} cohorts forward from {1}'.format(len(names), source))
+        for name in names:
+            for col in [name, 'frc_' + name]:
+                sql = 'alter table {0} add {1} number default 0 not null'.format(self.pcounts, col)
+                cols, rows = do_log_sql(db, sql)
+        batch = 100  # columns per statement
+        for ix in range(0, len(names), batch):
+            sql = '''
+            merge into {0} n
+            using {1} o
+            on (n.ccd = o.ccd)
+            when matched then update set {2}
+            '''.format(self.pcounts, source, '\n            , '.join(
+                ['n.{0} = o.{0}, n.frc_{0} = o.frc_{0}'.format(name)
+                 for name in names[ix:ix + batch]]))
+            cols, rows = do_log_sql(db, sql)
+        return len(names)
+
+
+    def dropGeneration(self, db, generation):
+        '''Drop the tables of a generation, those that exist.'''
+        tables = [generations.table_name(self.base_tables[k], generation)
+                  for k in sorted(self.base_tables)]
+        if self.minhash:
+            tables.append(generations.table_name(
+                self.base_tables['chi_minhash'], generation) + '_lsh')
+        tables.append(self.strataTable(generation))
+        for table in tables:
+            try:
+                cols, rows = do_log_sql(db, 'drop table {0}'.format(table))
+                log.info('Dropped {0}'.format(table))
+            except Exception as ex:
+                log.debug('Not dropped {0}: {1}'.format(table, ex))
+
+
+    def prepPlans(self, db):
+        '''Create the execution plans table if needed.'''
+        try:
+            log.debug('Checking if chi_plans table exists...')
+            cols, rows = do_log_sql(db, 'select 1 from {0} where rownum = 1'.format(self.plans.table))
+        except:
+            log.info('chi_plans table ({0}) does not exist, creating it...'.format(self.plans.table))
+            cols, rows = do_log_sql(db, self.plans.create_sql())
+            sql = 'create index {0}_tag_idx on {0} (tag, run_at)'.format(self.plans.table)
+            cols, rows = do_log_sql(db, sql)
+
+
+    def prepResults(self, db):
+        '''Create the ranked results store if needed.'''
+        results = self.results
+        try:
+            log.debug('Checking if chi_results table exists...')
+            cols, rows = do_log_sql(db, 'select 1 from {0} where rownum = 1'.format(results))
+        except:
+            log.info('chi_results table ({0}) does not exist, creating it...'.format(results))
+            sql = '''
+            create table {0} (
+              test_name varchar2(30) not null   -- chi column name of test set
+            , ref_name varchar2(30) not null    -- ... of reference set, or TOTAL
+            , prefix varchar2(200)
+            , ccd varchar2(200)
+            , name varchar2(2000)
+            , ref_cnt number
+            , ref_frc number
+            , test_cnt number
+            , test_frc number
+            , chisq number
+            , odds_ratio number
+            , dir number
+            , rank number       -- 0 for the TOTAL row
+            , revrank number
+            )
+            '''.format(results)
+            cols, rows = do_log_sql(db, sql)
+            # pages are read by keyset, from either end of the ranking
+            sql = '''
+            create unique index {0}_rank_idx on {0} (test_name, ref_name, rank)
+            '''.format(results)
+            cols, rows = do_log_sql(db, sql)
+            sql = '''
+            create unique index {0}_revrank_idx on {0} (test_name, ref_name, revrank)
+            '''.format(results)
+            cols, rows = do_log_sql(db, sql)
+
+
+
+    def prepDated(self, db):
+        '''Create the time-sliced concept store if needed.
+
+        Like chi_pconcepts, but with the first and last fact date of
+        each (patient, concept), range-partitioned by year of the last
+        date, so a window that starts in 2015 skips all the partitions
+        of patients' facts that ended before then.
+        '''
+        dated = self.dated
+        try:
+            log.debug('Checking if chi_pconcepts_dated table exists...')
+            cols, rows = do_log_sql(db, 'select 1 from {0} where rownum = 1'.format(dated))
+        except:
+            log.info('chi_pconcepts_dated table ({0}) does not exist, creating it...'.format(dated))
+            sql = '''
+            create table {0} (
+              pn number not null
+            , ccd varchar2(200) not null
+            , first_dt date not null
+            , last_dt date not null
+            )
+            partition by range (last_dt) interval (numtoyminterval(1, 'YEAR'))
+            (partition {0}_p0 values less than (date '1900-01-01'))
+            '''.format(dated)
+            cols, rows = do_log_sql(db, sql)
+            # the same facts and branch nodes as chi_pconcepts, with dates
+            sql = '''
+            insert /*+ append */ into {0} (pn, ccd, first_dt, last_dt)
+            select pn, ccd, min(dt), max(dt)
+            from (
+                select patient_num pn, concept_cd ccd, start_date dt
+                from {1}.observation_fact obs
+                join {2} chipat on chipat.pn = obs.patient_num
+                union all
+                select obs.patient_num pn, c_basecode ccd, obs.start_date dt
+                from {3}.{4}
+                join {1}.concept_dimension cd
+                on concept_path like c_dimcode||'%'
+                join {1}.observation_fact obs
+                on cd.concept_cd = obs.concept_cd
+                join {2} chipat on chipat.pn = obs.patient_num
+                where ( {5} or {6} ) and
+                {7}
+                union all
+                select patient_num pn, valueflag_cd||'_'||c_basecode ccd, obs.start_date dt
+                from {3}.{4}
+                join {1}.concept_dimension cd
+                on concept_path like c_dimcode||'%'
+                join {1}.observation_fact obs
+                on cd.concept_cd = obs.concept_cd
+                join {2} chipat on chipat.pn = obs.patient_num
+                where ( {6} ) and
+                {7} and valueflag_cd in ('H','L')
+            )
+            where dt is not null
+            group by pn, ccd
+            '''.format(dated, self.schema, self.chipats, self.metaschema, self.termtable,
+                       self.branchnodes, self.vfnodes, self.allbranchnodes)
+            cols, rows = do_log_sql(db, sql)
+            do_log_sql(db, 'commit')
+            sql = '''
+            create index {0}_pn_idx on {0} (pn) local
+            '''.format(dated)
+            cols, rows = do_log_sql(db, sql)
+
+
+    def prepMinhash(self, db):
+        '''Create the MinHash signature and LSH band tables if needed:
+        one grouped pass over chi_pconcepts, in the database.
+        '''
+        sigs = self.minhash
+        try:
+            log.debug('Checking if chi_minhash table exists...')
+            cols, rows = do_log_sql(db, 'select 1 from {0} where rownum = 1'.format(sigs))
+        except:
+            log.info('chi_minhash table ({0}) does not exist, creating it...'.format(sigs))
+            sql = '''
+            create table {0} as
+            select ccd
+            , {1}
+            from {2}
+            group by ccd
+            '''.format(sigs, minhash.signature_sql(minhash.hash_params()), self.pconcepts)
+            cols, rows = do_log_sql(db, sql)
+            sql = '''alter table {0} add constraint {0}_pk primary key (ccd)'''.format(sigs)
+            cols, rows = do_log_sql(db, sql)
+            sql = '''
+            create table {0}_lsh as
+            {1}
+            '''.format(sigs, minhash.band_sql(sigs))
+            cols, rows = do_log_sql(db, sql)
+            sql = '''create index {0}_lsh_idx on {0}_lsh (band, bucket)'''.format(sigs)
+            cols, rows = do_log_sql(db, sql)
+
+
+    def prepPairs(self, db):
+        '''Create the co-occurring pairs table if needed; index-organized
+        and key-compressed, since a cohort's pairs share its psid.
+        '''
+        pairs = self.pairs
+        try:
+            log.debug('Checking if chi_pairs table exists...')
+            cols, rows = do_log_sql(db, 'select 1 from {0} where rownum = 1'.format(pairs))
+        except:
+            log.info('chi_pairs table ({0}) does not exist, creating it...'.format(pairs))
+            sql = '''
+            create table {0} (
+              psid number not null
+            , ccd1 varchar2(200) not null
+            , ccd2 varchar2(200) not null
+            , n1 number not null      -- patients with ccd1
+            , n2 number not null      -- ... with ccd2
+            , n12 number not null     -- ... with both
+            , lift number
+            , odds_ratio number
+            , constraint {0}_pk primary key (psid, ccd1, ccd2)
+            )
+            organization index compress 1
+            '''.format(pairs)
+            cols, rows = do_log_sql(db, sql)
 
 
     def runChi(self):
@@ -560,6 +1348,7 @@ class Chi2:
         host, port, service, user, pw, temp_table = self.getChiOpt()
         chi_dbi = self.getOracleDBI(host, port, service, user, pw, temp_table)
         with chi_dbi() as db:
+            self.phase(db, 'cohort')
             runChi = True
             if self.qmid is not None:
                 col_name = self.checkRerunQMID(db)
@@ -569,6 +1358,7 @@ class Chi2:
             elif self.psid is not None and self.psid_done:
                 runChi = False              # already done
             chi_name = self.chi_name
+            npats = len(pats) if pats is not None else None
 
             if runChi:
                 # make a temp table of patient set for query chi_name=m###_r###_i###
@@ -583,15 +1373,19 @@ class Chi2:
                         where 1 = 0
                 '''.format(chi_name, schema)
                 cols, rows = do_log_sql(db, sql)
-                sql='insert into {0} (pn) values (:pn)'.format(chi_name)
-                cols, rows = do_log_sql(db, sql, [[p[0]] for p in pats])
+                npats = self.fillCohort(db, chi_name)
 
-                # add columns to chi_pcounts
-                sql = 'alter table {0} add {1} number'.format(pcounts, chi_name)
+                # add columns to chi_pcounts; with a default and not null,
+                # Oracle records the 0 in the dictionary, not in each row
+                sql = 'alter table {0} add {1} number default 0 not null'.format(pcounts, chi_name)
                 cols, rows = do_log_sql(db, sql)
 
-                sql = 'alter table {0} add frc_{1} number'.format(pcounts, chi_name)
+                sql = 'alter table {0} add frc_{1} number default 0 not null'.format(pcounts, chi_name)
                 cols, rows = do_log_sql(db, sql)
+                # DDL commits, so a failure from here on must take the
+                # columns out again; set unused is quick, as drop isn't.
+                self.undo.append('alter table {0} set unused ({1}, frc_{1})'.format(
+                    pcounts, chi_name))
                 log.info('Updating view for correlated update')
                 sql = '''
                 -- pconcepts = {0}
@@ -612,49 +1406,657 @@ class Chi2:
 		cols, rows = do_log_sql(db,sql)
 		# This view-based approach seems to run in under 2min for a 19k patient-set
 		log.info('updating columns of {0}'.format(pcounts))
+                redo0 = redo_size(db)
+                # Only concepts the cohort has are written; the rest keep
+                # the column default, 0.
                 sql = '''
                 -- chi_name = {0}
                 -- pcounts = {1}
                 -- len(pats) = {2}
-                update (
-                    select 
-                        pc.{0} emptycnt -- empty target column for counts
-                        , coalesce(cnt,0) newcnt -- source column for counts
-                        , pc.frc_{0} emptyfrc -- empty target column for fractions
-                        , coalesce(cnt/coalesce(hdenom,ldenom,{2}),0) newfrc -- source column for fractions
-                    from {1} pc 
-                    left join new_cohort on pc.ccd = new_cohort.ccd
-                ) up
-                set up.emptycnt = up.newcnt, up.emptyfrc = up.newfrc
-                '''.format(chi_name, pcounts, len(pats))
-                cols, rows = do_log_sql(db, sql)
+                merge into {1} pc
+                using new_cohort nc
+                on (pc.ccd = nc.ccd)
+                when matched then update
+                set pc.{0} = nc.cnt
+                , pc.frc_{0} = nc.cnt/coalesce(nc.hdenom,nc.ldenom,{2})
+                '''.format(chi_name, pcounts, npats)
+                cols, rows = do_log_sql(db, sql, tag='new_cohort', plans=self.plans)
+                written = db.rowcount
+                redo1 = redo_size(db)
+                cols, rows = do_log_sql(db, 'select count(*) from {0}'.format(pcounts))
+                log.info('wrote {0} of {1} rows of {2} ({3:.1f}%){4}'.format(
+                    written, rows[0][0], pcounts, 100.0 * written / max(rows[0][0], 1),
+                    '' if redo0 is None or redo1 is None else
+                    ', redo {0} bytes'.format(redo1 - redo0)))
 
                 sql = '''
                 update {0} set {1} = {2}
                 , frc_{1} = 1
                 where ccd = 'TOTAL'
-                '''.format(pcounts, chi_name, len(pats))
+                '''.format(pcounts, chi_name, npats)
                 cols, rows = do_log_sql(db, sql)
 
                 cols, rows = do_log_sql(db, 'commit')
+                self.undo = []
+                self.wrote()
                 cols, rows = do_log_sql(db, 'drop table {0}'.format(chi_name))
 
                 if self.to_json:
                     sql = 'select {0}, {1} from {2}'.format(chi_name, 'frc_%s' % chi_name, pcounts)
                     cols, rows = do_log_sql(db, sql)
 
-            if self.ref:
+            if self.ref and runChi:
                 resp = self.chi2_output(db)
+            elif self.ref:
+                # nothing new to read, so a standby may do; but results
+                # are stored on the primary
+                resp = self.readRouted(
+                    'ranking', lambda rdb: self.chi2_output(rdb, store=db))
             else:
                 resp = ''
 
-        log.info('patient count={0}'.format(len(pats)))
+        log.info('patient count={0}'.format(npats))
         log.info('chi_pconcepts={0}'.format(pconcepts))
         log.info('chi_pcounts={0}'.format(pcounts))
         log.info('chi_name={0}'.format(chi_name))
         return resp
 
-    
+
+    def fillCohort(self, db, chi_name, batch_size=5000):
+        '''Insert the cohort's patients into its temp table; return how many.
+
+        Patients come from `psets` (unless runQMID has read them
+        already) and are inserted a batch at a time.
+        '''
+        sql = 'insert into {0} (pn) values (:pn)'.format(chi_name)
+        if self.pats is not None:
+            cols, rows = do_log_sql(db, sql, [[p[0]] for p in self.pats])
+            return len(self.pats)
+
+        insert_batches(db, sql, ([pn] for pn in self.psets.get(int(self.qrid))),
+                       batch_size)
+        # patient sets know nothing of chi_pats; prune to patients with facts
+        sql = '''
+            delete from {0} mc
+            where not exists (select 1 from {1} chipat where chipat.pn = mc.pn)
+        '''.format(chi_name, self.chipats)
+        cols, rows = do_log_sql(db, sql)
+        cols, rows = do_log_sql(db, 'select count(*) from {0}'.format(chi_name))
+        return rows[0][0]
+
+
+    def runStrat(self):
+        '''Compare the test set with the rest of the reference set (or
+        the population) within strata, by Cochran-Mantel-Haenszel.
+
+        Counts for all concepts by stratum come from one grouped pass
+        over chi_pconcepts; the CMH statistic and Mantel-Haenszel odds
+        ratio are then summed over strata for all concepts at once.
+        Without -r, that pass is over the test set only; the
+        population's counts by stratum are made once (see prepStrata).
+        '''
+        test_psid = self.tpsid or self.psid
+        if self.tpsid and (self.rpsid == self.tpsid or not self.checkIntersection()):
+            if not self.status:
+                self.status = 'Job canceled, identical patient sets'
+            return self.strat_status([], [])
+        groups = scratch_table('S', test_psid, self.rpsid or 'T')
+        host, port, service, user, pw, temp_table = self.getChiOpt()
+        chi_dbi = self.getOracleDBI(host, port, service, user, pw, groups)
+        with chi_dbi() as db:
+            log.info('Stratifying PSID {0} vs. {1}'.format(test_psid, self.rpsid or 'TOTAL'))
+            universe = self.fillGroups(db, groups, test_psid)
+            if self.rpsid:
+                counts = self.strataCells(universe)
+            else:
+                # the rest of the population is population less test
+                counts = self.strataVsPopulation(db, groups)
+
+            filterStr, params = self.filterCond(db, 'pcounts.prefix')
+            limstr = ''
+            if self.limit:
+                limstr = 'where rank <= {0} or revrank <= {0}'.format(int(self.limit))
+            cutoff = ''
+            if self.cutoff:
+                cutoff = 'and cmh.m1 - cmh.a >= {0}'.format(int(self.cutoff))
+            sql = '''
+            with {0}
+            , terms as (     -- strata with no patients with a concept add 0
+                select c.ccd, c.a, c.m1, m.n1, m.n0, m.n1 + m.n0 t
+                from cells c
+                join margins m on m.stratum = c.stratum
+                where m.n1 > 0 and m.n0 > 0
+            )
+            , cmh as (
+                select ccd, sum(a) a, sum(m1) m1
+                , sum(a - n1 * m1 / t) dev
+                , sum(n1 * n0 * m1 * (t - m1) / (t * t * (t - 1))) var
+                , sum(a * (n0 - m1 + a) / t) r    -- a * d / t
+                , sum((n1 - a) * (m1 - a) / t) s  -- b * c / t
+                from terms group by ccd
+            )
+            , ranked_data as (
+                select pcounts.prefix, cmh.ccd, pcounts.name
+                , cmh.m1 - cmh.a ctl_cnt, cmh.a test_cnt
+                , case when var > 0 then power(greatest(abs(dev) - 0.5, 0), 2) / var end cmh_chisq
+                , case when s > 0 then r / s when r > 0 then null else 1 end mh_odds_ratio
+                , case when dev = 0 then 0 when dev > 0 then 1 else -1 end dir
+                , row_number() over (order by case when s > 0 then r / s end desc nulls first, cmh.ccd) rank
+                , row_number() over (order by case when s > 0 then r / s end asc nulls last, cmh.ccd desc) revrank
+                from cmh
+                join {1} pcounts on pcounts.ccd = cmh.ccd
+                where {2} {3}
+            )
+            select 'TOTAL' prefix, 'TOTAL' ccd, 'Stratified by: ' || count(*) || ' strata' name
+            , sum(n0) ctl_cnt, sum(n1) test_cnt
+            , null cmh_chisq, null mh_odds_ratio, null dir
+            from margins
+            union all
+            select prefix, ccd, name, ctl_cnt, test_cnt, cmh_chisq, mh_odds_ratio, dir
+            from (select * from ranked_data {4} order by rank)
+            '''.format(counts, self.pcounts, filterStr, cutoff, limstr)
+            cols, rows = do_log_sql(db, sql, params)
+            cols0, rows0 = do_log_sql(db, 'drop table {0}'.format(groups))
+
+        if self.to_file:
+            self.write_csv(cols, rows)
+        self.status = 'Done, chi success!'
+        return self.strat_status(cols, rows)
+
+
+    def strataCells(self, universe):
+        '''SQL for the margins (stratum sizes: n1 test, n0 control) and
+        cells (concept x stratum: a test, m1 all) of a universe of
+        (pn, grp), in one grouped pass over it.
+        '''
+        return '''
+            universe as (
+                {0}
+            )
+            , strata as (
+                select u.pn, u.grp, {1} stratum
+                from universe u
+                join {2}.patient_dimension pd on pd.patient_num = u.pn
+            )
+            , margins as (
+                select stratum, sum(grp) n1, sum(1 - grp) n0
+                from strata group by stratum
+            )
+            , cells as (
+                select pc.ccd, s.stratum
+                , sum(s.grp) a   -- test patients with the concept
+                , count(*) m1    -- all patients with the concept
+                from {3} pc
+                join strata s on s.pn = pc.pn
+                group by pc.ccd, s.stratum
+            )
+            '''.format(universe, self.strata, self.schema, self.pconcepts)
+
+
+    def strataVsPopulation(self, db, groups):
+        '''SQL for margins and cells (as `strataCells`) of the test set
+        in a scratch table vs. the rest of the population, from one
+        grouped pass over the test set and the population's counts.
+
+        The test set's strata are as of the same day as the
+        population's, so each test patient falls in a stored stratum.
+        '''
+        population, as_of = self.prepStrata(db)
+        return '''
+            test as (
+                select g.pn, {1} stratum from {0} g
+                join {2} chipat on chipat.pn = g.pn
+                join {3}.patient_dimension pd on pd.patient_num = g.pn
+            )
+            , margins as (
+                select p.stratum, coalesce(t.n1, 0) n1, p.m - coalesce(t.n1, 0) n0
+                from {4} p
+                left join (
+                    select stratum, count(*) n1 from test group by stratum
+                ) t on t.stratum = p.stratum
+                where p.ccd = 'TOTAL'
+            )
+            , cells as (
+                select p.ccd, p.stratum, coalesce(t.a, 0) a, p.m m1
+                from {4} p
+                left join (
+                    select pc.ccd, s.stratum, count(*) a
+                    from {5} pc
+                    join test s on s.pn = pc.pn
+                    group by pc.ccd, s.stratum
+                ) t on t.ccd = p.ccd and t.stratum = p.stratum
+                where p.ccd != 'TOTAL'
+            )
+            '''.format(groups, strata_as_of(self.strata, as_of), self.chipats,
+                       self.schema, population, self.pconcepts)
+
+
+    def strataTable(self, generation=None):
+        '''Name of the population's counts by stratum: one per
+        generation of chi_pcounts, and per chi_strata expression; short,
+        for Oracle's 30 character names.
+        '''
+        pcounts = (self.pcounts if generation is None else
+                   generations.table_name(self.base_tables['chi_pcounts'], generation))
+        schema, dot, name = pcounts.rpartition('.')
+        key = zlib.crc32('{0}\n{1}'.format(name, self.strata)) & 0xffffffff
+        return '{0}{1}chis_{2:08x}'.format(schema, dot, key)
+
+
+    def prepStrata(self, db):
+        '''Create the population's counts by stratum if needed: patients
+        with each concept (and, as concept TOTAL, all patients) by stratum,
+        with ages as of the day the counts are made.
+
+        :return: table name, and that day (YYYY-MM-DD)
+        '''
+        table = self.strataTable()
+        try:
+            log.debug('Checking if strata counts table exists...')
+            cols, rows = do_log_sql(db, 'select as_of from {0} where rownum = 1'.format(table))
+        except:
+            log.info('strata counts table ({0}) does not exist, creating it...'.format(table))
+            cols, rows = do_log_sql(db, "select to_char(sysdate, 'YYYY-MM-DD') from dual")
+            as_of = rows[0][0]
+            sql = '''
+            create table {0} (stratum, ccd, m, as_of,
+              constraint {5}_pk primary key (stratum, ccd))
+            organization index compress 1 as
+            select {1} stratum, pc.ccd, count(*) m, '{6}' as_of
+            from {2} pc
+            join {3} chipat on chipat.pn = pc.pn
+            join {4}.patient_dimension pd on pd.patient_num = pc.pn
+            group by {1}, pc.ccd
+            union all
+            select {1} stratum, 'TOTAL' ccd, count(*) m, '{6}' as_of
+            from {3} chipat
+            join {4}.patient_dimension pd on pd.patient_num = chipat.pn
+            group by {1}
+            '''.format(table, strata_as_of(self.strata, as_of), self.pconcepts,
+                       self.chipats, self.schema, table.split('.')[-1], as_of)
+            cols, rows = do_log_sql(db, sql)
+            return table, as_of
+        return table, rows[0][0]
+
+
+    def fillGroups(self, db, groups, test_psid, sample=iter):
+        '''Make a scratch table of the patients to compare: grp is 1 for
+        the test set, 0 for the rest of the reference set (-r). Without
+        -r, the rest of the population is the reference.
+
+        :param sample: which patients of a set to use; default all
+        :type sample: (PatientSet) => Iterable[Int]
+        :return: SQL for (pn, grp) of patients with facts
+        '''
+        test = self.psets.get(int(test_psid))
+        sql = 'create table {0} (pn number primary key, grp number)'.format(groups)
+        cols, rows = do_log_sql(db, sql)
+        sql = 'insert into {0} (pn, grp) values (:pn, :grp)'.format(groups)
+        insert_batches(db, sql, ([pn, 1] for pn in sample(test)))
+        if self.rpsid:
+            control = self.psets.get(int(self.rpsid)) - test
+            insert_batches(db, sql, ([pn, 0] for pn in sample(control)))
+            return '''
+            select g.pn, g.grp from {0} g
+            join {1} chipat on chipat.pn = g.pn
+            '''.format(groups, self.chipats)
+        return '''
+            select chipat.pn, coalesce(g.grp, 0) grp from {1} chipat
+            left join {0} g on g.pn = chipat.pn
+            '''.format(groups, self.chipats)
+
+
+    def runWindow(self):
+        '''Compare the test set with the reference set (or population)
+        counting only facts in the --since/--until window.
+
+        Only partitions of chi_pconcepts_dated whose facts may fall in
+        the window are read; the statistics are those of chi2_output.
+        '''
+        test_psid = self.tpsid or self.psid
+        if not self.dated:
+            self.status = 'ERROR, date windows need chi_pconcepts_dated in the config'
+            return self.strat_status([], [])
+        if self.tpsid and (self.rpsid == self.tpsid or not self.checkIntersection()):
+            if not self.status:
+                self.status = 'Job canceled, identical patient sets'
+            return self.strat_status([], [])
+        conds = []
+        if self.since:
+            conds.append("d.last_dt >= date '{0}'".format(self.since))
+        if self.until:
+            conds.append("d.first_dt < date '{0}' + 1".format(self.until))
+        groups = scratch_table('W', test_psid, self.rpsid or 'T')
+        host, port, service, user, pw, temp_table = self.getChiOpt()
+        chi_dbi = self.getOracleDBI(host, port, service, user, pw, groups)
+        with chi_dbi() as db:
+            log.info('PSID {0} vs. {1}, facts from {2} to {3}'.format(
+                test_psid, self.rpsid or 'TOTAL', self.since or '-', self.until or '-'))
+            universe = self.fillGroups(db, groups, test_psid)
+            filterStr, params = self.filterCond(db)
+            limstr = ''
+            if self.limit:
+                limstr = 'where rank <= {0} or revrank <= {0}'.format(int(self.limit))
+            cutoff = ''
+            if self.cutoff:
+                cutoff = 'and wref >= {0}'.format(int(self.cutoff))
+            # Without -r, the reference is the whole population, test included,
+            # as for chi2_output.
+            sql = '''
+            with universe as (
+                {0}
+            )
+            , sizes as (
+                select count(*) nref, sum(grp) ntest from universe
+            )
+            , windowed as (
+                select d.ccd, count(*) ref_cnt, sum(u.grp) test_cnt
+                from {1} d
+                join universe u on u.pn = d.pn
+                where {2}
+                group by d.ccd
+            )
+            , counts as (
+                select pcounts.prefix, w.ccd, pcounts.name
+                , w.ref_cnt wref, w.ref_cnt / sizes.nref frc_wref
+                , w.test_cnt wtest, w.test_cnt / sizes.ntest frc_wtest
+                from windowed w
+                cross join sizes
+                join {3} pcounts on pcounts.ccd = w.ccd
+                union all
+                select 'TOTAL', 'TOTAL', 'Facts from {4} to {5}'
+                , nref, 1, ntest, 1
+                from sizes
+            )
+            , {6}
+            , ranked_data as (
+                select data.*
+                , row_number() over (order by odds_ratio desc) as rank
+                , row_number() over (order by odds_ratio asc) as revrank
+                from data
+                where ccd != 'TOTAL'
+                and {7}
+            )
+            select prefix, ccd, name, wref, frc_wref, wtest, frc_wtest, chisq, odds_ratio, dir
+            from data where ccd = 'TOTAL'
+            union all
+            select prefix, ccd, name, wref, frc_wref, wtest, frc_wtest, chisq, odds_ratio, dir
+            from (select * from ranked_data {8} order by rank)
+            '''.format(universe, self.dated, ' and '.join(conds) or '1=1',
+                       self.pcounts, self.since or 'the start', self.until or 'now',
+                       self.statsCte(cutoff, 'counts', 'wtest', 'wref'),
+                       filterStr, limstr)
+            cols, rows = do_log_sql(db, sql, params)
+            cols0, rows0 = do_log_sql(db, 'drop table {0}'.format(groups))
+
+        if self.to_file:
+            self.write_csv(cols, rows)
+        self.status = 'Done, chi success!'
+        return self.strat_status(cols, rows)
+
+
+    def runPreview(self):
+        '''Answer approximately from a uniform sample of patients, then
+        start the exact run.
+
+        The sample is drawn (reproducibly) from the patient sets, so it
+        costs a scan of chi_pconcepts for the sampled patients only;
+        without -r, the reference counts are the exact TOTAL ones.
+        '''
+        import random
+        test_psid = self.tpsid or self.psid
+        if self.tpsid and (self.rpsid == self.tpsid or not self.checkIntersection()):
+            if not self.status:
+                self.status = 'Job canceled, identical patient sets'
+            return self.strat_status([], [])
+        rate = float(self.preview) / 100
+        rng = random.Random(int(test_psid))
+        sample = lambda pset: (pn for pn in pset if rng.random() < rate)
+        groups = scratch_table('P', test_psid, self.rpsid or 'T')
+        host, port, service, user, pw, temp_table = self.getChiOpt()
+        chi_dbi = self.getOracleDBI(host, port, service, user, pw, groups)
+        with chi_dbi() as db:
+            log.info('Previewing PSID {0} vs. {1} from a {2}% sample'.format(
+                test_psid, self.rpsid or 'TOTAL', self.preview))
+            universe = self.fillGroups(db, groups, test_psid, sample)
+            filterStr, params = self.filterCond(db, 'pcounts.prefix')
+            if self.rpsid:
+                sql = '''
+                with universe as (
+                    {0}
+                )
+                , sizes as (
+                    select count(*) nref, sum(grp) ntest from universe
+                )
+                select pcounts.prefix, pcounts.ccd, pcounts.name
+                , c.ref_cnt, sizes.nref, c.test_cnt, sizes.ntest, 0 ref_exact
+                from (
+                    select pc.ccd, count(*) ref_cnt, sum(u.grp) test_cnt
+                    from {1} pc join universe u on u.pn = pc.pn
+                    group by pc.ccd
+                ) c
+                cross join sizes
+                join {2} pcounts on pcounts.ccd = c.ccd
+                where {3}
+                '''.format(universe, self.pconcepts, self.pcounts, filterStr)
+            else:
+                sql = '''
+                with sampled as (
+                    select g.pn from {0} g join {1} chipat on chipat.pn = g.pn
+                )
+                , sizes as (
+                    select (select count(*) from sampled) ntest
+                    , (select total from {3} where ccd = 'TOTAL') nref
+                    from dual
+                )
+                select pcounts.prefix, pcounts.ccd, pcounts.name
+                , pcounts.total, sizes.nref, coalesce(c.test_cnt, 0), sizes.ntest, 1 ref_exact
+                from {3} pcounts
+                cross join sizes
+                left join (
+                    select pc.ccd, count(*) test_cnt
+                    from {2} pc join sampled s on s.pn = pc.pn
+                    group by pc.ccd
+                ) c on c.ccd = pcounts.ccd
+                where pcounts.ccd != 'TOTAL' and {4}
+                '''.format(groups, self.chipats, self.pconcepts, self.pcounts, filterStr)
+            cols, rows = do_log_sql(db, sql, params)
+            cols0, rows0 = do_log_sql(db, 'drop table {0}'.format(groups))
+
+        cutoff = int(self.cutoff) * rate if self.cutoff else None
+        cols, out = preview_rows(rows, self.limit and int(self.limit), cutoff)
+        if self.to_file:
+            self.write_csv(cols, out)
+        self.status = 'Preview from a {0}% sample'.format(self.preview)
+        if self.spawn is not None and self.listargs:
+            self.spawn(exact_args(self.listargs))
+            self.status += '; exact results to follow'
+        if self.to_json:
+            self.status = json.dumps({'cols': cols, 'rows': out, 'status': self.status,
+                                      'preview': float(self.preview)})
+        return self.status
+
+
+    def runSimilar(self):
+        '''Find the concepts whose patients are most like the -p set,
+        by Jaccard similarity: LSH candidates, ranked by MinHash
+        estimate, then the top LIMIT checked exactly.
+        '''
+        if not self.minhash:
+            self.status = 'ERROR, similarity search needs chi_minhash in the config'
+            return self.strat_status([], [])
+        limit = int(self.limit or 20)
+        groups = scratch_table('L', self.psid)
+        host, port, service, user, pw, temp_table = self.getChiOpt()
+        chi_dbi = self.getOracleDBI(host, port, service, user, pw, groups)
+        with chi_dbi() as db:
+            self.rpsid = None
+            self.fillGroups(db, groups, self.psid)
+            cohort = '''
+            select g.pn from {0} g join {1} chipat on chipat.pn = g.pn
+            '''.format(groups, self.chipats)
+            sql = '''
+            select count(*) n, {0} from ({1})
+            '''.format(minhash.signature_sql(minhash.hash_params()), cohort)
+            cols, rows = do_log_sql(db, sql)
+            if not rows[0][0]:
+                do_log_sql(db, 'drop table {0}'.format(groups))
+                self.status = 'No patients with facts in PSID {0}'.format(self.psid)
+                return self.strat_status([], [])
+            npats, sig = rows[0][0], list(rows[0][1:])
+
+            keys = minhash.band_keys(sig)
+            conds = ' or '.join(['(band = :{0} and bucket = :{1})'.format(2 * ix, 2 * ix + 1)
+                                 for ix in range(len(keys))])
+            sql = '''
+            select * from {0}
+            where ccd in (select ccd from {0}_lsh where {1})
+            '''.format(self.minhash, conds)
+            cols, rows = do_log_sql(db, sql, [v for key in keys for v in key])
+            ranked = sorted([(minhash.estimate(sig, row[1:]), row[0]) for row in rows],
+                            reverse=True)[:limit]
+            log.info('{0} LSH candidates for PSID {1}'.format(len(rows), self.psid))
+
+            out = []
+            if ranked:
+                # the exact re-check scans the cohort's facts for these concepts only
+                ccds, params = in_list('pc.ccd', [ccd for est, ccd in ranked])
+                sql = '''
+                select pcounts.prefix, pcounts.ccd, pcounts.name, pcounts.total
+                , i.cnt intersection
+                from (
+                    select pc.ccd, count(*) cnt
+                    from {1} pc join ({2}) c on c.pn = pc.pn
+                    where {3}
+                    group by pc.ccd
+                ) i
+                join {0} pcounts on pcounts.ccd = i.ccd
+                '''.format(self.pcounts, self.pconcepts, cohort, ccds)
+                cols, rows = do_log_sql(db, sql, params)
+                estimates = dict((ccd, est) for est, ccd in ranked)
+                for prefix, ccd, name, total, inter in rows:
+                    jaccard = float(inter) / (npats + total - inter)
+                    out.append([prefix, ccd, name, total, inter, estimates[ccd], jaccard])
+                out.sort(key=lambda r: (-r[-1], r[1]))
+            do_log_sql(db, 'drop table {0}'.format(groups))
+
+        cols = ['PREFIX', 'CCD', 'NAME', 'TOTAL', 'INTERSECTION', 'EST_JACCARD', 'JACCARD']
+        if self.to_file:
+            self.write_csv(cols, out)
+        self.status = 'Done, chi success!'
+        return self.strat_status(cols, out)
+
+
+    def runPairs(self):
+        '''Count the -p set's co-occurring concept pairs with at least
+        `support` patients; store them, if there's a chi_pairs table.
+        '''
+        snap = None
+        if self.snapshot and os.path.exists(os.path.join(self.snapshot, snapshot.CURRENT)):
+            snap = snapshot.Snapshot.open(self.snapshot)
+            if snap.source != self.pconcepts:
+                # e.g. a rebuild switched generations; the new one is coming
+                log.info('Snapshot {0} is of {1}, not {2}; reading the database'.format(
+                    self.snapshot, snap.source, self.pconcepts))
+                snap.close()
+                snap = None
+        if snap is not None:
+            with snap:
+                log.info('Reading snapshot {0} version {1}'.format(self.snapshot, snap.version))
+                # workers map the snapshot and read their own patients
+                positions = snap.positions(self.psets.get(int(self.psid)))
+                found = cooccur.count_pairs(
+                    lambda: cooccur.chunks(positions, 2000), self.support,
+                    source=cooccur.SnapshotPositions(snap.path))
+            if self.pairs:
+                host, port, service, user, pw, temp_table = self.getChiOpt()
+                chi_dbi = self.getOracleDBI(host, port, service, user, pw)
+                with chi_dbi() as db:
+                    self.storePairs(db, found)
+            return self.pairsStatus(found)
+
+        groups = scratch_table('Y', self.psid)
+        host, port, service, user, pw, temp_table = self.getChiOpt()
+        chi_dbi = self.getOracleDBI(host, port, service, user, pw, groups)
+        with chi_dbi() as db:
+            self.rpsid = None
+            self.fillGroups(db, groups, self.psid)
+            sql = '''
+            select pc.pn, pc.ccd
+            from {0} pc
+            join {1} g on g.pn = pc.pn
+            join {2} chipat on chipat.pn = g.pn
+            order by pc.pn
+            '''.format(self.pconcepts, groups, self.chipats)
+            db.arraysize = 5000
+
+            def blocks():
+                # a pass per call; rows stream from the cursor, a block
+                # at a time, rather than all being fetched at once
+                log.debug('    execute: {0}'.format(sql))
+                db.execute(sql)
+                return cooccur.row_blocks(db)
+            found = cooccur.count_pairs(blocks, self.support)
+            do_log_sql(db, 'drop table {0}'.format(groups))
+            if self.pairs:
+                self.storePairs(db, found)
+        return self.pairsStatus(found)
+
+
+    def storePairs(self, db, found):
+        do_log_sql(db, 'delete from {0} where psid = {1}'.format(self.pairs, int(self.psid)))
+        sql = '''
+        insert into {0} (psid, ccd1, ccd2, n1, n2, n12, lift, odds_ratio)
+        values ({1}, :ccd1, :ccd2, :n1, :n2, :n12, :lift, :odds_ratio)
+        '''.format(self.pairs, int(self.psid))
+        insert_batches(db, sql, (list(pair) for pair in found))
+
+
+    def pairsStatus(self, found):
+        log.info('{0} pairs with support >= {1} for PSID {2}'.format(
+            len(found), self.support, self.psid))
+
+        cols = ['CCD1', 'CCD2', 'N1', 'N2', 'N12', 'LIFT', 'ODDS_RATIO']
+        out = sorted(found, key=lambda pair: -pair[5])[:int(self.limit or 100)]
+        if self.to_file:
+            self.write_csv(cols, out)
+        self.status = 'Done, chi success!'
+        return self.strat_status(cols, out)
+
+
+    def runSnapshot(self):
+        '''Write chi_pconcepts to a new version of the snapshot.
+        '''
+        if not self.snapshot:
+            raise ValueError('no chi_snapshot directory in config')
+        host, port, service, user, pw, temp_table = self.getChiOpt()
+        chi_dbi = self.getOracleDBI(host, port, service, user, pw)
+        with chi_dbi() as db:
+            sql = 'select pn, ccd from {0} order by pn'.format(self.pconcepts)
+            log.debug('    execute: {0}'.format(sql))
+            db.arraysize = 5000
+            db.execute(sql)
+            version = snapshot.build(db, self.snapshot, source=self.pconcepts)
+        self.status = 'Done, snapshot version {0}'.format(version)
+        return self.status
+
+
+    def write_csv(self, cols, rows):
+        '''Write output rows to outfile, quoting prefix, ccd and name.'''
+        with open(self.outfile, 'w') as file:
+            file.write('%s\n' % ','.join(['\"{0}\"'.format(c) for c in cols]))
+            for row in rows:
+                file.write('%s\n' % ','.join(
+                    ['\"{0}\"'.format(v) if ix < 3 else '{0}'.format(v)
+                     for ix, v in enumerate(row)]))
+
+
+    def strat_status(self, cols, rows):
+        if self.to_json:
+            self.status = json.dumps({'cols': cols, 'rows': rows, 'status': self.status})
+        return self.status
+
+
     def checkRerunQMID(self, db):
         '''Check if results already exists for QMID'''
         pconcepts = self.pconcepts
@@ -706,10 +2108,19 @@ class Chi2:
 
 
     def checkIntersection(self):
-        host, port, service, user, pw = self.getCrcOpt()
-        dbi = self.getOracleDBI(host, port, service, user, pw)
-        with dbi() as db:
-            try:
+        '''Check that the test patient set is a subset of the reference set.
+
+        If both sets are at hand in `psets` (or only to be had from
+        it, via the PDO service), they are compared here; otherwise
+        the database compares them, rather than send both over.
+        '''
+        tpsid, rpsid = int(self.tpsid), int(self.rpsid)
+        if (self.patient_source is not None or
+                (self.psets.cached(tpsid) and self.psets.cached(rpsid))):
+            test, ref = self.psets.get(tpsid), self.psets.get(rpsid)
+            outside = len(test - ref)
+        else:
+            def count(db):
                 sql = '''
                 select count(*) from (
                     select patient_num from {0}.qt_patient_set_collection
@@ -718,28 +2129,48 @@ class Chi2:
                     select patient_num from {0}.qt_patient_set_collection
                     where result_instance_id = {2} -- ref
                 )
-                '''.format(self.schema, self.tpsid, self.rpsid)
+                '''.format(self.schema, tpsid, rpsid)
                 cols, rows = do_log_sql(db, sql)
-                if rows[0][0] > 0:
-                    self.status = 'Job canceled, all patients in test subset must be in the reference set'
-                    return False
-            except:
-                raise
+                return rows[0][0]
+            # a standby that lags may lack some of the reference set
+            outside = self.readRouted('patients', count, crc=True,
+                                      found=lambda n: n == 0)
+        if outside > 0:
+            log.info('{0} test patients not in reference set'.format(outside))
+            self.status = 'Job canceled, all patients in test subset must be in the reference set'
+            return False
         return True
 
 
+    def readPatientSet(self, psid):
+        '''Read the patient_nums of a patient set from the QT tables.'''
+        def read(db):
+            sql = '''
+                select patient_num from {0}.qt_patient_set_collection
+                where result_instance_id = {1}
+            '''.format(self.schema, int(psid))
+            cols, rows = do_log_sql(db, sql)
+            return [r[0] for r in rows]
+        return self.readRouted('patients', read, crc=True, found=bool)
+
+
     def dbmgr(self, connect, temp_table=None):
         '''Make a context manager that yields cursors, given connect access.
         '''
         @contextmanager
         def dbtrx():
+            if self.cancelled and self.cancelled():
+                raise jobctl.JobCancelled()
             conn = connect()
             cur = conn.cursor()
+            dog = jobctl.Watchdog(self.cancelled)
             try:
-                yield cur
+                with dog.watch(conn):
+                    yield cur
             except Exception as e:
                 #error, = e.args
                 #log.debug('e.args={0}'.format(e.args))
+                jobctl.set_budget(conn, 0)  # let the clean-up finish
                 conn.rollback()
                 if temp_table:
                     try:
@@ -749,6 +2180,13 @@ class Chi2:
                         pass
                     finally:
                         log.debug('Raising error from rollback...')
+                while self.undo:
+                    try:
+                        cols, rows = do_log_sql(cur, self.undo.pop())
+                    except Exception as ex:
+                        log.warning('could not undo: {0}'.format(ex))
+                if dog.fired:
+                    raise jobctl.JobCancelled(str(e))
                 raise e
             else:
                 conn.commit()
@@ -757,25 +2195,270 @@ class Chi2:
         return dbtrx
 
 
-    def getFilterSql(self):
-        sql = 'select c_name from {0}'.format(self.chischemes)
-        if 'ALL' in self.filter:
-            sql += ' where 1=1'
-        elif len(self.filter) > 0:
-            sql += '\nwhere 1=0'
-        for p in range(0, len(self.filter)):
-            if self.filter[p] != 'ALL':
-                sql += '\nor c_key like :{0} || \'%\''.format(p)
-        return sql
+    def phase(self, db, name):
+        '''Limit the database calls of a phase of the job to its budget.'''
+        jobctl.set_budget(db.connection, self.budgets.get(name, 0))
+
+
+    def filterCond(self, db, column='prefix'):
+        '''Resolve -f patterns to the exact set of scheme prefixes.
+
+        :return: SQL condition on column and its bind parameters
+        '''
+        sql, params = scheme_sql(self.chischemes, self.filter)
+        cols, rows = do_log_sql(db, sql, params)
+        prefixes = sorted(r[0] for r in rows)
+        if len(self.filter) > 0:
+            log.info('Filters: {0}'.format(self.filter))
+            log.info('Applied filters prefixes: {0}'.format(prefixes))
+        return in_list(column, prefixes)
+
+
+    def statsCte(self, cutoff='', source=None, test=None, ref=None):
+        '''SQL for the cohort and data CTEs of chi2_output:
+        per-concept statistics of chi_name vs. ref.
+
+        :param source: table or CTE with the count columns (default: pcounts)
+        :param test: name of test count column (default: chi_name)
+        :param ref: name of reference count column (default: ref)
+        '''
+        return '''
+        cohort as (
+            select {0} pat_count from {1} where ccd = 'TOTAL'
+        )
+        , data as (
+            select prefix, ccd
+            , name
+            , {2}
+            , frc_{2} 
+            , {0}
+            , frc_{0}
+            -- , power({0} - (cohort.pat_count * frc_{2}), 2) / (cohort.pat_count * frc_{2}) chisq
+            -- oops, that's not really chisq df=1, but the below is...
+            , case 
+	      when frc_{2} = frc_{0} then 0
+	      when frc_{2} = 1 or frc_{0} = 1 then null
+	      else
+	      power({0} - (cohort.pat_count * frc_{2}), 2)*(1/(cohort.pat_count * frc_{2}) + 
+	      1/((cohort.pat_count-{0}) * frc_{2}) + 1/(cohort.pat_count * (1-frc_{2})) + 
+	      1/((cohort.pat_count-{0}) * (1-frc_{2}))) 
+	      end chisq
+	    , case 
+	      when frc_{0}=frc_{2} then 1 
+	      when frc_{0} in (0,1) or frc_{2} in (0,1) then 0
+	      else
+	      (1-frc_{2})*frc_{0}/((1-frc_{0})*frc_{2}) 
+	      end odds_ratio
+	    , case when frc_{2} = frc_{0} then 0 when frc_{2} < frc_{0} then 1 else -1 end dir
+            from {1}
+            , cohort
+            where frc_{2} > 0   -- reference patient set frequency
+            {3}
+            --where frc_{2} > 0 or frc_{0} > 0
+        )
+        '''.format(test or self.chi_name, source or self.pcounts, ref or self.ref, cutoff)
+
+
+    def storeResults(self, db):
+        '''Store the whole ranking of chi_name vs. ref, unless it's already stored.
+
+        Rankings are stored without filters or cutoff; pages apply those.
+        '''
+        sql = '''
+        select count(*) from {0} where test_name = '{1}' and ref_name = '{2}'
+        '''.format(self.results, self.chi_name, self.ref)
+        cols, rows = do_log_sql(db, sql)
+        if rows[0][0] > 0:
+            return
+        log.info('Storing ranked results for {0} vs. {1}'.format(self.chi_name, self.ref))
+        sql = '''
+        insert into {0} (test_name, ref_name, prefix, ccd, name
+            , ref_cnt, ref_frc, test_cnt, test_frc, chisq, odds_ratio, dir
+            , rank, revrank)
+        with {3}
+        select '{1}', '{2}', prefix, ccd, name
+            , {2}, frc_{2}, {1}, frc_{1}, chisq, odds_ratio, dir
+            , 0, 0
+        from data where ccd = 'TOTAL'
+        union all
+        select '{1}', '{2}', prefix, ccd, name
+            , {2}, frc_{2}, {1}, frc_{1}, chisq, odds_ratio, dir
+            , row_number() over (order by odds_ratio desc, ccd)
+            , row_number() over (order by odds_ratio asc, ccd desc)
+        from data where ccd != 'TOTAL'
+        '''.format(self.results, self.chi_name, self.ref, self.statsCte())
+        cols, rows = do_log_sql(db, sql)
+        self.wrote()
+
+
+    def runPage(self):
+        '''Read a page of stored results by keyset: the LIMIT rows after
+        rank (or revrank) `keyset`, subject to filters and cutoff.
+        '''
+        # Results stored just now may not be on a standby yet.
+        page = self.readRouted('ranking', self.readPage,
+                               found=lambda page: page is not None)
+        if page is None:
+            self.status = 'No stored results, run the comparison first'
+            return self.pageStatus([], [])
+        cols, rows, bounds = page
+        self.status = 'Done, chi success!'
+        return self.pageStatus(cols, rows, bounds)
+
+
+    def readPage(self, db):
+        '''Read a page of stored results, and, for the first, page bounds.
+
+        :return: (cols, rows, bounds), or None if there are no results
+        '''
+        self.phase(db, 'output')
+        test_name, ref_name = self.pageNames(db)
+        if test_name is None or ref_name is None:
+            return None
+
+        bounds = None
+        key, conds, params = self.pageConds(db, test_name, ref_name)
+        limit = int(self.limit or 100)
+        if int(self.keyset) == 0:
+            bounds = self.pageBounds(db, key, conds, params, limit)
+        sql = '''
+        select * from (
+            select prefix, ccd, name, ref_cnt, ref_frc, test_cnt, test_frc
+            , chisq, odds_ratio, dir, rank, revrank
+            from {0}
+            where {1} and {2} > {3}
+            order by {2}
+        ) where rownum <= {4}
+        '''.format(self.results, '\n            and '.join(conds), key,
+                   int(self.keyset), limit)
+        cols, rows = do_log_sql(db, sql, params)
+        if not rows:
+            sql = '''
+            select count(*) from {0}
+            where test_name = '{1}' and ref_name = '{2}'
+            '''.format(self.results, test_name, ref_name)
+            cols0, rows0 = do_log_sql(db, sql)
+            if rows0[0][0] == 0:
+                return None
+        return cols, rows, bounds
+
+
+    def pageNames(self, db):
+        '''chi names of the test and reference sets; None if not run.'''
+        if self.tpsid:
+            test, ref = self.tpsid, self.rpsid
+        else:
+            test, ref = self.psid, None
+        test_name = self.findChiName(db, test)
+        ref_name = self.findChiName(db, ref) if ref else 'TOTAL'
+        return test_name, ref_name
+
+
+    def pageConds(self, db, test_name, ref_name):
+        '''Rank key (by direction), and conditions (filters, cutoff) of
+        stored results, with their bind parameters.
+        '''
+        key = 'rank' if self.direction == 'over' else 'revrank'
+        conds = ["test_name = '{0}'".format(test_name),
+                 "ref_name = '{0}'".format(ref_name),
+                 '{0} > 0'.format(key)]  # not TOTAL
+        if self.cutoff:
+            conds.append('ref_cnt >= {0}'.format(int(self.cutoff)))
+        params = []
+        if len(self.filter) > 0 and 'ALL' not in self.filter:
+            filterStr, params = self.filterCond(db)
+            conds.append(filterStr)
+        return key, conds, params
+
+
+    def pageBounds(self, db, key, conds, params, limit):
+        '''The number of rows, and the rank key after which each page
+        starts (ranks have gaps, given filters or a cutoff).
+
+        :rtype: (Int, Seq[Int])
+        '''
+        sql = '''
+        select rn, {1}, total from (
+            select {1}
+            , row_number() over (order by {1}) rn
+            , count(*) over () total
+            from {0}
+            where {2}
+        ) where mod(rn, {3}) = 0 or rn = total
+        order by rn
+        '''.format(self.results, key, '\n            and '.join(conds), limit)
+        cols, rows = do_log_sql(db, sql, params)
+        return page_bounds(rows, limit)
+
+
+    def exportCsv(self, batch_size=1000):
+        '''Generate stored results, filtered, as CSV, a batch of rows at a
+        time, so neither we nor the client need hold them all.
+        '''
+        import csv
+        from StringIO import StringIO
+
+        def names(connect):
+            with self.dbmgr(connect)() as db:
+                return connect, self.pageNames(db)
+        # stream from wherever the results were found
+        connect, (test_name, ref_name) = self.routers['chi'].read(
+            'ranking', names, found=lambda out: None not in out[1])
+        if test_name is None or ref_name is None:
+            raise LookupError('No stored results, run the comparison first')
+        with self.dbmgr(connect)() as db:
+            self.phase(db, 'output')
+            key, conds, params = self.pageConds(db, test_name, ref_name)
+            sql = '''
+            select prefix, ccd, name, ref_cnt, ref_frc, test_cnt, test_frc
+            , chisq, odds_ratio, dir
+            from {0}
+            where {1}
+            order by {2}
+            '''.format(self.results, '\n            and '.join(conds), key)
+            log.debug('    execute: {0}'.format(sql))
+            db.arraysize = batch_size
+            db.execute(sql, params)
+            cols = [d[0] for d in db.description]
+            while True:
+                buf = StringIO()
+                out = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC)
+                if cols:
+                    out.writerow(cols)
+                    cols = None
+                rows = db.fetchmany()
+                out.writerows([['' if v is None else v for v in row]
+                               for row in rows])
+                if buf.getvalue():
+                    yield buf.getvalue()
+                if not rows:
+                    break
+
+
+    def pageStatus(self, cols, rows, bounds=None):
+        if not self.to_json:
+            return self.status
+        key = 'RANK' if self.direction == 'over' else 'REVRANK'
+        last = rows[-1][cols.index(key)] if rows else None
+        out = {'cols': cols, 'rows': rows, 'next': last, 'status': self.status}
+        if bounds:
+            out['total'], out['bounds'] = bounds
+        self.status = json.dumps(out)
+        return self.status
+
 
+    def chi2_output(self, db, store=None):
+        '''Rank the test set's concepts against the reference set's.
 
-    def chi2_output(self, db):
+        :param store: cursor to store results with, if not `db`
+        '''
         if (self.chi_name is None or self.chi_name == '') and self.extant:
             # This should only happen for QMID 
             self.status = 'No data for QMID {0}, try running without -e/--exists'.format(self.psid)
             if self.to_json:
                 self.status = json.dumps({'cols': [], 'rows': [], 'status': status})
             return self.status
+        self.phase(db, 'output')
         # Skip filtering/output if not required
         if not self.to_file and not self.to_json: 
             if len(self.filter) > 0:
@@ -787,12 +2470,7 @@ class Chi2:
         if self.limit:
             limstr = 'where rank <= {0} or revrank <= {0}'.format(self.limit)
         # Filter results by concept code prefix (data domain)
-        filterStr = self.getFilterSql()
-        if len(self.filter) > 0:
-            log.info('Filters: {0}'.format(self.filter))
-            if 'ALL' in self.filter: self.filter.remove('ALL')
-            cols, rows = do_log_sql(db, filterStr, self.filter)
-            log.info('Applied filters prefixes: {0}'.format([r[0] for r in rows]))
+        filterStr, params = self.filterCond(db)
         # Filter results by reference fact cutoff
         cutoff = ''
         if self.cutoff:
@@ -810,42 +2488,7 @@ class Chi2:
             prefixes = [(r[0], r[1]) for r in rows]
         # Get results data 
         sql = '''
-        with patterns as (
-            {4}
-        )
-        , cohort as (
-            select {0} pat_count from {1} where ccd = 'TOTAL'
-        )
-        , data as (
-            select prefix, ccd
-            , name
-            , {3}
-            , frc_{3} 
-            , {0}
-            , frc_{0}
-            -- , power({0} - (cohort.pat_count * frc_{3}), 2) / (cohort.pat_count * frc_{3}) chisq
-            -- oops, that's not really chisq df=1, but the below is...
-            , case 
-	      when frc_{3} = frc_{0} then 0
-	      when frc_{3} = 1 or frc_{0} = 1 then null
-	      else
-	      power({0} - (cohort.pat_count * frc_{3}), 2)*(1/(cohort.pat_count * frc_{3}) + 
-	      1/((cohort.pat_count-{0}) * frc_{3}) + 1/(cohort.pat_count * (1-frc_{3})) + 
-	      1/((cohort.pat_count-{0}) * (1-frc_{3}))) 
-	      end chisq
-	    , case 
-	      when frc_{0}=frc_{3} then 1 
-	      when frc_{0} in (0,1) or frc_{3} in (0,1) then 0
-	      else
-	      (1-frc_{3})*frc_{0}/((1-frc_{0})*frc_{3}) 
-	      end odds_ratio
-	    , case when frc_{3} = frc_{0} then 0 when frc_{3} < frc_{0} then 1 else -1 end dir
-            from {1}
-            , cohort
-            where frc_{3} > 0   -- reference patient set frequency
-            {5}
-            --where frc_{3} > 0 or frc_{0} > 0
-        )
+        with {6}
         , ranked_data as (
             select data.*
             --, row_number() over (order by chisq*dir desc) as rank
@@ -853,8 +2496,8 @@ class Chi2:
             , row_number() over (order by odds_ratio desc) as rank
             , row_number() over (order by odds_ratio asc) as revrank  -- this is not a useless line
             from data   
-            join patterns on data.prefix = patterns.c_name 
             where ccd != 'TOTAL'
+            and {4}
             order by rank
         ) 
         select prefix, ccd, name, {3}, frc_{3}, {0}, frc_{0}, chisq, odds_ratio, dir
@@ -862,8 +2505,11 @@ class Chi2:
         union all
         select prefix, ccd, name, {3}, frc_{3}, {0}, frc_{0}, chisq, odds_ratio, dir
         from ranked_data {2}
-        '''.format(self.chi_name, self.pcounts, limstr, self.ref, filterStr, cutoff)
-        cols, rows = do_log_sql(db, sql, self.filter)
+        '''.format(self.chi_name, self.pcounts, limstr, self.ref, filterStr, cutoff,
+                   self.statsCte(cutoff))
+        cols, rows = do_log_sql(db, sql, params, tag='chi2_output', plans=self.plans)
+        if self.results:
+            self.storeResults(store or db)
 
         # Write results to file
         if self.to_file:
@@ -891,10 +2537,458 @@ class Chi2:
         return self.status
 
 
-def do_log_sql(cur, sql, params=[]): 
+def matrix_pairs(n, versus_first=False):
+    '''Which (test, reference) set indexes to compare.
+
+    >>> matrix_pairs(3)
+    [(0, 1), (0, 2), (1, 2)]
+    >>> matrix_pairs(3, versus_first=True)
+    [(1, 0), (2, 0)]
+    '''
+    if versus_first:
+        return [(i, 0) for i in range(1, n)]
+    return [(i, j) for i in range(n) for j in range(i + 1, n)]
+
+
+def pair_stats(cnt, frc, ref_frc, pat_count):
+    '''Chi-squared, odds ratio and direction for one concept, one pair of sets,
+    just as chi2_output computes them in SQL.
+
+    :param cnt: test set patients with the concept
+    :param frc: test set fraction with the concept
+    :param ref_frc: reference set fraction with the concept
+    :param pat_count: test set size
+    :return: (chisq, odds_ratio, dir), or None where the reference
+             fraction is 0 (which chi2_output leaves out)
+
+    >>> pair_stats(20, 0.2, 0.1, 100)
+    (25.0, 2.25, 1)
+    >>> pair_stats(10, 0.1, 0.1, 100)
+    (0, 1, 0)
+    >>> pair_stats(0, 0, 0.5, 100)
+    (200.0, 0, -1)
+    >>> pair_stats(5, 0.05, 0, 100) is None
+    True
+    '''
+    if not ref_frc:
+        return None
+    if ref_frc == frc:
+        chisq = 0
+    elif ref_frc == 1 or frc == 1:
+        chisq = None
+    else:
+        chisq = ((cnt - pat_count * ref_frc) ** 2 *
+                 (1.0 / (pat_count * ref_frc) +
+                  1.0 / ((pat_count - cnt) * ref_frc) +
+                  1.0 / (pat_count * (1 - ref_frc)) +
+                  1.0 / ((pat_count - cnt) * (1 - ref_frc))))
+    if frc == ref_frc:
+        odds_ratio = 1
+    elif frc in (0, 1) or ref_frc in (0, 1):
+        odds_ratio = 0
+    else:
+        odds_ratio = (1 - ref_frc) * frc / ((1 - frc) * ref_frc)
+    direction = 0 if ref_frc == frc else 1 if ref_frc < frc else -1
+    return chisq, odds_ratio, direction
+
+
+def cmh_stats(strata):
+    '''Cochran-Mantel-Haenszel statistic (with continuity correction),
+    Mantel-Haenszel common odds ratio and direction for one concept,
+    just as runStrat computes them in SQL.
+
+    :param strata: per stratum, (a, m1, n1, n0): test patients with
+                   the concept, all patients with the concept, test
+                   patients and control patients
+    :return: (cmh_chisq, mh_odds_ratio, dir)
+
+    Within each stratum below, the concept is as common in test as in
+    control, though test patients are mostly in the stratum where it's
+    rare:
+
+    >>> cmh_stats([(8, 10, 80, 20), (10, 50, 20, 80)])
+    (0.0, 1.0, 0)
+
+    >>> chisq, odds_ratio, dir = cmh_stats([(20, 30, 100, 100)])
+    >>> round(chisq, 4), odds_ratio, dir
+    (3.1606, 2.25, 1)
+    '''
+    dev = var = r = s = 0.0
+    for a, m1, n1, n0 in strata:
+        t = float(n1 + n0)
+        if not n1 or not n0:
+            continue
+        dev += a - n1 * m1 / t
+        var += n1 * n0 * m1 * (t - m1) / (t * t * (t - 1))
+        r += a * (n0 - m1 + a) / t
+        s += (n1 - a) * (m1 - a) / t
+    chisq = max(abs(dev) - 0.5, 0) ** 2 / var if var > 0 else None
+    odds_ratio = r / s if s > 0 else None if r > 0 else 1
+    direction = 0 if dev == 0 else 1 if dev > 0 else -1
+    return chisq, odds_ratio, direction
+
+
+def preview_rows(rows, limit=None, cutoff=None, z=1.96):
+    '''Rank concepts by approximate odds ratio, with Wald confidence
+    bounds (on the log scale, with Haldane's +0.5 for empty cells).
+
+    :param rows: (prefix, ccd, name, ref_cnt, ref_n, test_cnt, test_n,
+                 ref_exact) where counts of patients with the concept
+                 and set sizes are from the sample, except reference
+                 counts flagged exact, which add no variance
+    :param limit: keep the top and bottom limit rows
+    :param cutoff: minimum reference count, in the sample
+    :return: (cols, rows), rows ordered by odds ratio; UNCERTAIN is 1
+             where the bounds include 1, or reach past the page's
+             cut-off, i.e. overlap the bounds of a row that isn't shown
+
+    >>> cols, out = preview_rows([
+    ...     ('ICD9', 'ICD9:250', 'diabetes', 100, 1000, 30, 100, 1),
+    ...     ('ICD9', 'ICD9:401', 'hypertension', 300, 1000, 33, 100, 1),
+    ...     ('ICD9', 'ICD9:V70', 'checkup', 500, 1000, 20, 100, 1)])
+    >>> [(r[1], round(r[7], 2), r[-1]) for r in out]
+    [('ICD9:250', 3.88, 0), ('ICD9:401', 1.16, 1), ('ICD9:V70', 0.25, 0)]
+    >>> lo, hi = out[0][8:10]
+    >>> round(lo, 2), round(hi, 2)
+    (2.53, 5.93)
+
+    With a page of 1, over- and under-represented, the middle row is
+    dropped, and the top row's bounds don't reach the dropped row's:
+
+    >>> cols, out = preview_rows([r[:3] + (r[3] * 4, 4000, r[5], 100, 0)
+    ...                           for r in [('ICD9', 'ICD9:250', '', 100, 0, 30),
+    ...                                     ('ICD9', 'ICD9:401', '', 300, 0, 33),
+    ...                                     ('ICD9', 'ICD9:V70', '', 500, 0, 20)]],
+    ...                          limit=1)
+    >>> [(r[1], r[-1]) for r in out]
+    [('ICD9:250', 0), ('ICD9:V70', 0)]
+    '''
+    import math
+    cols = ['PREFIX', 'CCD', 'NAME', 'REF_CNT', 'FRC_REF', 'TEST_CNT', 'FRC_TEST',
+            'ODDS_RATIO', 'OR_LO', 'OR_HI', 'DIR', 'UNCERTAIN']
+    stats = []
+    for prefix, ccd, name, c, n0, a, n1, exact in rows:
+        if not n0 or not n1 or (cutoff and c < cutoff):
+            continue
+        a1, b1, c1, d1 = a + .5, n1 - a + .5, c + .5, n0 - c + .5
+        log_or = math.log(a1 / b1) - math.log(c1 / d1)
+        var = 1 / a1 + 1 / b1 + (0 if exact else 1 / c1 + 1 / d1)
+        se = math.sqrt(var)
+        frc, ref_frc = float(a) / n1, float(c) / n0
+        stats.append([prefix, ccd, name, c, ref_frc, a, frc, math.exp(log_or),
+                      math.exp(log_or - z * se), math.exp(log_or + z * se),
+                      0 if frc == ref_frc else 1 if frc > ref_frc else -1])
+    stats.sort(key=lambda r: (-r[7], r[1]))
+    if limit and len(stats) > 2 * limit:
+        hidden = stats[limit:-limit]
+        top_hi = max(r[9] for r in hidden)
+        bottom_lo = min(r[8] for r in hidden)
+        shown = [(r, r[8] <= top_hi) for r in stats[:limit]] + \
+                [(r, r[9] >= bottom_lo) for r in stats[-limit:]]
+    else:
+        shown = [(r, False) for r in stats]
+    return cols, [r + [1 if past or r[8] <= 1 <= r[9] else 0]
+                  for r, past in shown]
+
+
+def valid_percent(txt):
+    '''Is txt a percentage of patients to sample: in (0, 100]?
+
+    >>> [valid_percent(t) for t in ['5', '0.5', '100', '0', '150', 'x']]
+    [True, True, True, False, False, False]
+    '''
+    return (re.match(r'^\d+(\.\d*)?$|^\.\d+$', txt) is not None and
+            0 < float(txt) <= 100)
+
+
+@contextmanager
+def admitted(args,
+             max_wait=3600.0):
+    '''Hold a job slot while running, if given --admission-dir, as the
+    exact run that follows a preview is; it waits up to `max_wait`
+    seconds, as no client is waiting on it.
+    '''
+    if not args.get('--admission-dir'):
+        yield
+        return
+    import fcntl
+    import lafile
+    from admission import Admission
+    gate = Admission(lafile.Editable(args['--admission-dir'], os, open),
+                     fcntl.flock, time.time, time.sleep,
+                     per_user=int(args['--per-user']),
+                     slots=int(args['--slots']), max_wait=max_wait)
+    with gate.admit(args['--admit-as'], priority=1, wait_user=True):
+        yield
+
+
+def exact_args(listargs):
+    '''Arguments for the exact run that follows a preview.
+
+    >>> exact_args(['-j', '--preview=5', '-p', '123'])
+    ['-j', '-p', '123']
+    >>> exact_args(['-j', '--preview', '5', '-p', '123'])
+    ['-j', '-p', '123']
+    '''
+    out, skip = [], False
+    for arg in listargs:
+        if skip:
+            skip = False
+        elif arg == '--preview':
+            skip = True
+        elif not str(arg).startswith('--preview='):
+            out.append(arg)
+    return out
+
+
+def command_line(listargs):
+    '''Command line for arguments as given to `Chi2`, where the values
+    of a repeated option come as a list.
+
+    >>> command_line(['-j', '-x', 5, '-f', ['a', 'b'], '-p', 123])
+    ['-j', '-x', '5', '-f', 'a', '-f', 'b', '-p', '123']
+    '''
+    out = []
+    for arg in listargs:
+        if isinstance(arg, list):
+            flag = out.pop()
+            for value in arg:
+                out.extend([flag, str(value)])
+        else:
+            out.append(str(arg))
+    return out
+
+
+def spawn_detached(popen, listargs):
+    '''Run chinotype in a process of its own, which outlives this one
+    (e.g. a CGI request) and doesn't hold on to its output.
+
+    :param popen: access to start processes, a la `subprocess.Popen`
+    :param listargs: arguments, as given to `Chi2`
+    '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'chinotype.py')
+    cmd = [executable, script] + command_line(listargs)
+    log.info('spawning: %s', cmd)
+    with open(os.devnull, 'r+') as devnull:
+        popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+              close_fds=True, preexec_fn=os.setsid)
+
+
+def _bench(dbi,
+           concepts=100000, sparsities=(0.01, 0.05, 0.2, 1.0)):
+    '''Compare the write volume of filling a cohort's columns with the
+    old UPDATE, of every row of chi_pcounts, and with the MERGE of only
+    the concepts the cohort has, at several sparsities (the fraction of
+    concepts the cohort has), on scratch tables in the chi schema.
+
+    Redo needs select on v_$mystat and v_$statname.
+
+    :param dbi: access to the chi database, as from `Chi2.getOracleDBI`
+    '''
+    counts, cohort = 'chi_bench_counts', 'chi_bench_cohort'
+    with dbi() as db:
+        do_log_sql(db, '''
+        create table {0} (ccd, n, c, frc_c) as
+        select 'C' || level, level, 0, 0 from dual connect by level <= {1}
+        '''.format(counts, int(concepts)))
+        do_log_sql(db, 'alter table {0} add primary key (ccd)'.format(counts))
+        fills = [
+            ('update', '''
+            update (
+                select pc.c emptycnt, coalesce(cnt, 0) newcnt
+                , pc.frc_c emptyfrc, coalesce(cnt / {2}, 0) newfrc
+                from {0} pc left join {1} nc on pc.ccd = nc.ccd
+            ) up
+            set up.emptycnt = up.newcnt, up.emptyfrc = up.newfrc
+            '''),
+            ('merge', '''
+            merge into {0} pc using {1} nc on (pc.ccd = nc.ccd)
+            when matched then update set pc.c = nc.cnt, pc.frc_c = nc.cnt / {2}
+            ''')]
+        print '%8s %-7s %9s %12s %8s' % ('sparsity', 'fill', 'rows', 'redo bytes', 'seconds')
+        try:
+            for sparsity in sparsities:
+                step = max(1, int(round(1 / sparsity)))
+                do_log_sql(db, '''
+                create table {0} as
+                select ccd, 1 + mod(n, 7) cnt from {1} where mod(n, {2}) = 0
+                '''.format(cohort, counts, step))
+                try:
+                    for label, sql in fills:
+                        redo0, t0 = redo_size(db), time.time()
+                        do_log_sql(db, sql.format(counts, cohort, 1000))
+                        written = db.rowcount
+                        redo1, t1 = redo_size(db), time.time()
+                        do_log_sql(db, 'rollback')
+                        print '%8.2f %-7s %9d %12s %8.2f' % (
+                            1.0 / step, label, written,
+                            '-' if redo0 is None else redo1 - redo0, t1 - t0)
+                finally:
+                    do_log_sql(db, 'drop table {0}'.format(cohort))
+        finally:
+            do_log_sql(db, 'drop table {0}'.format(counts))
+
+
+def redo_size(db):
+    '''Redo generated by this session so far, in bytes, or None if
+    v$mystat isn't readable (it needs select on v_$mystat, v_$statname).
+    '''
+    try:
+        cols, rows = do_log_sql(db, '''
+        select ms.value from v$mystat ms
+        join v$statname sn on sn.statistic# = ms.statistic#
+        where sn.name = 'redo size'
+        ''')
+        return rows[0][0]
+    except Exception as ex:
+        log.debug('redo size not available: {0}'.format(ex))
+        return None
+
+
+def page_bounds(rows, limit):
+    '''Number of rows and where pages start, given (row number, key,
+    total) of each row ending a page, and of the last row.
+
+    >>> page_bounds([(2, 3, 5), (4, 9, 5), (5, 12, 5)], 2)
+    (5, [0, 3, 9])
+    >>> page_bounds([(2, 3, 4), (4, 9, 4)], 2)
+    (4, [0, 3])
+    >>> page_bounds([], 2)
+    (0, [0])
+    '''
+    if not rows:
+        return 0, [0]
+    total = rows[0][2]
+    return total, [0] + [k for rn, k, _ in rows if rn % limit == 0 and rn < total]
+
+
+def insert_batches(db, sql, rows, batch_size=5000):
+    '''Insert rows a batch at a time, as they arrive.'''
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            cols, out = do_log_sql(db, sql, batch)
+            batch = []
+    if len(batch) > 1:
+        cols, out = do_log_sql(db, sql, batch)
+    elif batch:
+        cols, out = do_log_sql(db, sql, batch[0])
+
+
+def matrix_rows(names, pairs, rows, cutoff=None):
+    '''Compute pairwise statistics for each concept, in one pass over the rows.
+
+    :param names: chi column names of the sets
+    :param pairs: (test, reference) indexes, as from `matrix_pairs`
+    :param rows: (prefix, ccd, name, counts..., fractions...) rows,
+                 including the TOTAL row
+    :param cutoff: min reference set count for a pair's statistics
+    :return: column names and output rows, TOTAL first; a pair's
+             statistics are null where it's not comparable
+
+    >>> cols, out = matrix_rows(['A', 'B'], [(0, 1)], [
+    ...     ('ICD9', 'ICD9:250', 'Diabetes', 20, 10, 0.2, 0.1),
+    ...     ('TOTAL', 'TOTAL', 'All', 100, 100, 1, 1)])
+    >>> cols
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['PREFIX', 'CCD', 'NAME', 'A', 'B', 'FRC_A', 'FRC_B',
+     'CHISQ_A_B', 'ODDS_RATIO_A_B']
+    >>> out[1]
+    ('ICD9', 'ICD9:250', 'Diabetes', 20, 10, 0.2, 0.1, 25.0, 2.25)
+    '''
+    n = len(names)
+    cols = (['PREFIX', 'CCD', 'NAME'] + list(names) +
+            ['FRC_' + name for name in names] +
+            [stat + '_%s_%s' % (names[i], names[j])
+             for (i, j) in pairs
+             for stat in ['CHISQ', 'ODDS_RATIO']])
+    totals = [r for r in rows if r[1] == 'TOTAL']
+    pat_counts = totals[0][3:3 + n] if totals else [None] * n
+    cutoff = int(cutoff) if cutoff else None
+
+    def stats(row):
+        counts, frcs = row[3:3 + n], row[3 + n:3 + 2 * n]
+        for (i, j) in pairs:
+            st = (None if cutoff and (counts[j] or 0) < cutoff
+                  else pair_stats(counts[i], frcs[i], frcs[j], pat_counts[i]))
+            for v in (st[:2] if st else (None, None)):
+                yield v
+
+    out = [tuple(r) + tuple(stats(r)) for r in totals]
+    out.extend([tuple(r) + tuple(stats(r))
+                for r in rows if r[1] != 'TOTAL'])
+    return cols, out
+
+
+def owner_conds(qualified, name_col='table_name'):
+    '''SQL conditions on the owner and name of a [schema.]table
+    for data dictionary views such as all_tab_columns.
+
+    >>> owner_conds('chi.chi_schemes', 'object_name')
+    ("and owner = 'CHI'", "and object_name = 'CHI_SCHEMES'")
+    >>> owner_conds('chi_schemes')
+    ('', "and table_name = 'CHI_SCHEMES'")
+    '''
+    table_info = qualified.split('.')
+    owner, table_name = '', ''
+    if len(table_info) > 1:
+        owner = 'and owner = \'{0}\''.format(table_info[0].upper())
+        table_name = 'and {0} = \'{1}\''.format(name_col, table_info[1].upper())
+    elif len(table_info) > 0:
+        table_name = 'and {0} = \'{1}\''.format(name_col, table_info[0].upper())
+    return owner, table_name
+
+
+def strata_as_of(expr, as_of):
+    '''Stratum SQL with ages as of a given day rather than today,
+    and a stratum for patients the expression gives none.
+
+    >>> print strata_as_of(STRATA_DEFAULT, '2020-01-31')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    coalesce(to_char(sex_cd || ':' ||
+      least(floor(months_between(date '2020-01-31', birth_date) / 120), 9)
+      * 10), '-')
+    '''
+    expr = re.sub(r'(?i)\bsysdate\b', "date '{0}'".format(as_of), expr)
+    return "coalesce(to_char({0}), '-')".format(expr)
+
+
+def scratch_table(kind, *psids):
+    '''Name a scratch table of a job: by kind, patient sets and
+    process, so that jobs on the same sets at once don't clash.
+
+    >>> scratch_table('S', 123, 'T') == 'S123_T_{0}'.format(os.getpid())
+    True
+    '''
+    return '{0}{1}_{2}'.format(kind, '_'.join([str(p) for p in psids]),
+                               os.getpid())
+
+
+def missing_table(ex):
+    '''Is a database error ORA-00942: table or view does not exist?
+
+    >>> class Error(object):
+    ...     code = 942
+    >>> missing_table(Exception(Error())), missing_table(Exception('?'))
+    (True, False)
+    '''
+    error = ex.args[0] if ex.args else None
+    return getattr(error, 'code', None) == 942
+
+
+def do_log_sql(cur, sql, params=[], tag=None, plans=None):
     '''Execute sql on given connection and log it
+
+    :param String tag: name of the statement, for plan capture
+    :param plans: where to record the plans of tagged statements, if anywhere
+    :type plans: planwatch.PlanWatch
     '''
     cols, rows = None, None
+    if tag and plans:
+        plans.prepare(cur)
+    t0 = time.time()
     if len(params) > 1 and sql.strip().lower().startswith('insert'):
         log.debug('executemany: {0}'.format(sql))
         cursor = cur.executemany(sql, params)
@@ -911,15 +3005,51 @@ def do_log_sql(cur, sql, params=[]):
             log.debug('   rowcount: {0}'.format(cursor.rowcount))
     else:
         log.debug('   rowcount: None')
+    if tag and plans:
+        plans.capture(cur, tag, time.time() - t0)
     return cols, rows
 
 
-if __name__=='__main__':
-    args = docopt(__doc__, argv=argv[1:])
-    if args['-p']:
+def main(args):
+    if args['--rebuild']:
+        log.info(Chi2(args=args).runRebuild())
+    elif args['--bench-fill']:
+        chi = Chi2(args=args)
+        host, port, service, user, pw, temp_table = chi.getChiOpt()
+        _bench(chi.getOracleDBI(host, port, service, user, pw))
+    elif args['--snapshot']:
+        log.info(Chi2(args=args).runSnapshot())
+    elif args['-k']:
+        log.info(Chi2(args=args).runPage())
+    elif args['--stratify'] and (args['-p'] or args['-t']):
+        log.info(Chi2(args=args).runStrat())
+    elif args['--pairs'] and args['-p']:
+        log.info(Chi2(args=args).runPairs())
+    elif args['--similar'] and args['-p']:
+        log.info(Chi2(args=args).runSimilar())
+    elif args['--preview'] and (args['-p'] or args['-t']):
+        from subprocess import Popen
+        log.info(Chi2(listargs=argv[1:], args=args,
+                      spawn=pf_(spawn_detached, Popen)).runPreview())
+    elif (args['--since'] or args['--until']) and (args['-p'] or args['-t']):
+        log.info(Chi2(args=args).runWindow())
+    elif args['-p']:
         log.info(Chi2(args=args).runPSID())
     elif args['-m']:
         log.info(Chi2(args=args).runQMID())
     elif args['-t'] and args['-r']:
         log.info(Chi2(args=args).runPSID_p2())
+    elif args['-s']:
+        log.info(Chi2(args=args).runMatrix())
 
+
+if __name__=='__main__':
+    from docopt import docopt
+    args = docopt(__doc__, argv=argv[1:])
+    try:
+        with admitted(args):
+            main(args)
+    finally:
+        # a cancelled job's marker has done its work
+        if args['--cancel-file'] and os.path.exists(args['--cancel-file']):
+            os.remove(args['--cancel-file'])
@@ -0,0 +1,109 @@
+'''coldstart -- import-time profile and start-up budget for entry points
+.......................................................................
+
+Each CGI request starts a fresh python, so whatever the entry points
+import is paid before the request is even parsed. Heavy dependencies
+(the Oracle driver, mechanize, pkg_resources, ...) should be imported
+only by the code paths that use them.
+
+The entry points stay within budget and load none of the heavy modules:
+
+  >>> for entry in ENTRY_POINTS:
+  ...     cost = import_cost(entry)
+  ...     if cost.heavy or cost.seconds > STARTUP_BUDGET:
+  ...         print entry, cost.heavy, cost.seconds
+  ...         print cost.report()
+
+For a report a la python 3's `-X importtime`, run this module::
+
+  $ python coldstart.py param_check
+  import time: cumulative ms | imported module
+  ...
+
+'''
+
+import json
+import subprocess
+import sys
+
+ENTRY_POINTS = ['param_check', 'chinotype', 'i2b2hive']
+
+# Modules an entry point must not import just by being imported.
+HEAVY = ['cx_Oracle', 'docopt', 'mechanize', 'pkg_resources',
+         'paste', 'webtest', 'argh']
+
+# seconds to import an entry point, not counting python's own start-up
+STARTUP_BUDGET = 0.1
+
+_PROBE = r'''
+import sys, time, json, __builtin__
+_import = __builtin__.__import__
+depth = [0]
+rows = []
+
+def timed(name, *args, **kwargs):
+    if not name or name in sys.modules:
+        return _import(name, *args, **kwargs)
+    depth[0] += 1
+    t0 = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        depth[0] -= 1
+        rows.append((depth[0], name, time.time() - t0))
+
+__builtin__.__import__ = timed
+t0 = time.time()
+__import__(sys.argv[1])
+seconds = time.time() - t0
+__builtin__.__import__ = _import
+heavy = [m for m in json.loads(sys.argv[2]) if m in sys.modules]
+print json.dumps(dict(seconds=seconds, heavy=heavy, rows=rows))
+'''
+
+
+class ImportCost(object):
+    '''What it took to import a module in a fresh interpreter.
+    '''
+    def __init__(self, module, seconds, heavy, rows):
+        self.module = module
+        self.seconds = seconds
+        self.heavy = heavy
+        self._rows = rows
+
+    def report(self):
+        '''Format per-module cumulative import times, nested by depth.
+
+        Rows come out in completion order, as with `-X importtime`.
+        '''
+        lines = ['import time: cumulative ms | imported module']
+        for depth, name, secs in self._rows:
+            lines.append('import time: %13.1f | %s%s' % (
+                secs * 1000, '  ' * depth, name))
+        return '\n'.join(lines)
+
+
+def import_cost(module,
+                python=sys.executable, cwd=None):
+    '''Import `module` in a fresh interpreter and measure it.
+
+    :param String module: e.g. `param_check`
+    :param String python: interpreter to use
+    :rtype: ImportCost
+    '''
+    out = subprocess.check_output(
+        [python, '-c', _PROBE, module, json.dumps(HEAVY)], cwd=cwd)
+    info = json.loads(out.strip().splitlines()[-1])
+    return ImportCost(module, info['seconds'], info['heavy'], info['rows'])
+
+
+if __name__ == '__main__':
+    def _main(argv):
+        for module in argv[1:] or ENTRY_POINTS:
+            cost = import_cost(module)
+            print cost.report()
+            print '%s: %.1f ms (budget %.1f ms); heavy modules: %s' % (
+                module, cost.seconds * 1000, STARTUP_BUDGET * 1000,
+                cost.heavy or 'none')
+
+    _main(sys.argv)
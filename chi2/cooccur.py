@@ -0,0 +1,312 @@
+'''cooccur -- concept co-occurrence (comorbidity) counts for a cohort
+..................................................................
+
+A cohort's rows of chi_pconcepts make a sparse patient x concept
+matrix X; X'X counts, for each pair of concepts, the patients who have
+both. We compute it for the pairs with at least `support` patients.
+
+The cohort comes a block of patients at a time, e.g. from rows ordered
+by patient_num, as they stream from a cursor:
+
+  >>> rows = [(1, 'DM'), (1, 'HTN'), (1, 'CKD'),
+  ...         (2, 'DM'), (2, 'HTN'),
+  ...         (3, 'DM'), (3, 'HTN'), (3, 'CKD'),
+  ...         (4, 'HTN'), (4, 'ASTHMA'),
+  ...         (5, 'ASTHMA')]
+  >>> blocks = lambda: row_blocks(iter(rows), block_size=2)
+  >>> pairs = count_pairs(blocks, support=2, workers=1)
+  >>> for p in pairs:
+  ...     print '%s %s %d %d %d %.2f' % p[:6]
+  CKD DM 2 3 2 1.67
+  CKD HTN 2 4 2 1.25
+  DM HTN 3 4 3 1.25
+
+Each pair comes with the patients with each concept and both, the
+lift (how much more often the two occur together than independence
+predicts), and the odds ratio, where it's finite:
+
+  >>> pairs[0][5:]
+  (1.6666666666666667, None)
+
+There are two passes over the blocks: one for the support of each
+concept, and one for the pairs of the frequent ones. Blocks are spread
+over worker processes, each sent once per pass, and only as workers
+are ready for them, so the cohort is never all in memory at once.
+When the pairs could number more than `max_pairs`, they are counted in
+stripes (by their first concept): each worker returns a block's counts
+stripe by stripe, those are set aside in files, and each stripe's are
+added up in turn:
+
+  >>> count_pairs(blocks, support=2, workers=2, max_pairs=2) == pairs
+  True
+
+Blocks needn't carry the concepts themselves: given a snapshot (see
+`snapshot`), they can be positions of patients in it, and each worker
+maps the snapshot files and reads the concepts of its own patients:
+
+  >>> import tempfile, shutil
+  >>> import snapshot
+  >>> root = tempfile.mkdtemp()
+  >>> snapshot.build(iter(rows), root)
+  1
+  >>> snap = snapshot.Snapshot.open(root)
+  >>> positions = snap.positions([1, 2, 3, 4, 5])
+  >>> count_pairs(lambda: chunks(positions, 2), support=2, workers=2,
+  ...             source=SnapshotPositions(snap.path)) == pairs
+  True
+  >>> snap.close()
+  >>> shutil.rmtree(root)
+
+'''
+
+import logging
+import marshal
+import os
+import shutil
+import tempfile
+from collections import defaultdict, deque
+from itertools import groupby
+
+log = logging.getLogger(__name__)
+
+# state of a worker process (or of this one, with workers=1)
+_worker = {}
+
+
+def count_pairs(blocks, support,
+                source=None, workers=None, max_pairs=5000000):
+    '''Count co-occurring concept pairs of a cohort.
+
+    :param blocks: access to the cohort, a block of patients at a time;
+                   called once per pass
+    :type blocks: () => Iterable[B]
+    :param Int support: least number of patients for a concept or pair
+    :param source: how workers read blocks; by default, `Codes`
+    :param Int workers: processes to use; None for one per CPU
+    :param Int max_pairs: bound on pair counts held at once
+    :return: (concept1, concept2, n1, n2, n12, lift, odds_ratio) sorted by
+             concept1, concept2, where n1 and n2 are patients with
+             concept1 and concept2, and n12 is patients with both
+    :rtype: Seq[Tuple]
+    :forall: B
+    '''
+    source = source or Codes()
+    reader = source.open()
+
+    # First pass: each concept's support.
+    n, bound, supports = 0, 0, defaultdict(int)
+    for block_n, block_bound, block_supports in _run(
+            workers, blocks(), _block_supports, (source,)):
+        n += block_n
+        bound += block_bound
+        for key, cnt in block_supports.iteritems():
+            supports[key] += cnt
+
+    # A pair can't be more frequent than either concept (apriori), so
+    # only frequent concepts are kept, numbered 0..F-1 by concept.
+    named = sorted((reader.name(key), key)
+                   for key, cnt in supports.iteritems() if cnt >= support)
+    names = [name for name, _ in named]
+    frequent = dict((key, ix) for ix, (_, key) in enumerate(named))
+    support_of = [supports[key] for _, key in named]
+
+    # Each patient with k concepts has k(k-1)/2 pairs; their sum
+    # bounds the number of distinct pairs.
+    stripes = max(1, -(-min(bound, len(names) ** 2 // 2) // max_pairs))
+    width = -(-len(names) // stripes) or 1
+    log.info('%d patients, %d of %d concepts with support >= %d; '
+             'at most %d pairs, in %d stripe(s)',
+             n, len(names), len(supports), support, bound, stripes)
+
+    def emit(merged, out):
+        for key in sorted(merged):
+            n12 = merged[key]
+            if n12 < support:
+                continue
+            i, j = divmod(key, len(names))
+            n1, n2 = support_of[i], support_of[j]
+            out.append((names[i], names[j], n1, n2, n12) +
+                       pair_measures(n12, n1, n2, n))
+
+    # Second pass: pair counts, by stripe.
+    out = []
+    results = _run(workers, blocks(), _block_pairs, (source, frequent, width))
+    if stripes == 1:
+        merged = defaultdict(int)
+        for parts in results:
+            _add(merged, parts[0])
+        emit(merged, out)
+        return out
+
+    spill = tempfile.mkdtemp(prefix='cooccur-')
+    try:
+        files = [open(os.path.join(spill, str(s)), 'w+b')
+                 for s in range(stripes)]
+        for parts in results:
+            for f, part in zip(files, parts):
+                if part:
+                    marshal.dump(part, f)
+        for f in files:
+            f.seek(0)
+            merged = defaultdict(int)
+            while True:
+                try:
+                    _add(merged, marshal.load(f))
+                except EOFError:
+                    break
+            f.close()
+            emit(merged, out)
+    finally:
+        shutil.rmtree(spill)
+    return out
+
+
+def row_blocks(rows,
+               block_size=2000):
+    '''Group (patient_num, concept) rows into blocks of patients' concepts.
+
+    :param rows: ordered by patient_num
+    :type rows: Iterable[(Int, String)]
+    :rtype: Iterator[Seq[Seq[String]]]
+
+    >>> list(row_blocks([(1, 'a'), (1, 'b'), (2, 'a'), (3, 'c')], 2))
+    [[['a', 'b'], ['a']], [['c']]]
+    '''
+    block = []
+    for pn, group in groupby(rows, key=lambda row: row[0]):
+        block.append([ccd for _, ccd in group])
+        if len(block) >= block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def chunks(items, size):
+    '''Slices of a sequence.
+
+    >>> list(chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    '''
+    for lo in xrange(0, len(items), size):
+        yield items[lo:lo + size]
+
+
+class Codes(object):
+    '''Blocks of patients' concept codes, as such.
+    '''
+    def open(self):
+        return self
+
+    def read(self, block):
+        return block
+
+    def name(self, key):
+        return key
+
+
+class SnapshotPositions(object):
+    '''Blocks of positions of patients in a snapshot version.
+    '''
+    def __init__(self, path):
+        '''
+        :param String path: snapshot version directory (`Snapshot.path`)
+        '''
+        self.path = path
+
+    def open(self):
+        import snapshot
+        return _SnapshotReader(snapshot.Snapshot(self.path))
+
+
+class _SnapshotReader(object):
+    def __init__(self, snap):
+        self._snap = snap
+
+    def read(self, block):
+        return [self._snap.concept_ids_at(r) for r in block]
+
+    def name(self, key):
+        return self._snap.concepts[key]
+
+
+def _run(workers, blocks, fn, initargs):
+    '''Apply fn to each block, in worker processes unless workers=1.
+    '''
+    if workers == 1:
+        _init(*initargs)
+        for block in blocks:
+            yield fn(block)
+        return
+    from multiprocessing import Pool, cpu_count
+    workers = workers or cpu_count()
+    pool = Pool(workers, _init, initargs)
+    try:
+        # Not pool.imap: it would draw all the blocks at once.
+        pending = deque()
+        for block in blocks:
+            pending.append(pool.apply_async(fn, (block,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _init(source, frequent=None, width=None):
+    _worker.update(reader=source.open(), frequent=frequent, width=width)
+
+
+def _block_supports(block):
+    '''Patients, a bound on their pairs, and each concept's support
+    in one block.
+    '''
+    n, bound, counts = 0, 0, defaultdict(int)
+    for concepts in _worker['reader'].read(block):
+        keys = set(concepts)
+        n += 1
+        bound += len(keys) * (len(keys) - 1) // 2
+        for key in keys:
+            counts[key] += 1
+    return n, bound, dict(counts)
+
+
+def _block_pairs(block):
+    '''Pair counts of frequent concepts in one block, a dict per stripe.
+
+    Pairs (i, j), i < j, are keyed as i * F + j.
+    '''
+    frequent, width = _worker['frequent'], _worker['width']
+    size = len(frequent)
+    parts = [defaultdict(int) for _ in range(-(-size // width) or 1)]
+    for concepts in _worker['reader'].read(block):
+        ids = sorted(set(frequent[key] for key in concepts if key in frequent))
+        for ix, i in enumerate(ids):
+            counts, base = parts[i // width], i * size
+            for j in ids[ix + 1:]:
+                counts[base + j] += 1
+    return [dict(counts) for counts in parts]
+
+
+def _add(merged, part):
+    for key, cnt in part.iteritems():
+        merged[key] += cnt
+
+
+def pair_measures(n12, n1, n2, n):
+    '''Lift and odds ratio of a pair of concepts.
+
+    >>> pair_measures(30, 50, 60, 100)
+    (1.0, 1.0)
+    >>> pair_measures(10, 10, 10, 100)
+    (10.0, None)
+
+    :return: (lift, odds_ratio); odds_ratio is None if it's infinite
+    '''
+    lift = float(n12) * n / (n1 * n2)
+    n10, n01 = n1 - n12, n2 - n12
+    n00 = n - n1 - n2 + n12
+    odds_ratio = float(n12) * n00 / (n10 * n01) if n10 and n01 else None
+    return lift, odds_ratio
@@ -4,6 +4,8 @@ distribution channels, so, welcome to CIRD's repo.
 
 '''
 
+from types import FunctionType
+
 
 class ESuite(object):
     '''ESuite -- Encapsulated (or: E-like) method suite
@@ -43,6 +45,14 @@ class ESuite(object):
       >>> it.quadruple()
       16
 
+    Objects with the same methods share a class; each keeps its
+    own state:
+
+      >>> Ex(1).__class__ is Ex(2).__class__
+      True
+      >>> Ex(1).double(), Ex(2).double()
+      (2, 4)
+
 
     TODO: take another look at making docstrings visible.
 
@@ -66,7 +76,51 @@ class ESuite(object):
         suite = dict(arg_methods + delegate_methods,
                      **kwargs)
 
-        return type(cls.__name__, (ESuite, object), suite)()
+        names = tuple(sorted(suite))
+        shape = (cls, names,
+                 tuple(isinstance(suite[n], FunctionType) for n in names))
+        made = _suite_classes.get(shape)
+        if made is None:
+            made = _suite_classes[shape] = _suite_class(cls.__name__, suite)
+        suite_cls, state = made
+
+        it = suite_cls()
+        state.__set__(it, tuple(suite[n] for n in names))
+        return it
+
+
+# One class per (ESuite subclass, suite shape), rather than per object.
+_suite_classes = {}
+
+
+def _suite_class(name, suite):
+    '''Make a class whose methods call the ones captured in each object.
+
+    Each object keeps its methods in a slot. The slot's descriptor is
+    removed from the class and held only by the methods, so the
+    captured state is no easier to get at than closure cells.
+
+    :return: the class and its state slot descriptor
+    '''
+    names = sorted(suite)
+    suite_cls = type(name, (ESuite, object), dict(__slots__=('_state',)))
+    state = suite_cls.__dict__['_state']
+    del suite_cls._state
+
+    def method(ix, f):
+        def call(self, *args, **kwargs):
+            return state.__get__(self)[ix](self, *args, **kwargs)
+        call.__name__, call.__doc__ = f.__name__, f.__doc__
+        return call
+
+    def value(ix):
+        return property(lambda self: state.__get__(self)[ix])
+
+    for ix, n in enumerate(names):
+        setattr(suite_cls, n,
+                method(ix, suite[n]) if isinstance(suite[n], FunctionType)
+                else value(ix))
+    return suite_cls, state
 
 
 def slot(obj):
@@ -86,3 +140,36 @@ def val(slot):
 
 def update(slot, val):
     slot[0] = val
+
+
+def _bench(n=20000):
+    '''Compare construction time and memory of shared vs. per-object classes.
+    '''
+    import sys
+    import timeit
+
+    def per_object_class(x):
+        def double(self):
+            return x + x
+        return type('Ex', (ESuite, object), dict(double=double))()
+
+    class Ex(ESuite):
+        def __new__(cls, x):
+            def double(self):
+                return x + x
+            return cls.make(double)
+
+    for label, mk in [('per-object class', per_object_class),
+                      ('shared class', Ex)]:
+        usec = timeit.timeit(lambda: mk(4), number=n) / n * 1e6
+        objs = [mk(i) for i in range(n)]
+        classes = set(o.__class__ for o in objs)
+        nbytes = (sum(sys.getsizeof(o) for o in objs) +
+                  sum(sys.getsizeof(c) + sys.getsizeof(c.__dict__)
+                      for c in classes))
+        print '%-16s %6.2f usec/object %6d bytes/object' % (
+            label, usec, nbytes / n)
+
+
+if __name__ == '__main__':
+    _bench()
@@ -0,0 +1,123 @@
+'''generations -- rebuild the derived tables aside, then switch to them
+.................................................................
+
+Building chi_pats, chi_pconcepts and chi_pcounts from scratch takes
+hours. Rather than drop them and leave chinotype unusable meanwhile,
+a rebuild makes a new generation of them under names of its own, while
+jobs go on using the current one:
+
+  >>> table_name('chi_concept_counts', 0)
+  'chi_concept_counts'
+  >>> table_name('chi.chi_concept_counts', 3)
+  'chi.chi_concept_counts_g3'
+
+Generation 0 is the tables by their configured names, as built before
+there were generations.
+
+Before the switch, the new tables are checked: none may be empty, and
+none may have many fewer rows than the current one, which would more
+likely be a failed load than fewer patients:
+
+  >>> old = {'chi_pats': 1000, 'chi_pconcepts': 90000}
+  >>> check_counts(old, {'chi_pats': 1010, 'chi_pconcepts': 91000})
+  []
+  >>> check_counts(old, {'chi_pats': 0, 'chi_pconcepts': 50000})
+  ... # doctest: +NORMALIZE_WHITESPACE
+  ['chi_pats: no rows',
+   'chi_pconcepts: 50000 rows, down from 90000 (more than 10%)']
+
+Cohorts already added to the current chi_pcounts are carried forward:
+their count and frequency columns are copied to the new one:
+
+  >>> cohort_columns(['PREFIX', 'CCD', 'TOTAL', 'FRC_TOTAL',
+  ...                 'M12_I34_R56', 'FRC_M12_I34_R56'])
+  ['M12_I34_R56']
+
+The switch itself is one row, inserted in a table of generations,
+the latest of which is current; jobs read it as they start. It is
+committed in one transaction with clearing the stored results that
+the new tables make stale.
+
+'''
+
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+# fraction of rows a new generation of a table may lose
+TOLERANCE_DEFAULT = 0.1
+
+# cohort count columns, as made by `chinotype.Chi2.runChi`
+_COHORT = re.compile(r'^M\d+_I\d+_R\d+$')
+
+
+def table_name(base, generation):
+    '''Name of a generation of a [schema.]table.
+    '''
+    return base if generation == 0 else '{0}_g{1}'.format(base, generation)
+
+
+def check_counts(old, new,
+                 tolerance=TOLERANCE_DEFAULT):
+    '''Check row counts of a new generation against the current one.
+
+    :param old: row counts of the current tables, by config name
+    :type old: Dict[String, Int]
+    :param new: row counts of the new tables, by config name
+    :type new: Dict[String, Int]
+    :param Float tolerance: fraction of rows a table may lose
+    :return: problems, if any
+    :rtype: Seq[String]
+    '''
+    out = []
+    for name in sorted(new):
+        if not new[name]:
+            out.append('{0}: no rows'.format(name))
+        elif old.get(name) and new[name] < (1 - tolerance) * old[name]:
+            out.append('{0}: {1} rows, down from {2} (more than {3:.0%})'.format(
+                name, new[name], old[name], tolerance))
+    return out
+
+
+def cohort_columns(cols):
+    '''Names of cohort count columns; each has a `frc_` column too.
+    '''
+    return [c for c in cols if _COHORT.match(c.upper())]
+
+
+class Generations(object):
+    '''Which generation of the derived tables is current, in a table.
+    '''
+    def __init__(self, table):
+        '''
+        :param String table: generations table, as made by `create_sql`
+        '''
+        self.table = table
+
+    def create_sql(self):
+        return '''
+        create table {0} (
+          generation number not null primary key
+        , switched_at date default sysdate not null
+        , note varchar2(1000)      -- row counts, etc.
+        )
+        '''.format(self.table)
+
+    def current(self, cur):
+        '''The current generation; 0 if none has been switched to.
+        '''
+        cur.execute('select max(generation) from {0}'.format(self.table))
+        row = cur.fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
+
+    def switch(self, cur, generation, note):
+        '''Make `generation` current, as of the next commit.
+
+        The caller commits, together with whatever else must change
+        as of the switch.
+        '''
+        log.info('switching to generation %d: %s', generation, note)
+        cur.execute('''
+        insert into {0} (generation, note) values (:0, :1)
+        '''.format(self.table), [generation, note[:1000]])
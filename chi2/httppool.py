@@ -0,0 +1,335 @@
+'''httppool -- thread-safe keep-alive HTTP transport for hive messages
+.....................................................................
+
+A mechanize `Browser` is one stateful conversation: `HiveUA` has to
+set its `method` and `addheaders` for each request, and it opens a new
+connection every time. `HTTPPool` keeps idle connections per host for
+re-use and gives each request its own connection, so any number of
+threads can share it.
+
+Under plain CGI, a pool lives for one request, but that request still
+makes several hive requests to the same host: the PM check, then, with
+`--pdo`, one per page of each patient set. Those share one connection
+rather than each opening its own. In a long-lived (e.g. WSGI) host,
+where one pool serves many requests, connections outlive requests too.
+
+Let's start a stub hive that reports which connection each request
+came in on:
+
+  >>> hive = StubHive()
+  >>> pool = HTTPPool(connect, timeout=5)
+  >>> addr = hive.address() + '/index.php'
+
+Sequential requests re-use one connection:
+
+  >>> [pool.post(addr, '<ping/>').read() for i in range(3)]
+  ['<pong n="1"/>', '<pong n="1"/>', '<pong n="1"/>']
+
+Concurrent requests each get a connection, which stay pooled after:
+
+  >>> hive.delay = 0.2
+  >>> replies = []
+  >>> threads = [threading.Thread(
+  ...     target=lambda: replies.append(pool.post(addr, '<ping/>').read()))
+  ...     for i in range(3)]
+  >>> for t in threads: t.start()
+  >>> for t in threads: t.join()
+  >>> sorted(replies)
+  ['<pong n="1"/>', '<pong n="2"/>', '<pong n="3"/>']
+  >>> pool.idle_count(addr)
+  3
+
+`post_all` sends many requests to a host from a few worker threads,
+each of which keeps to its own pooled connection, and gives the
+replies in order:
+
+  >>> hive.delay = 0.0
+  >>> pool.post_all(addr, ['<ping/>'] * 4, workers=2)
+  ... # doctest: +ELLIPSIS
+  ['<pong n="..."/>', '<pong n="..."/>', '<pong n="..."/>', '<pong n="..."/>']
+  >>> pool.idle_count(addr)
+  3
+
+HTTP errors are exceptions:
+
+  >>> pool.post(hive.address() + '/nowhere', '<ping/>')
+  Traceback (most recent call last):
+    ...
+  HTTPStatusError: 404 Not Found
+
+  >>> pool.close()
+  >>> hive.stop()
+
+'''
+
+import httplib
+import logging
+import socket
+import threading
+from urlparse import urlsplit
+
+log = logging.getLogger(__name__)
+
+
+class HTTPStatusError(IOError):
+    '''Non-200 HTTP response
+    '''
+    pass
+
+
+def connect(scheme, netloc, timeout):
+    '''Open an HTTP connection, using the standard library.
+
+    .. note:: This is a network access capability;
+              only trusted code should pass it around.
+    '''
+    cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+    return cls(netloc, timeout=timeout)
+
+
+class HTTPPool(object):
+    '''Keep-alive HTTP connections, pooled per host, shared by threads.
+    '''
+    def __init__(self, connect, timeout=180,
+                 max_idle=8):
+        '''
+        :param connect: access to make connections, e.g. `connect`
+        :type connect: (String, String, Float) => HTTPConnection
+        :param Float timeout: socket timeout (seconds) per connection
+        :param Int max_idle: max idle connections kept per host
+        '''
+        self._connect = connect
+        self._timeout = timeout
+        self._max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, key):
+        '''Get an idle connection to a host, or make a new one.
+
+        :return: (connection, is it re-used?)
+        '''
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key[0], key[1], self._timeout), False
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        '''Close all idle connections.
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def idle_count(self, addr):
+        '''How many idle connections are pooled for the host of `addr`?
+        '''
+        parts = urlsplit(addr)
+        with self._lock:
+            return len(self._idle.get((parts.scheme, parts.netloc), []))
+
+    def post(self, addr, body,
+             headers=(('Content-Type', 'text/xml'),)):
+        '''POST a request; get the reply.
+
+        Read the reply to the end to return its connection to the pool.
+
+        :param String addr: web address
+        :param String body: request body
+        :rtype: file-like
+        :raises: HTTPStatusError for non-200 responses
+        '''
+        parts = urlsplit(addr)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        while True:
+            conn, reused = self._checkout(key)
+            try:
+                conn.request('POST', path or '/', body, dict(headers))
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    # The server may have closed it while idle; try a fresh one.
+                    log.debug('stale pooled connection to %s', key[1])
+                    continue
+                raise
+            break
+        reply = _Reply(response, lambda reuse: (
+            self._checkin(key, conn) if reuse else conn.close()))
+        if response.status != 200:
+            reply.read()
+            raise HTTPStatusError('%d %s' % (response.status, response.reason))
+        return reply
+
+
+    def post_all(self, addr, bodies,
+                 workers=4):
+        '''POST requests from `workers` threads; get the replies, read.
+
+        :param String addr: web address
+        :param bodies: request bodies
+        :type bodies: Seq[String]
+        :rtype: Seq[String]
+        :raises: the first error of any request, once all are done
+        '''
+        out = [None] * len(bodies)
+        errors = []
+        todo = iter(range(len(bodies)))
+        todo_lock = threading.Lock()
+
+        def work():
+            while True:
+                with todo_lock:
+                    ix = next(todo, None)
+                if ix is None:
+                    return
+                try:
+                    out[ix] = self.post(addr, bodies[ix]).read()
+                except Exception as ex:
+                    errors.append(ex)
+
+        threads = [threading.Thread(target=work)
+                   for _ in range(max(1, min(workers, len(bodies))))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return out
+
+
+class _Reply(object):
+    '''File-like HTTP response that gives back its connection at the end.
+    '''
+    def __init__(self, response, release):
+        self._response = response
+        self._release = release
+        self.status = response.status
+
+    def read(self, amt=None):
+        data = (self._response.read() if amt is None
+                else self._response.read(amt))
+        if self._response.isclosed():
+            self._finish(not self._response.will_close)
+        return data
+
+    def close(self):
+        # A partly read response leaves the connection unusable.
+        self._finish(False)
+
+    def _finish(self, reuse):
+        release, self._release = self._release, None
+        if release is not None:
+            release(reuse)
+
+
+class StubHive(object):
+    '''Local HTTP/1.1 server for exercising the pool.
+
+    It answers POSTs to `/index.php` with `<pong n="..."/>`, where `n`
+    numbers the connection the request came in on, after `delay` seconds.
+    '''
+    def __init__(self, delay=0.0):
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+        import time
+
+        self.delay = delay
+        stub = self
+        counter = [0]
+        counter_lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # replies are written piecemeal; don't hold them back
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with counter_lock:
+                    counter[0] += 1
+                    self.conn_num = counter[0]
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                if self.path != '/index.php':
+                    self._reply(404, 'Not Found', '')
+                    return
+                time.sleep(stub.delay)
+                self._reply(200, 'OK', '<pong n="%d"/>' % self.conn_num)
+
+            def _reply(self, code, reason, body):
+                self.send_response(code, reason)
+                self.send_header('Content-Type', 'text/xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def address(self):
+        host, port = self._server.server_address
+        return 'http://%s:%d' % (host, port)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _bench(requests=64, delay=0.01, workers=(1, 2, 4, 8)):
+    '''Compare sequential requests over fresh vs. pooled connections
+    against a stub hive, as in a job that reads many PDO pages; then
+    throughput of `post_all` by number of workers, where the hive takes
+    `delay` seconds per request.
+    '''
+    import time
+
+    hive = StubHive(delay=delay)
+    addr = hive.address() + '/index.php'
+    try:
+        for label, fresh in [('fresh', True), ('pooled', False)]:
+            pool = HTTPPool(connect)
+            t0 = time.time()
+            for _ in range(requests):
+                pool.post(addr, '<ping/>').read()
+                if fresh:
+                    pool.close()
+            elapsed = time.time() - t0
+            print '%s connections: %6.1f requests/sec' % (
+                label, requests / elapsed)
+            pool.close()
+        for n in workers:
+            pool = HTTPPool(connect, max_idle=max(workers))
+            t0 = time.time()
+            pool.post_all(addr, ['<ping/>'] * requests, workers=n)
+            elapsed = time.time() - t0
+            print '%d worker(s): %6.1f requests/sec' % (n, requests / elapsed)
+            pool.close()
+    finally:
+        hive.stop()
+
+
+if __name__ == '__main__':
+    _bench()
@@ -11,13 +11,17 @@ Integration test usage::
 
 '''
 
+import hashlib
+import json
 import logging
-import pkg_resources
+import os
+import threading
 import xml.etree.ElementTree as ET
 
-# We use the Browser interface (type) at the module level,
+# We use the (mechanize) Browser interface (type) at the module level,
 # but instantiating it is a capability limited to trusted code.
-from mechanize import Browser
+# mechanize and pkg_resources are imported only when needed,
+# to keep the CGI's start-up cheap; cf. coldstart.py
 
 #from ocap import lafile
 import lafile
@@ -29,10 +33,26 @@ KEY1 = r'\\i2b2\i2b2\Diagnoses\Neoplasms (140-239)' '\\'
 
 def _res(fn):
     ''':type fn: String'''
+    import pkg_resources
     return pkg_resources.resource_string(__name__, fn)
 
-MSG_get_user_configuration = _res('msgs/i2b2_get_user_config.xml')
-MSG_PDO = _res('msgs/i2b2_get_pdo.xml')
+
+def _template(fn):
+    '''Get a message template on first use, not at import time.
+
+    :type fn: String
+    :rtype: () => String
+    '''
+    it = []
+
+    def get():
+        if not it:
+            it.append(_res(fn))
+        return it[0]
+    return get
+
+MSG_get_user_configuration = _template('msgs/i2b2_get_user_config.xml')
+MSG_PDO = _template('msgs/i2b2_get_pdo.xml')
 
 
 def _integration_test_main(argv,
@@ -62,19 +82,31 @@ class HiveUA(object):
         '''
         :param String hive_addr: web address of i2b2 hive endpoint
                                  usually `http://.../index.php`
-        :param Browser browser: web access a la mechanize
+        :param Browser browser: web access a la mechanize,
+                                or a thread-safe `httppool.HTTPPool`
         '''
-        # Skip robots.txt
-        browser.set_handle_robots(False)
+        if hasattr(browser, 'post'):
+            def open_request(bodyq):
+                log.debug('request body: %s', bodyq)
+                return browser.post(hive_addr, bodyq)
+        else:
+            # Skip robots.txt
+            browser.set_handle_robots(False)
+            # A Browser is one conversation; take turns.
+            turn = threading.Lock()
+
+            def open_request(bodyq):
+                log.debug('request body: %s', bodyq)
+                with turn:
+                    browser.method = "POST"
+                    browser.addheaders = [('Content-Type', 'text/xml')]
+                    return browser.open(hive_addr, bodyq)
 
         def send_request(bodyq):
-            log.debug('request body: %s', bodyq)
-            browser.method = "POST"
-            browser.addheaders = [('Content-Type', 'text/xml')]
-            reply = browser.open(hive_addr, bodyq)
-            body = reply.read()
+            body = open_request(bodyq).read()
             log.debug('reply: %s...', body[:40])
             return body
+        self.open_request = open_request
         self.send_request = send_request
 
     def _post_to_hive(self, redirect, request_template, parts):
@@ -94,6 +126,19 @@ class HiveUA(object):
         log.debug('_post_to_hive parsed reply: %s', body_parsed)
         return body_parsed
 
+    def _open_from_hive(self, redirect, request_template, parts):
+        '''Fill in template and send request, but leave the reply unread.
+
+        Use this rather than `_post_to_hive` for replies that may be too
+        big to hold in memory; cf. `iter_pdo_patients`.
+
+        :return: file-like reply
+        '''
+        log.debug('_open_from_hive %s: %s ...', redirect,
+                  request_template[:40])
+        bodyq = request_template % dict(parts, REDIRECT=redirect)
+        return self.open_request(bodyq)
+
 
 class BadFormat(ValueError):
     '''Message (e.g. from PM cell) has bad format.
@@ -110,7 +155,8 @@ class HiveError(IOError):
 class AccountCheck(HiveUA):
     '''Require i2b2 PM account to invoke access.
     '''
-    def __init__(self, hive_addr, urlCellPM, browser):
+    def __init__(self, hive_addr, urlCellPM, browser,
+                 cache=None):
         '''
 
         .. note:: In :ref:`well-typed python <well-typed>`,
@@ -122,9 +168,12 @@ class AccountCheck(HiveUA):
                                  as in i2b2_config_data.js
         :param Browser browser: web access
         :param doit: function to be called only if the PM cell says OK
+        :param CredentialCache cache: optional memory of
+                                      recent successful checks
         '''
         HiveUA.__init__(self, hive_addr, browser)
         self.urlCellPM = urlCellPM
+        self.cache = cache
 
     def restrict(self, access):
         '''Make a restricted form of an access function.
@@ -147,13 +196,59 @@ class AccountCheck(HiveUA):
 
         .. note:: `get_...` seems misleading; this is stateful.
 
+        Only successful checks are cached, and only until the session
+        token times out or `CredentialCache.max_ttl` passes, whichever
+        is sooner, so a cache hit authorizes only what the PM cell did
+        moments ago.
+
+          >>> import os, tempfile, shutil
+          >>> tmp = tempfile.mkdtemp()
+          >>> cache = CredentialCache(lafile.Editable(tmp, os, open),
+          ...                         clock=lambda: 0)
+          >>> acct = AccountCheck('http://hive/index.php',
+          ...                     'http://hive/PMService/', mock_browser(),
+          ...                     cache=cache)
+          >>> token = ('knock-knock', 'session-key:12345')
+          >>> acct.get_user_configuration(token)
+          ('session-key:12345', {}, [])
+          >>> acct.get_user_configuration(token)
+          ('session-key:12345', {}, [])
+          >>> sorted(cache.stats().items())
+          ... # doctest: +NORMALIZE_WHITESPACE
+          [('evictions', 0), ('expirations', 0), ('hits', 1),
+           ('misses', 1), ('size', 1)]
+          >>> shutil.rmtree(tmp)
+
         '''
         username, password = authz
+        if self.cache is not None:
+            config = self.cache.get(authz)
+            if config is not None:
+                log.debug('PM check cached for %s', username)
+                return config
         doc = self._post_to_hive(self.urlCellPM + path,
-                                 MSG_get_user_configuration,
+                                 MSG_get_user_configuration(),
                                  dict(USERNAME=username,
                                       PASSWORD=password))
-        return AccountCheck._parse_config(doc, username)
+        config = AccountCheck._parse_config(doc, username)
+        if self.cache is not None:
+            self.cache.put(authz, config, AccountCheck._token_timeout(doc))
+        return config
+
+    @classmethod
+    def _token_timeout(cls, doc):
+        '''Get the session token timeout (ms) from a PM reply, if any.
+
+          >>> AccountCheck._token_timeout(ET.fromstring(
+          ...     '<response><user><password token_ms_timeout="60000">'
+          ...     'SessionKey:xyz</password></user></response>'))
+          60000
+          >>> AccountCheck._token_timeout(ET.fromstring('<response/>'))
+        '''
+        for pw in doc.findall('.//user/password'):
+            if 'token_ms_timeout' in pw.attrib:
+                return int(pw.attrib['token_ms_timeout'])
+        return None
 
     @classmethod
     def _parse_config(cls, doc, username):
@@ -191,6 +286,331 @@ class AccountCheck(HiveUA):
         return session_key, cells, projects
 
 
+class PDOPatientSet(HiveUA):
+    '''Read patient sets a page at a time through the CRC cell's PDO service.
+
+    This needs only an i2b2 session, not SELECT grants on
+    `qt_patient_set_collection`.
+
+    Let's make a stub hive with a patient set of 5 patients:
+
+      >>> hive = StubPDOBrowser({42: [101, 102, 103, 104, 105]})
+      >>> pdo = PDOPatientSet('http://hive/index.php',
+      ...                     'http://hive/QueryToolService/', hive,
+      ...                     page_size=2)
+
+    We get all the patients, 2 per request:
+
+      >>> list(pdo.patients(('me', 'SessionKey:xyz'), 'BlueHeron', 42))
+      [101, 102, 103, 104, 105]
+      >>> hive.pages
+      [(1, 2), (3, 4), (5, 6)]
+
+    An ERROR status from the CRC cell is an exception:
+
+      >>> list(pdo.patients(('me', 'SessionKey:xyz'), 'BlueHeron', 7))
+      Traceback (most recent call last):
+        ...
+      HiveError: no such patient set: 7
+    '''
+    def __init__(self, hive_addr, urlCellCRC, browser,
+                 page_size=10000):
+        '''
+        :param String hive_addr: address of i2b2 hive endpoint (index.php)
+        :param String urlCellCRC: address of i2b2 QueryToolService,
+                                  as in the `cells` from `AccountCheck`
+        :param Browser browser: web access
+        :param Int page_size: max patients per PDO request
+        '''
+        HiveUA.__init__(self, hive_addr, browser)
+        self.urlCellCRC = urlCellCRC
+        self.page_size = page_size
+
+    def patients(self, authz, project_id, patient_set,
+                 path='pdorequest'):
+        '''Generate the patient_nums of a patient set.
+
+        :param authz: (username, session key)
+        :param String project_id: i2b2 project of the patient set
+        :param Int patient_set: result_instance_id of the patient set
+        :rtype: Iterator[Int]
+        '''
+        username, password = authz
+        lo = 1
+        while True:
+            reply = self._open_from_hive(
+                self.urlCellCRC + path, MSG_PDO(),
+                dict(USERNAME=username, PASSWORD=password,
+                     PROJECT_ID=project_id, PATIENT_SET=patient_set,
+                     MIN_PATIENTS=lo, MAX_PATIENTS=lo + self.page_size - 1,
+                     PANELS=''))
+            qty = 0
+            for patient_num in iter_pdo_patients(reply):
+                qty += 1
+                yield patient_num
+            log.debug('PDO patients %d.. of set %s: %d',
+                      lo, patient_set, qty)
+            if qty < self.page_size:
+                break
+            lo += self.page_size
+
+
+def iter_pdo_patients(reply):
+    '''Parse patient_nums from a PDO reply incrementally.
+
+    Each `patient` element is discarded as soon as it has been read,
+    so memory use doesn't grow with the size of the reply.
+
+    :param reply: file-like PDO response message
+
+    >>> from StringIO import StringIO
+    >>> list(iter_pdo_patients(StringIO(_pdo_reply([7, 8]))))
+    [7, 8]
+
+    :raises: HiveError on ERROR status in the reply
+    '''
+    parents = []
+    for event, elt in ET.iterparse(reply, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elt)
+            continue
+        parents.pop()
+        name = elt.tag.rsplit('}', 1)[-1]
+        if name == 'status' and elt.attrib.get('type') == 'ERROR':
+            raise HiveError(elt.text)
+        elif name == 'patient':
+            yield int(elt.findtext('patient_id'))
+            if parents:
+                parents[-1].remove(elt)
+
+
+def _pdo_reply(patient_nums, error=None):
+    '''Make a PDO response message, for testing.
+    '''
+    status = ('<status type="ERROR">%s</status>' % error if error
+              else '<status type="DONE">DONE</status>')
+    patients = ''.join(['<patient><patient_id source="HIVE">%d</patient_id>'
+                        '</patient>' % pn for pn in patient_nums])
+    return ('''<ns5:response xmlns:ns5="http://www.i2b2.org/xsd/hive/msg/1.1/"
+      xmlns:ns2="http://www.i2b2.org/xsd/hive/pdo/1.1/">
+      <response_header><result_status>%s</result_status></response_header>
+      <message_body><ns2:patient_data><ns2:patient_set>%s</ns2:patient_set>
+      </ns2:patient_data></message_body></ns5:response>'''
+            % (status, patients))
+
+
+class StubPDOBrowser(object):
+    '''Stand-in for a hive with a CRC cell that serves PDO requests.
+
+    :param patient_sets: patient_nums by result_instance_id
+    :type patient_sets: Dict[Int, Seq[Int]]
+    '''
+    def __init__(self, patient_sets):
+        self.patient_sets = patient_sets
+        self.pages = []
+
+    def set_handle_robots(self, flag):
+        pass
+
+    def open(self, addr, body=None):
+        from StringIO import StringIO
+        req = ET.fromstring(body)
+        plist = req.findall('.//patient_list')[0]
+        lo, hi = int(plist.attrib['min']), int(plist.attrib['max'])
+        self.pages.append((lo, hi))
+        psid = int(plist.findtext('patient_set_coll_id'))
+        if psid not in self.patient_sets:
+            return StringIO(_pdo_reply([],
+                                       error='no such patient set: %d' % psid))
+        return StringIO(_pdo_reply(self.patient_sets[psid][lo - 1:hi]))
+
+
+class CredentialCache(object):
+    '''Remember successful PM credential checks, across processes.
+
+    Each CGI request is a process of its own, so checks are kept in a
+    directory, one small file per check, written aside and renamed into
+    place so readers never see a partial file. Only checks made with a
+    session token (the password the PM cell hands back as the session
+    key) are kept, and then only the user's cells and projects: the
+    file is named by a hash of the token, and holds nothing that would
+    let its reader act as the user.
+
+      >>> import os, tempfile, shutil
+      >>> import lafile
+      >>> tmp = tempfile.mkdtemp()
+      >>> now = [0.0]
+      >>> cache = CredentialCache(lafile.Editable(tmp, os, open),
+      ...                         clock=lambda: now[0], max_entries=2)
+      >>> alice = ('alice', 'SessionKey:a')
+      >>> cache.put(alice, ('SessionKey:a', {'CRC': 'http://crc/'}, ['P1']),
+      ...           60000)
+      >>> cache.get(alice)
+      ('SessionKey:a', {u'CRC': u'http://crc/'}, [u'P1'])
+
+    Another process (another cache on the same directory) sees it:
+
+      >>> other = CredentialCache(lafile.Editable(tmp, os, open),
+      ...                         clock=lambda: now[0])
+      >>> other.get(alice)[2]
+      [u'P1']
+
+    A different token is a different key, and a check that didn't use
+    the session key isn't kept:
+
+      >>> cache.get(('alice', 'SessionKey:b')) is None
+      True
+      >>> cache.put(('bob', 'sekret'), ('SessionKey:b1', {}, []), 60000)
+      >>> cache.get(('bob', 'sekret')) is None
+      True
+
+    Entries expire with the token, but no later than `max_ttl` seconds,
+    so a logout at the PM cell is noticed soon enough:
+
+      >>> now[0] = 61.0
+      >>> cache.get(alice) is None
+      True
+      >>> cache.put(alice, ('SessionKey:a', {}, []), 1800000)
+      >>> now[0] += cache.max_ttl + 1
+      >>> cache.get(alice) is None
+      True
+
+    Beyond `max_entries`, those closest to expiring go first:
+
+      >>> for who in ['carol', 'dave', 'eve']:
+      ...     key = 'SessionKey:' + who
+      ...     cache.put((who, key), (key, {}, []), 60000)
+      ...     now[0] += 1
+      >>> cache.get(('carol', 'SessionKey:carol')) is None
+      True
+
+    Entries can be invalidated by user, or all at once:
+
+      >>> cache.invalidate('dave')
+      >>> cache.get(('dave', 'SessionKey:dave')) is None
+      True
+      >>> cache.get(('eve', 'SessionKey:eve'))[0]
+      'SessionKey:eve'
+      >>> cache.invalidate()
+      >>> sorted(cache.stats().items())
+      ... # doctest: +NORMALIZE_WHITESPACE
+      [('evictions', 1), ('expirations', 2), ('hits', 2),
+       ('misses', 6), ('size', 0)]
+
+      >>> shutil.rmtree(tmp)
+    '''
+    max_ttl = 300
+
+    def __init__(self, cache_dir, clock, max_entries=1000,
+                 default_ttl_ms=1800000):
+        '''
+        :param lafile.Editable cache_dir: where to keep checks; shared
+                                          by all the processes
+        :param clock: access to the time, in seconds
+        :type clock: () => Float
+        :param Int max_entries: bound on number of cached checks
+        :param Int default_ttl_ms: lifetime of entries for replies
+                                   that don't give a token timeout
+        '''
+        self._dir = cache_dir
+        self._clock = clock
+        self._max_entries = max_entries
+        self._default_ttl_ms = default_ttl_ms
+        # hits etc. in this process
+        self._counts = dict(hits=0, misses=0, evictions=0, expirations=0)
+
+    @classmethod
+    def _name(cls, authz):
+        username, password = authz
+        return '%s.%s' % (username.encode('hex'),
+                          hashlib.sha256(password).hexdigest())
+
+    def get(self, authz):
+        '''Get the cached user configuration for these credentials, if any.
+        '''
+        entry = self._read(self._name(authz))
+        if entry is not None and entry['expires'] <= self._clock():
+            self._counts['expirations'] += 1
+            self._forget(self._name(authz))
+            entry = None
+        if entry is None:
+            self._counts['misses'] += 1
+            return None
+        self._counts['hits'] += 1
+        return authz[1], entry['cells'], entry['projects']
+
+    def put(self, authz, config, ttl_ms):
+        '''Remember the user configuration from a successful check.
+
+        :param Int ttl_ms: session token timeout; None for the default
+        '''
+        session_key, cells, projects = config
+        if session_key != authz[1]:
+            return
+        if ttl_ms is None:
+            ttl_ms = self._default_ttl_ms
+        name = self._name(authz)
+        expires = self._clock() + min(ttl_ms / 1000.0, self.max_ttl)
+        tmp = self._dir / ('.%s.%d.tmp' % (name, os.getpid()))
+        tmp.setBytes(json.dumps(dict(expires=expires, cells=cells,
+                                     projects=projects)))
+        tmp.renameTo(self._dir / name)
+        self._prune()
+
+    def invalidate(self, username=None):
+        '''Forget checks for one user, or for everyone.
+        '''
+        for name in self._names():
+            if username is None or name.startswith(
+                    username.encode('hex') + '.'):
+                self._forget(name)
+
+    def stats(self):
+        '''Get hit/miss metrics.
+
+        :rtype: Dict[String, Int]
+        '''
+        return dict(self._counts, size=len(self._names()))
+
+    def _names(self):
+        names = [rd.fullPath().rsplit('/', 1)[-1]
+                 for rd in self._dir.ro().subRdFiles()]
+        return [n for n in names if not n.startswith('.')]
+
+    def _read(self, name):
+        rd = (self._dir / name).ro()
+        try:
+            return json.loads(rd.getBytes())
+        except (IOError, OSError, ValueError):
+            return None  # not there, or removed meanwhile
+
+    def _forget(self, name):
+        try:
+            (self._dir / name).delete()
+        except OSError:
+            pass  # another process beat us to it
+
+    def _prune(self):
+        '''Drop expired entries, and those closest to expiring beyond
+        `max_entries`.
+        '''
+        names = self._names()
+        if len(names) <= self._max_entries:
+            return
+        now = self._clock()
+        live = []
+        for name in names:
+            entry = self._read(name)
+            if entry is None or entry['expires'] <= now:
+                self._forget(name)
+            else:
+                live.append((entry['expires'], name))
+        live.sort()
+        for _, name in live[:max(0, len(live) - self._max_entries)]:
+            self._forget(name)
+            self._counts['evictions'] += 1
+
+
 def pw_decode(txt):
     '''
     :param String txt: i2b2 password element text
@@ -238,30 +658,191 @@ def ds_access(user_name, rdFiles,
 
     :raises: XMLSyntaxError on failure to parse XML files therein
 
+    Files parsed by an earlier call in this process are parsed again
+    only if they changed since (see `DatasourceIndex`).
+
     '''
     # Refer to type since pyflakes can't see in docstrings
     classOf(lafile.ConfigRd)
 
-    docs = [ET.fromstring(rd.inChannel().read())
-            for rd in rdFiles
-            if rd.fullPath().endswith(suffix)]
+    return _find_datasource(_parsed, rdFiles, user_name, suffix)
+
+
+# parsed -ds.xml files of this process, for ds_access
+_parsed = {}
+
+
+def _find_datasource(parsed, rdFiles, user_name, suffix):
+    '''Find a datasource in the first file that has it, parsing only
+    files that changed or were parsed only in part.
+
+    :param parsed: path -> (mtime, all parsed?, {user-name: (password, url)});
+                   updated in place
+    '''
+    for rd in rdFiles:
+        if not rd.fullPath().endswith(suffix):
+            continue
+        path, mtime = rd.fullPath(), rd.lastModified()
+        entry = parsed.get(path)
+        if (entry is None or entry[0] != mtime or
+                not (entry[1] or user_name in entry[2])):
+            entry = _parse_datasources(rd, mtime, user_name)
+            parsed[path] = entry
+        if user_name in entry[2]:
+            return _conn_details(*entry[2][user_name])
+    raise IndexError(user_name)
+
+
+def _parse_datasources(rd, mtime, user_name):
+    '''Parse a file up to the datasource for `user_name`.
+    '''
+    log.debug('parsing datasources in %s', rd.fullPath())
+    srcs = {}
+    for users, details in _iter_datasources(rd):
+        for u in users:
+            srcs.setdefault(u, details)
+        if user_name in users:
+            return mtime, False, srcs
+    return mtime, True, srcs
 
-    srcs = [(src.findall('password'),
-             src.findall('connection-url'),
-             src.findall('user-name'))
-            for doc in docs
-            for src in doc.findall('local-tx-datasource')]
 
-    my_srcs = [(pw[0].text, conn[0].text)
-               for (pw, conn, u) in srcs
-               if (user_name in [e.text for e in u]) and pw and conn]
+def _iter_datasources(rd):
+    '''Generate the usable datasources of a jboss -ds.xml file.
 
-    if not my_srcs:
-        raise IndexError(user_name)
+    Parsing is incremental, so we read no further than the caller needs.
 
-    pw, url = my_srcs[0]
+    :return: (user-names, (password, connection-url)) pairs
+    :rtype: Iterator[(Seq[String], (String, String))]
+    '''
+    depth = 0
+    stream = rd.inChannel()
+    try:
+        for event, elt in ET.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1 or elt.tag != 'local-tx-datasource':
+                continue
+            pw, conn = elt.findall('password'), elt.findall('connection-url')
+            users = [e.text for e in elt.findall('user-name')]
+            elt.clear()
+            if pw and conn:
+                yield users, (pw[0].text, conn[0].text)
+    finally:
+        stream.close()
+
+
+def _conn_details(password, url):
+    '''Connection details from an Oracle thin connection-url.
+
+    Only the datasource asked for is taken apart, so other kinds
+    (postgres, h2, ...) in the same deploy directory do no harm.
+
+    >>> _conn_details('pw', 'jdbc:oracle:thin:@dbhost:1521:DB1')
+    ('pw', 'dbhost', '1521', 'DB1')
+    '''
     [host, port, sid] = url.split('@', 1)[1].split(':', 2)
-    return pw, host, port, sid
+    return password, host, port, sid
+
+
+class DatasourceIndex(object):
+    '''Find jboss datasources by user-name, re-reading only changed files.
+
+    Let's make a deploy directory with a couple datasource descriptors,
+    and keep track of which files get read:
+
+      >>> import os, tempfile, shutil
+      >>> tmp = tempfile.mkdtemp()
+      >>> def ds(user, pw, url):
+      ...     return ('<datasources><local-tx-datasource>'
+      ...             '<connection-url>%s</connection-url>'
+      ...             '<user-name>%s</user-name>'
+      ...             '<password>%s</password></local-tx-datasource>'
+      ...             '</datasources>' % (url, user, pw))
+      >>> open(os.path.join(tmp, 'a-ds.xml'), 'w').write(
+      ...     ds('A', 'pwA', 'jdbc:oracle:thin:@h1:1521:DB1'))
+      >>> open(os.path.join(tmp, 'b-ds.xml'), 'w').write(
+      ...     ds('B', 'pwB', 'jdbc:oracle:thin:@h2:1521:DB1'))
+      >>> reads = []
+      >>> def openf(path):
+      ...     reads.append(os.path.basename(path))
+      ...     return open(path)
+      >>> deploy = lafile.Readable(tmp, os.path, os.listdir, openf)
+
+      >>> now = [0]
+      >>> dsi = DatasourceIndex(deploy, lambda: now[0], recheck=60)
+      >>> dsi.lookup('B')
+      ('pwB', 'h2', '1521', 'DB1')
+
+    Within `recheck` seconds, lookups don't touch the filesystem:
+
+      >>> del reads[:]
+      >>> dsi.lookup('B')
+      ('pwB', 'h2', '1521', 'DB1')
+      >>> dsi.lookup('A')
+      ('pwA', 'h1', '1521', 'DB1')
+      >>> reads
+      []
+
+    After that, only changed files are parsed again:
+
+      >>> open(os.path.join(tmp, 'b-ds.xml'), 'w').write(
+      ...     ds('B', 'pw2', 'jdbc:oracle:thin:@h2:1521:DB1'))
+      >>> os.utime(os.path.join(tmp, 'b-ds.xml'), (1, 1))
+      >>> now[0] = 61
+      >>> dsi.lookup('B')
+      ('pw2', 'h2', '1521', 'DB1')
+      >>> reads
+      ['b-ds.xml']
+
+    Datasources of other kinds are passed over:
+
+      >>> open(os.path.join(tmp, 'a-ds.xml'), 'w').write(
+      ...     ds('H2', 'sa', 'jdbc:h2:mem:test'))
+      >>> ds_access('B', deploy.subRdFiles())
+      ('pw2', 'h2', '1521', 'DB1')
+
+      >>> dsi.lookup('nobody')
+      Traceback (most recent call last):
+        ...
+      IndexError: nobody
+      >>> shutil.rmtree(tmp)
+    '''
+    def __init__(self, deploy_dir, clock,
+                 recheck=60, suffix='-ds.xml'):
+        '''
+        :param lafile.Readable deploy_dir: jboss deploy directory
+        :param clock: access to the time, in seconds
+        :type clock: () => Float
+        :param Float recheck: how long to trust a lookup (seconds)
+        :param String suffix: which files describe datasources
+        '''
+        self._dir = deploy_dir
+        self._clock = clock
+        self._recheck = recheck
+        self._suffix = suffix
+        # path -> (mtime, all parsed?, {user-name: (password, url)})
+        self._files = {}
+        # user-name -> (when, details)
+        self._found = {}
+
+    def lookup(self, user_name):
+        '''Get (password, host, port, sid) of a datasource by user-name.
+
+        :raises: IndexError if there's no such datasource
+        '''
+        now = self._clock()
+        hit = self._found.get(user_name)
+        if hit is not None and now - hit[0] < self._recheck:
+            return hit[1]
+        rds = list(self._dir.subRdFiles())
+        paths = set(rd.fullPath() for rd in rds)
+        for gone in [p for p in self._files if p not in paths]:
+            del self._files[gone]
+        details = _find_datasource(self._files, rds, user_name, self._suffix)
+        self._found[user_name] = (now, details)
+        return details
 
 
 def mock_browser():
@@ -293,6 +874,7 @@ if __name__ == '__main__':
 
     def _with_caps():
         from sys import argv
+        from mechanize import Browser
 
         _integration_test_main(argv=argv,
                                mkBrowser=lambda: Browser())
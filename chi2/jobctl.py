@@ -0,0 +1,139 @@
+'''jobctl -- time budgets and cancellation for a job's database calls
+.................................................................
+
+Each phase of a chinotype job (building the concept tables, adding a
+cohort, ranking the output) gets a time budget, in seconds, enforced
+by the database driver as a call timeout; 0 is no limit:
+
+  >>> sorted(parse_budgets('prep=0, cohort=900,output=300').items())
+  [('cohort', 900.0), ('output', 300.0), ('prep', 0.0)]
+
+A job is cancelled from outside, e.g. by a request from the user who
+started it, by making a marker file; its name is made from the user
+and job ids, which must be safe as file names:
+
+  >>> job_marker('dconnolly', 'a1b2-3')
+  'dconnolly.a1b2-3'
+  >>> job_marker('dconnolly', '../etc')
+  Traceback (most recent call last):
+    ...
+  ValueError: bad job id: ../etc
+
+While a job runs, a `Watchdog` thread checks for cancellation and
+interrupts whatever call the job's connection is making:
+
+  >>> import time
+  >>> class Conn(object):
+  ...     cancels = 0
+  ...     def cancel(self):
+  ...         self.cancels += 1
+  >>> conn, flag = Conn(), []
+  >>> dog = Watchdog(lambda: bool(flag), poll=0.01)
+  >>> with dog.watch(conn):
+  ...     time.sleep(0.05)
+  ...     flag.append('cancel')
+  ...     time.sleep(0.05)
+  >>> dog.fired, conn.cancels > 0
+  (True, True)
+
+'''
+
+import logging
+import re
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# seconds by phase; 0 for no limit
+BUDGETS_DEFAULT = 'prep=0,cohort=900,output=300'
+
+_SAFE_ID = re.compile(r'^[\w.-]{1,64}$')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def parse_budgets(txt):
+    '''Parse `phase=seconds, ...`.
+
+    :rtype: Dict[String, Float]
+    '''
+    budgets = {}
+    for item in txt.split(','):
+        if not item.strip():
+            continue
+        name, seconds = item.split('=')
+        budgets[name.strip()] = float(seconds)
+    return budgets
+
+
+def set_budget(conn, seconds):
+    '''Limit each call on a cx_Oracle connection to `seconds`.
+
+    Needs cx_Oracle 7 and Oracle client 18; otherwise, calls are not
+    limited (but can still be cancelled).
+    '''
+    try:
+        conn.callTimeout = int(seconds * 1000)
+    except AttributeError:
+        if seconds:
+            log.warning('call timeouts need cx_Oracle 7 and Oracle client 18')
+
+
+def job_marker(username, job_id):
+    '''Name of the file whose existence cancels a job.
+    '''
+    if not _SAFE_ID.match(username or '') or username.startswith('.'):
+        raise ValueError('bad username: %s' % username)
+    if not _SAFE_ID.match(job_id or '') or job_id.startswith('.'):
+        raise ValueError('bad job id: %s' % job_id)
+    return '%s.%s' % (username, job_id)
+
+
+class Watchdog(object):
+    '''Cancel a connection's calls once a job is cancelled.
+    '''
+    def __init__(self, cancelled,
+                 poll=1.0):
+        '''
+        :param cancelled: access to whether the job is cancelled;
+                          None if it can't be
+        :type cancelled: () => Boolean
+        :param Float poll: seconds between checks
+        '''
+        self._cancelled = cancelled
+        self._poll = poll
+        self.fired = False
+
+    @contextmanager
+    def watch(self, conn):
+        '''Watch while the block runs.
+
+        :param conn: has `cancel()`, e.g. a cx_Oracle connection
+        '''
+        if self._cancelled is None:
+            yield self
+            return
+        done = threading.Event()
+
+        def run():
+            done.wait(self._poll)
+            while not done.is_set():
+                if self.fired or self._cancelled():
+                    if not self.fired:
+                        log.info('job cancelled; interrupting database call')
+                    self.fired = True
+                    # again each time, in case a call started since
+                    conn.cancel()
+                done.wait(self._poll)
+
+        dog = threading.Thread(target=run, name='chi2-watchdog')
+        dog.daemon = True
+        dog.start()
+        try:
+            yield self
+        finally:
+            done.set()
+            dog.join()
@@ -16,6 +16,8 @@ Inspired by:
          inChannel : unit -> in_channel;
          getBytes : unit -> string;
          fullPath : unit -> string;
+         length : unit -> int;
+         lastModified : unit -> float;
     }
 
 
@@ -92,8 +94,14 @@ class Readable(ESuite):
         def fullPath(_):
             return os_path.abspath(path)
 
+        def length(_):
+            return os_path.getsize(path)
+
+        def lastModified(_):
+            return os_path.getmtime(path)
+
         return cls.make(isDir, exists, subRdFiles, subRdFile, inChannel,
-                        getBytes, fullPath,
+                        getBytes, fullPath, length, lastModified,
                         __div__=subRdFile,
                         __trueDiv=subRdFile)
 
@@ -163,8 +171,14 @@ class ListReadable(ESuite):
         def fullPath(_):
             return abspath('')
 
+        def length(_):
+            raise IOError('cannot measure directory')
+
+        def lastModified(_):
+            raise IOError('cannot date directory')
+
         return cls.make(isDir, exists, subRdFiles, subRdFile, inChannel,
-                        getBytes, fullPath,
+                        getBytes, fullPath, length, lastModified,
                         __div__=subRdFile,
                         __trueDiv=subRdFile)
 
@@ -245,9 +259,15 @@ class ConfigRd(ESuite, ConfigDir):
         def fullPath(_):
             return base.fullPath()
 
+        def length(_):
+            raise IOError('cannot measure directory')
+
+        def lastModified(_):
+            raise IOError('cannot date directory')
+
         return cls.make(get, items,
                         isDir, exists, subRdFiles, subRdFile, inChannel,
-                        getBytes, fullPath,
+                        getBytes, fullPath, length, lastModified,
                         __div__=subRdFile,
                         __trueDiv=subRdFile)
 
@@ -259,6 +279,17 @@ class Editable(ESuite):
     >>> (x / 'y').ro().fullPath()
     '/x/y'
 
+    Appending and renaming need no authority beyond the files involved:
+
+    >>> import tempfile, shutil
+    >>> tmp = Editable(tempfile.mkdtemp(), os, open)
+    >>> (tmp / 'a').setBytes('x')
+    >>> with (tmp / 'a').appendChannel() as out:
+    ...     out.write('yz')
+    >>> (tmp / 'a').renameTo(tmp / 'b')
+    >>> (tmp / 'b').ro().getBytes(), (tmp / 'b').ro().length()
+    ('xyz', 3)
+    >>> shutil.rmtree(tmp.ro().fullPath())
     '''
     def __new__(cls, path, os, openf):
         def _openrd(p):
@@ -281,8 +312,15 @@ class Editable(ESuite):
         def outChannel(_):
             return openf(path, 'w')
 
+        def appendChannel(_):
+            return openf(path, 'a')
+
         def setBytes(self, b):
-            outChannel(self).write(b)
+            with outChannel(self) as out:
+                out.write(b)
+
+        def renameTo(_, other):
+            os.rename(path, other.ro().fullPath())
 
         def mkDir(_):
             os.mkdir(path)
@@ -293,8 +331,8 @@ class Editable(ESuite):
         def delete(_):
             os.remove(path)
 
-        return cls.make(ro, subEdFiles, subEdFile, outChannel,
-                        setBytes, mkDir, createNewFile, delete,
+        return cls.make(ro, subEdFiles, subEdFile, outChannel, appendChannel,
+                        setBytes, renameTo, mkDir, createNewFile, delete,
                         __div__=subEdFile,
                         __trueDiv=subEdFile)
 
@@ -319,9 +357,15 @@ class ListEditable(ESuite):
         def outChannel(_):
             raise IOError('cannot write directory')
 
+        def appendChannel(_):
+            raise IOError('cannot write directory')
+
         def setBytes(_, b):
             raise IOError('cannot write directory')
 
+        def renameTo(_, other):
+            raise IOError('cannot rename list directory')
+
         def mkDir(_):
             raise IOError('cannot make list directory')
 
@@ -331,8 +375,8 @@ class ListEditable(ESuite):
         def delete(_):
             raise IOError('cannot delete list directory')
 
-        return cls.make(ro, subEdFiles, subEdFile, outChannel,
-                        setBytes, mkDir, createNewFile, delete,
+        return cls.make(ro, subEdFiles, subEdFile, outChannel, appendChannel,
+                        setBytes, renameTo, mkDir, createNewFile, delete,
                         __div__=subEdFile,
                         __trueDiv=subEdFile)
 
@@ -386,9 +430,15 @@ class ConfigEd(ESuite, ConfigDir):
         def outChannel(_):
             raise IOError()
 
+        def appendChannel(_):
+            raise IOError()
+
         def setBytes(_):
             raise IOError()
 
+        def renameTo(_, other):
+            raise IOError('cannot rename config directory')
+
         def mkDir(_):
             raise IOError('cannot make config directory')
 
@@ -398,8 +448,8 @@ class ConfigEd(ESuite, ConfigDir):
         def delete(_):
             raise IOError('cannot delete config directory')
 
-        return cls.make(ro, subEdFiles, subEdFile, outChannel,
-                        setBytes, mkDir, createNewFile, delete,
+        return cls.make(ro, subEdFiles, subEdFile, outChannel, appendChannel,
+                        setBytes, renameTo, mkDir, createNewFile, delete,
                         __div__=subEdFile,
                         __trueDiv=subEdFile)
 
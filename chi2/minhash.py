@@ -0,0 +1,118 @@
+'''minhash -- MinHash signatures and LSH bands for concept similarity
+.................................................................
+
+The patients with a concept and the patients in a cohort are sets;
+their Jaccard similarity is estimated by the fraction of agreeing
+components of their MinHash signatures. Signature component i of a
+set of patient_nums is the least `(a_i * pn^2 + b_i * pn + c_i) mod PRIME`.
+(Linear hashes are not nearly min-wise independent over runs of
+consecutive patient_nums, which are common.)
+
+  >>> params = hash_params(64)
+  >>> cohort = range(0, 3000)
+  >>> similar = range(500, 3500)     # Jaccard: 2500 / 3500 = 0.71
+  >>> other = range(2500, 9000)      # Jaccard: 500 / 9000 = 0.06
+  >>> sig = signature(cohort, params)
+  >>> abs(estimate(sig, signature(similar, params)) - 2500 / 3500.0) < 0.15
+  True
+  >>> abs(estimate(sig, signature(other, params)) - 500 / 9000.0) < 0.15
+  True
+
+The same signatures can be computed by the database, in one grouped
+pass, e.g. over chi_pconcepts:
+
+  >>> print signature_sql(params[:2])
+  min(mod(pn * pn * 288545017 + pn * 1819850091 + 1640193504, 2147483647)) h0
+  , min(mod(pn * pn * 547756562 + pn * 1063938747 + 965274711, 2147483647)) h1
+
+Locality-sensitive hashing: split signatures into bands; sets that
+agree on all of any one band are candidates. With 16 bands of 4,
+sets with Jaccard 0.7 are nearly always candidates, and sets with
+Jaccard 0.1 rarely:
+
+  >>> round(candidate_probability(0.7, 16), 2), round(candidate_probability(0.1, 16), 4)
+  (0.99, 0.0016)
+  >>> keys = band_keys(sig, 16)
+  >>> len(keys), keys[0][0]
+  (16, 0)
+  >>> any(k in band_keys(signature(similar, params), 16) for k in keys)
+  True
+
+'''
+
+import random
+
+# a * pn^2 + b * pn + c stays within the 38 digits of an Oracle NUMBER
+PRIME = 2147483647  # 2 ** 31 - 1
+
+# Changing these means rebuilding the signature tables.
+NUM_HASHES = 64
+NUM_BANDS = 16
+SEED = 1
+
+
+def hash_params(num_hashes=NUM_HASHES, seed=SEED):
+    '''Coefficients (a, b, c) of the hash functions.
+    '''
+    rng = random.Random(seed)
+    return [(rng.randrange(1, PRIME), rng.randrange(0, PRIME),
+             rng.randrange(0, PRIME))
+            for _ in range(num_hashes)]
+
+
+def signature(nums, params):
+    '''MinHash signature of a set of patient_nums, in python.
+
+    :type nums: Iterable[Int]
+    :rtype: Seq[Int]
+    '''
+    sig = [PRIME] * len(params)
+    for pn in nums:
+        for ix, (a, b, c) in enumerate(params):
+            h = (a * pn * pn + b * pn + c) % PRIME
+            if h < sig[ix]:
+                sig[ix] = h
+    return sig
+
+
+def signature_sql(params, col='pn'):
+    '''SQL select-list for the signature of each group of rows.
+    '''
+    return '\n, '.join(['min(mod({0} * {0} * {1} + {0} * {2} + {3}, {4})) h{5}'.format(
+        col, a, b, c, PRIME, ix) for ix, (a, b, c) in enumerate(params)])
+
+
+def band_keys(sig, num_bands=NUM_BANDS):
+    '''(band, bucket) keys of a signature.
+
+    :rtype: Seq[(Int, String)]
+    '''
+    rows = len(sig) // num_bands
+    # int(): the database may hand back numbers as floats
+    return [(band, ':'.join([str(int(h)) for h in sig[band * rows:(band + 1) * rows]]))
+            for band in range(num_bands)]
+
+
+def band_sql(table, num_hashes=NUM_HASHES, num_bands=NUM_BANDS):
+    '''SQL for the (band, bucket, ccd) rows of a signature table,
+    with buckets as band_keys makes them.
+    '''
+    rows = num_hashes // num_bands
+    return '\nunion all\n'.join([
+        "select {0} band, {1} bucket, ccd from {2}".format(
+            band, " || ':' || ".join(['h{0}'.format(band * rows + ix)
+                                      for ix in range(rows)]), table)
+        for band in range(num_bands)])
+
+
+def estimate(sig1, sig2):
+    '''Estimate Jaccard similarity from signatures.
+    '''
+    return sum(1 for h1, h2 in zip(sig1, sig2) if h1 == h2) / float(len(sig1))
+
+
+def candidate_probability(jaccard, num_bands=NUM_BANDS, num_hashes=NUM_HASHES):
+    '''Chance that sets with this similarity share a band.
+    '''
+    rows = num_hashes // num_bands
+    return 1 - (1 - jaccard ** rows) ** num_bands
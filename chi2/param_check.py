@@ -8,17 +8,23 @@
 .. note:: @@I'm using spaces at the end of the line, which get flagged
           by pep8 and show up red in my emacs, to highlight TODOs.
 
+.. note:: chinotype (cx_Oracle, docopt) and paste are imported only
+          once a request needs them; cf. coldstart.py
+
 '''
 
 import json
 import logging
+from contextlib import contextmanager
+from datetime import datetime
 from functools import partial as pf_
+from itertools import chain
 
-import argh
-from paste.request import parse_formvars
 #from ocap import lafile
 import lafile
-from chinotype import Chi2
+import reqlog
+from jobctl import job_marker
+from admission import Admission, Rejected
 
 import i2b2hive
 
@@ -28,19 +34,63 @@ log = logging.getLogger(__name__)
 def cgi_main(argv, arg_wr, clock,
              mkCGIHandler, mkBrowser,
              queue_dir='queue',
+             cancel_dir='cancel',
+             admission_dir='admission',
+             pm_cache_dir='pm_cache',
+             flock=None, sleep=None, popen=None,
              log_name='chi2.log'):
 
 
     [hive_addr, pm_addr, request_log_dir] = argv[1:4]
     log_wr = arg_wr / request_log_dir
     queue_wr = log_wr / queue_dir
-    log_request = mk_log_request(log_wr, clock, 'logging')
+    cancel_wr = log_wr / cancel_dir
+    if not cancel_wr.ro().exists():
+        cancel_wr.mkDir()
+    log_request = reqlog.RequestLog(log_wr, clock, 'logging',
+                                    flock=flock).log_request
     queue_request = mk_log_request(queue_wr, clock, 'queueing')
     browser = mkBrowser()
-    account_check = i2b2hive.AccountCheck(hive_addr, pm_addr, browser)
-
-    job_setup = JobSetUp(account_check, queue_request)
-    app = WellFormedPost(job_setup, JobSetUp.mandatory_params, log_request)
+    pm_cache_wr = log_wr / pm_cache_dir
+    if not pm_cache_wr.ro().exists():
+        pm_cache_wr.mkDir()
+    pm_cache = i2b2hive.CredentialCache(pm_cache_wr, pf_(_seconds, clock))
+    account_check = i2b2hive.AccountCheck(hive_addr, pm_addr, browser,
+                                          cache=pm_cache)
+
+    admission = None
+    if flock:
+        # jobs from all the CGI processes share slots via locked files
+        admission_wr = log_wr / admission_dir
+        if not admission_wr.ro().exists():
+            admission_wr.mkDir()
+        admission = Admission(admission_wr, flock, pf_(_seconds, clock), sleep,
+                              per_user=_int_flag(argv, '--per-user', 2),
+                              slots=_int_flag(argv, '--slots', 4),
+                              max_wait=_int_flag(argv, '--max-wait', 120))
+
+    mk_patient_source = None
+    if '--pdo' in argv:
+        # read patient sets via the CRC cell rather than QT table grants
+        mk_patient_source = pf_(pdo_patient_source, hive_addr, browser)
+
+    job_setup = JobSetUp(account_check, queue_request,
+                         mk_patient_source=mk_patient_source,
+                         cancel_wr=cancel_wr, admission=admission,
+                         popen=popen)
+    page_setup = PageSetUp(account_check)
+    export_setup = ExportSetUp(account_check)
+    cancel_job = CancelJob(account_check, cancel_wr)
+    app = ByPath({
+        '/page': WellFormedPost(page_setup, PageSetUp.mandatory_params,
+                                log_request, PageSetUp.optional_params),
+        '/export': WellFormedPost(export_setup, ExportSetUp.mandatory_params,
+                                  log_request, ExportSetUp.optional_params),
+        '/cancel': WellFormedPost(cancel_job, CancelJob.mandatory_params,
+                                  log_request),
+        '/metrics': Metrics(admission)},
+        WellFormedPost(job_setup, JobSetUp.mandatory_params, log_request,
+                       JobSetUp.optional_params))
 
     cgi = mkCGIHandler(
         log_wr / log_name,
@@ -48,6 +98,29 @@ def cgi_main(argv, arg_wr, clock,
     cgi.run(app)
 
 
+def _int_flag(argv, name, default):
+    '''Find `--name=N` among args.
+
+    >>> _int_flag(['x.cgi', '--slots=8'], '--slots', 4)
+    8
+    >>> _int_flag(['x.cgi'], '--slots', 4)
+    4
+    '''
+    for arg in argv:
+        if arg.startswith(name + '='):
+            return int(arg[len(name) + 1:])
+    return default
+
+
+def _seconds(clock):
+    '''Adapt a datetime clock to one that counts seconds.
+
+    >>> _seconds(MockClock().now)
+    978307230.0
+    '''
+    return (clock() - datetime(1970, 1, 1)).total_seconds()
+
+
 #TODO: import from elsewhere to keep it from obscuring JobSetUp
 def decode_concepts(txt):
     concepts = json.loads(txt)
@@ -59,6 +132,102 @@ def decode_concepts(txt):
     return concepts
 
 
+def decode_psids(txt):
+    '''Decode a comma-separated list of patient set ids.
+
+    >>> decode_psids('123, 456,789')
+    ['123', '456', '789']
+    >>> decode_psids('123,all')
+    Traceback (most recent call last):
+      ...
+    ValueError: invalid literal for int() with base 10: 'all'
+    '''
+    return [str(int(psid)) for psid in txt.split(',') if psid.strip()]
+
+
+def decode_percent(txt):
+    '''Check a sample percentage is in (0, 100].
+
+    >>> decode_percent('2.5')
+    '2.5'
+    >>> decode_percent('150')
+    Traceback (most recent call last):
+      ...
+    ValueError: not a percentage of patients: 150
+    '''
+    from chinotype import valid_percent
+    if not valid_percent(txt):
+        raise ValueError('not a percentage of patients: %s' % txt)
+    return txt
+
+
+def decode_date(txt):
+    '''Check a date is YYYY-MM-DD.
+
+    >>> decode_date('2015-02-28')
+    '2015-02-28'
+    >>> decode_date('2015-02-30')
+    Traceback (most recent call last):
+      ...
+    ValueError: day is out of range for month
+    '''
+    return datetime.strptime(txt, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+
+def pdo_patient_source(hive_addr, browser,
+                       username, session_key, cells, project):
+    '''Make a patient set source from the CRC cell of an i2b2 session.
+
+    :param String project: i2b2 project the request is for
+    :return: patient_nums by result_instance_id
+    :rtype: (Int) => Iterable[Int]
+    '''
+    pdo = i2b2hive.PDOPatientSet(hive_addr, cells['CRC'], browser)
+    return lambda psid: pdo.patients((username, session_key),
+                                     project, int(psid))
+
+
+def route_project(requested, projects):
+    '''Choose the project, and so the chinotype tables, for a request.
+
+    Each project may have its own tables, maybe on its own database
+    host (see `chinotype.project_options`); a request goes to those of
+    the project it names, which must be one of the user's:
+
+      >>> route_project('ACT', ['Demo', 'ACT'])
+      'ACT'
+      >>> route_project('ACT', ['Demo'])
+      Traceback (most recent call last):
+        ...
+      NotAuthorized: not a member of project ACT
+
+    A client that names no project gets the user's first one:
+
+      >>> route_project(None, ['Demo', 'ACT'])
+      'Demo'
+      >>> route_project(None, []) is None
+      True
+
+    :param String requested: project named in the request, if any
+    :param projects: the user's projects, per the PM cell
+    :type projects: Seq[String]
+    '''
+    if requested:
+        if requested not in projects:
+            raise NotAuthorized('not a member of project %s' % requested)
+        return requested
+    return projects[0] if projects else None
+
+
+def project_args(project):
+    '''chinotype args to use a project's tables.
+
+    >>> project_args('ACT'), project_args(None)
+    (['--project', 'ACT'], [])
+    '''
+    return ['--project', project] if project else []
+
+
 class JobSetUp(object):
     mandatory_params = [('pgsize', None),
                         ('cutoff', int),
@@ -66,16 +235,53 @@ class JobSetUp(object):
                         ('patient_set_2', int),
                         ('concepts', None),
                         ('extant', int)]
+    # job_id: chosen by the client, to cancel the job by
+    # project: i2b2 project of the patient sets (see `route_project`)
+    # preview: answer first from a sample of this percent of patients
+    # matrix: patient sets to compare pairwise, in place of patient_set_*;
+    # versus_first=1 compares each with the first only
+    # since, until: count only facts in this window (YYYY-MM-DD)
+    # similar=1: find the concepts whose patients are most like patient_set_2
+    optional_params = [('job_id', None), ('project', None),
+                       ('preview', decode_percent),
+                       ('matrix', decode_psids), ('versus_first', int),
+                       ('since', decode_date), ('until', decode_date),
+                       ('similar', int)]
 
     def __init__(self, account_check, queue_request,
-                 out_key='str'):
+                 out_key='str', mk_patient_source=None, cancel_wr=None,
+                 admission=None, popen=None):
         '''JobSetUp constructor
 
         :type account_check: i2b2pm.AccountCheck
         :param queue_request: access to queue requests
         :param String out_key: object key where HTTP client
                                expects to find job summary
+        :param mk_patient_source: optional access to patient sets
+                                  given an authorized i2b2 session
+                                  and project
+        :type mk_patient_source: (String, String, Dict[String, String],
+                                  String) => (Int) => Iterable[Int]
+        :param cancel_wr: optional access to the markers of cancelled jobs
+        :type cancel_wr: lafile.Editable
+        :param admission: optional bounds on jobs running at once
+        :type admission: admission.Admission
+        :param popen: optional access to start processes, a la
+                      `subprocess.Popen`, for the exact run that
+                      follows a preview
         '''
+        self._admit = admission.admit if admission else _admit_all
+
+        def background_args(username, job_id):
+            '''Arguments for the exact run after a preview: to take a
+            job slot, and to be cancelled, as this job would be.
+            '''
+            args = admission.process_args(username) if admission else []
+            if job_id and cancel_wr:
+                args += ['--cancel-file',
+                         (cancel_wr / job_marker(username, job_id)).ro().fullPath()]
+            return args
+
         '''
         def queue(username, filename, **job_info):
             queue_request(username, dict(job_info,
@@ -86,30 +292,84 @@ class JobSetUp(object):
 
         self.queue_if_authz = account_check.restrict(lambda *args: queue)
         '''
-        def do_job(username, patient_set_1, patient_set_2, pgsize, cutoff, concepts, extant, **job_info):
-            log.info('running job for user=%s, patient_set_1=%s, patient_set_2=%s', \
-                username, patient_set_1, patient_set_2)
-            args = ['-j', '-x', cutoff, '-n', pgsize]
+        def do_job(username, patient_set_1, patient_set_2, pgsize, cutoff, concepts, extant,
+                   projects=(), mk_source=None, job_id=None, project=None,
+                   preview=None, matrix=None, versus_first=None,
+                   since=None, until=None, similar=None, **job_info):
+            project = route_project(project, projects)
+            log.info('running job for user=%s, project=%s, patient_set_1=%s, patient_set_2=%s', \
+                username, project, patient_set_1, patient_set_2)
+            from chinotype import Chi2, spawn_detached
+            # PDO requests need a project; without one, read the QT tables
+            patient_source = mk_source(project) if mk_source and project else None
+            cancelled = None
+            if job_id and cancel_wr:
+                marker_wr = cancel_wr / job_marker(username, job_id)
+                cancelled = marker_wr.ro().exists
+            args = ['-j', '-x', cutoff, '-n', pgsize] + project_args(project)
             if len(concepts) > 0:
                 args.extend(['-f', [concepts]])
             if extant:
                 args.extend(['-e'])
-            if patient_set_1 == 0:
+            if matrix:
+                args.extend(['-s', matrix])
+                if versus_first:
+                    args.extend(['-a'])
+                run = lambda chi: chi.runMatrix()
+            elif similar:
+                args.extend(['-l', '-p', patient_set_2])
+                run = lambda chi: chi.runSimilar()
+            elif patient_set_1 == 0:
                 args.extend(['-p', patient_set_2])
-                chistr = Chi2(listargs=args).runPSID()
+                run = lambda chi: chi.runPSID()
             else:
                 args.extend(['-r', patient_set_1])
                 args.extend(['-t', patient_set_2])
-                chistr = Chi2(listargs=args).runPSID_p2()
+                run = lambda chi: chi.runPSID_p2()
+            if (since or until) and not (matrix or similar):
+                for k, v in [('--since', since), ('--until', until)]:
+                    if v:
+                        args.extend([k, v])
+                run = lambda chi: chi.runWindow()
+            spawn = None
+            # previews sample whole patient sets; windows are run exactly
+            if preview and not (matrix or similar or since or until):
+                args.extend(['--preview', preview])
+                run = lambda chi: chi.runPreview()
+                if popen:
+                    extra = background_args(username, job_id)
+                    spawn = lambda exact: spawn_detached(popen, exact + extra)
+            chi = lambda prep: Chi2(listargs=args, patient_source=patient_source,
+                                    spawn=spawn, cancelled=cancelled, prep=prep)
+            # Jobs on sets whose chi columns exist only read stored
+            # counts; windows count facts anew.
+            psids = matrix or [ps for ps in [patient_set_1, patient_set_2] if ps]
+            quick = extant or (not (since or until) and
+                               chi(False).hasColumns(psids))
+            try:
+                with self._admit(username, priority=0 if quick else 1):
+                    chistr = run(chi(True))
+            finally:
+                if cancelled and cancelled():
+                    marker_wr.delete()
             chijson = json.loads(chistr)
             log.info('response=%s', chijson['status'])
             return { out_key: chistr }
  
-        self.do_if_authz = account_check.restrict(lambda *args: do_job)
+        def authorized(username, session_key, cells, projects):
+            if mk_patient_source is None:
+                return pf_(do_job, projects=projects)
+            return pf_(do_job, projects=projects, mk_source=pf_(
+                mk_patient_source, username, session_key, cells))
+
+        self.do_if_authz = account_check.restrict(authorized)
 
     def __call__(self, env, start_response,
                  username, password,
-                 pgsize, cutoff, patient_set_1, patient_set_2, concepts, extant):
+                 pgsize, cutoff, patient_set_1, patient_set_2, concepts, extant,
+                 job_id=None, project=None, preview=None,
+                 matrix=None, versus_first=None, since=None, until=None,
+                 similar=None):
         '''Handle HTTP request per `WSGI`__.
 
         __ http://www.python.org/dev/peps/pep-0333/
@@ -125,6 +385,22 @@ class JobSetUp(object):
         :param String patient_set_2: patient_set id (numeral)
         :param String concepts: concept_prefix filter (String)
         :param String: use only existing data? true=1/false=0 (numeral)
+        :param String job_id: optional, to cancel the job by (see `CancelJob`)
+        :param String project: optional i2b2 project (see `route_project`)
+        :param String preview: optional sample percentage (see
+                              `chinotype.Chi2.runPreview`)
+        :param matrix: optional patient set ids to compare pairwise (see
+                       `chinotype.Chi2.runMatrix`), in place of
+                       patient_set_1 and patient_set_2
+        :type matrix: Seq[String]
+        :param Int versus_first: with matrix, 1 to compare each set
+                                 with the first only
+        :param String since: optional first day (YYYY-MM-DD) of facts
+                             to count (see `chinotype.Chi2.runWindow`)
+        :param String until: optional last day of facts to count
+        :param Int similar: optional; 1 to find the concepts whose
+                            patients are most like patient_set_2 (see
+                            `chinotype.Chi2.runSimilar`)
 
         :rtype: Iterable[String]
         '''
@@ -138,13 +414,262 @@ class JobSetUp(object):
             raise NotAuthorized(ex)
 
         log.debug('i2b2 credentials OK for %s', username)
-        out = do_job(username, patient_set_1, patient_set_2, pgsize, cutoff, concepts, extant)
+        out = do_job(username, patient_set_1, patient_set_2, pgsize, cutoff, concepts, extant,
+                     job_id=job_id, project=project, preview=preview,
+                     matrix=matrix, versus_first=versus_first,
+                     since=since, until=until, similar=similar)
+
+        start_response('200 OK',
+                       [('content-type', 'application/json')])
+        return [json.dumps(out)]
+
+
+class PageSetUp(object):
+    '''Serve a page of stored results by keyset.
+
+    The first run of a comparison stores its full ranking (see
+    `chinotype.Chi2.storeResults`); a page is then an indexed read
+    of the `pgsize` rows ranked after `after`, whatever the page size.
+    '''
+    mandatory_params = [('pgsize', int),
+                        ('cutoff', int),
+                        ('patient_set_1', int),
+                        ('patient_set_2', int),
+                        ('concepts', None),
+                        ('after', int),
+                        ('direction', None)]
+    optional_params = [('project', None)]
+
+    def __init__(self, account_check,
+                 out_key='str'):
+        '''
+        :type account_check: i2b2pm.AccountCheck
+        :param String out_key: object key where HTTP client
+                               expects to find the page
+        '''
+        def do_page(username, patient_set_1, patient_set_2, pgsize, cutoff,
+                    concepts, after, direction, project, projects=()):
+            project = route_project(project, projects)
+            log.info('page for user=%s, project=%s, patient_set_1=%s,'
+                     ' patient_set_2=%s, after %s %s', username, project,
+                     patient_set_1, patient_set_2, direction, after)
+            from chinotype import Chi2
+            args = ['-j', '-x', str(cutoff), '-n', str(pgsize),
+                    '-k', str(after), '-d', direction] + project_args(project)
+            if len(concepts) > 0:
+                args.extend(['-f', concepts])
+            if patient_set_1 == 0:
+                args.extend(['-p', str(patient_set_2)])
+            else:
+                args.extend(['-t', str(patient_set_2),
+                             '-r', str(patient_set_1)])
+            return {out_key: Chi2(listargs=args).runPage()}
+
+        self.page_if_authz = account_check.restrict(
+            lambda username, session_key, cells, projects:
+            pf_(do_page, projects=projects))
+
+    def __call__(self, env, start_response,
+                 username, password,
+                 pgsize, cutoff, patient_set_1, patient_set_2, concepts,
+                 after, direction, project=None):
+        '''Handle HTTP request per `WSGI`__.
+
+        __ http://www.python.org/dev/peps/pep-0333/
+
+        :param Int after: rank of the last row of the previous page;
+                          0 for the first page
+        :param String direction: `over` or `under` (-represented)
+
+        Other parameters are as in `JobSetUp`.
+
+        :rtype: Iterable[String]
+        '''
+        if direction not in ('over', 'under'):
+            raise ValueError('direction: over or under, not %s' % direction)
+        log.info('checking i2b2 password for: %s', username)
+        try:
+            password = i2b2hive.pw_decode(password)
+            do_page = self.page_if_authz((username, password))
+        except (i2b2hive.HiveError, ValueError) as ex:
+            raise NotAuthorized(ex)
+
+        out = do_page(username, patient_set_1, patient_set_2, pgsize, cutoff,
+                      concepts, after, direction, project)
+        start_response('200 OK',
+                       [('content-type', 'application/json')])
+        return [json.dumps(out)]
+
+
+class ExportSetUp(object):
+    '''Stream all the stored results of a comparison as CSV.
+
+    The browser saves the response as it arrives, rather than building
+    the file in memory from one big JSON response.
+    '''
+    mandatory_params = [('cutoff', int),
+                        ('patient_set_1', int),
+                        ('patient_set_2', int),
+                        ('concepts', None),
+                        ('direction', None)]
+    optional_params = [('project', None)]
+
+    def __init__(self, account_check):
+        '''
+        :type account_check: i2b2pm.AccountCheck
+        '''
+        def do_export(username, patient_set_1, patient_set_2, cutoff,
+                      concepts, direction, project, projects=()):
+            project = route_project(project, projects)
+            log.info('export for user=%s, project=%s, patient_set_1=%s,'
+                     ' patient_set_2=%s', username, project,
+                     patient_set_1, patient_set_2)
+            from chinotype import Chi2
+            args = ['-x', str(cutoff), '-k', '0', '-d', direction] + \
+                project_args(project)
+            if len(concepts) > 0:
+                args.extend(['-f', concepts])
+            if patient_set_1 == 0:
+                args.extend(['-p', str(patient_set_2)])
+            else:
+                args.extend(['-t', str(patient_set_2),
+                             '-r', str(patient_set_1)])
+            return Chi2(listargs=args).exportCsv()
+
+        self.export_if_authz = account_check.restrict(
+            lambda username, session_key, cells, projects:
+            pf_(do_export, projects=projects))
+
+    def __call__(self, env, start_response,
+                 username, password,
+                 cutoff, patient_set_1, patient_set_2, concepts, direction,
+                 project=None):
+        '''Handle HTTP request per `WSGI`__.
+
+        __ http://www.python.org/dev/peps/pep-0333/
+
+        Parameters are as in `PageSetUp`.
+
+        :rtype: Iterable[String]
+        '''
+        if direction not in ('over', 'under'):
+            raise ValueError('direction: over or under, not %s' % direction)
+        try:
+            password = i2b2hive.pw_decode(password)
+            do_export = self.export_if_authz((username, password))
+        except (i2b2hive.HiveError, ValueError) as ex:
+            raise NotAuthorized(ex)
+
+        chunks = do_export(username, patient_set_1, patient_set_2, cutoff,
+                           concepts, direction, project)
+        try:
+            # find any error before the response starts
+            first = next(chunks)
+        except LookupError as ex:
+            start_response('404 not found',
+                           [('content-type', 'text/plain')])
+            return [str(ex)]
+        filename = 'chi2_%d_%d.csv' % (patient_set_1, patient_set_2)
+        start_response('200 OK',
+                       [('content-type', 'text/csv'),
+                        ('content-disposition',
+                         'attachment; filename="%s"' % filename)])
+        return chain([first], chunks)
+
+
+@contextmanager
+def _admit_all(username, priority):
+    yield
+
+
+class Metrics(object):
+    '''WSGI app to report admission metrics, as JSON.
+
+    The metrics are counts, not who asked for what, so any method
+    will do, without credentials.
+    '''
+    def __init__(self, admission):
+        '''
+        :type admission: admission.Admission
+        '''
+        self._admission = admission
+
+    def __call__(self, env, start_response):
+        out = self._admission.metrics() if self._admission else {}
+        start_response('200 OK',
+                       [('content-type', 'application/json')])
+        return [json.dumps(out)]
+
+
+class CancelJob(object):
+    '''Cancel a running job: its database call is interrupted, and what
+    it added for its cohort is dropped (see `jobctl.Watchdog`).
+
+    A user can cancel only their own jobs, as the marker is named by
+    username as well as job id.
+    '''
+    mandatory_params = [('job_id', None)]
+
+    def __init__(self, account_check, cancel_wr):
+        '''
+        :type account_check: i2b2pm.AccountCheck
+        :param lafile.Editable cancel_wr: access to the markers of
+                                          cancelled jobs
+        '''
+        def cancel(username, job_id):
+            log.info('cancelling job %s of %s', job_id, username)
+            (cancel_wr / job_marker(username, job_id)).setBytes('')
+            return {'status': 'cancelling'}
+
+        self.cancel_if_authz = account_check.restrict(
+            lambda username, session_key, cells, projects: cancel)
+
+    def __call__(self, env, start_response,
+                 username, password, job_id):
+        '''Handle HTTP request per `WSGI`__.
+
+        __ http://www.python.org/dev/peps/pep-0333/
+
+        :param String job_id: as given when the job was started
 
+        :rtype: Iterable[String]
+        '''
+        try:
+            password = i2b2hive.pw_decode(password)
+            cancel = self.cancel_if_authz((username, password))
+        except (i2b2hive.HiveError, ValueError) as ex:
+            raise NotAuthorized(ex)
+
+        out = cancel(username, job_id)
         start_response('200 OK',
                        [('content-type', 'application/json')])
         return [json.dumps(out)]
 
 
+class ByPath(object):
+    '''WSGI app to dispatch on PATH_INFO.
+
+      >>> hello = lambda env, start_response: ['hello']
+      >>> page = lambda env, start_response: ['page']
+      >>> app = ByPath({'/page': page}, hello)
+      >>> app({'PATH_INFO': '/page'}, None)
+      ['page']
+      >>> app({}, None)
+      ['hello']
+    '''
+    def __init__(self, apps, default):
+        '''
+        :param apps: apps by path, e.g. `/page`
+        :param default: app for any other path
+        '''
+        self._apps = apps
+        self._default = default
+
+    def __call__(self, env, start_response):
+        app = self._apps.get(env.get('PATH_INFO') or '/', self._default)
+        return app(env, start_response)
+
+
 class ClientError(IOError):
     '''HTTP 4xx errors
     '''
@@ -235,14 +760,17 @@ class WellFormedPost(object):
 
     mandatory_params = ['username', 'password']
 
-    def __init__(self, subApp, sub_params, log_request):
+    def __init__(self, subApp, sub_params, log_request,
+                 opt_params=()):
         '''
         :param log_request: access to log authorized requests
         :type log_request: (String, Dict[String, String]) => Unit
+        :param opt_params: parameters passed only if given, as `sub_params`
         '''
         self._subApp = subApp
         self._log_request = log_request
         self._sub_params = sub_params
+        self._opt_params = opt_params
 
     def __call__(self, env, start_response):
         '''Handle HTTP request per `WSGI`__.
@@ -264,6 +792,7 @@ class WellFormedPost(object):
                       env['REQUEST_METHOD'])
             return ['Bzzt. We only do POST.']
 
+        from paste.request import parse_formvars
         args = parse_formvars(env)
 
         identity = lambda x: x
@@ -275,13 +804,20 @@ class WellFormedPost(object):
             mvalues = dict([
                 (k, (txform or identity)(args[k]))
                 for (k, txform) in self._sub_params])
+            mvalues.update([
+                (k, (txform or identity)(args[k]))
+                for (k, txform) in self._opt_params if k in args])
         except (KeyError, ValueError) as ex:
             start_response('400 bad request',
                            [('content-type', 'text/plain')])
             log.error('incorrect credentials for %s', username)
             return ['Incorrect parameters:', str(ex)]
 
-        self._log_request(username, dict(args))
+        try:
+            self._log_request(username, dict(args))
+        except Exception as ex:
+            # the log is for the record; don't fail the request over it
+            log.error('could not log request of %s: %s', username, ex)
         try:
 	    #log.info('env=%s', env)
 	    #log.info('start_response=%s', start_response)
@@ -295,6 +831,12 @@ class WellFormedPost(object):
             start_response('403 not authorized',
                            [('content-type', 'text/plain')])
             return ['incorrect credentials']
+        except Rejected as ex:
+            log.warning('job of %s not admitted: %s', username, ex)
+            start_response(ex.status,
+                           [('content-type', 'text/plain'),
+                            ('retry-after', str(ex.retry_after))])
+            return [str(ex)]
         # For debugging, catch IOError instead
         except Exception, ex:
             log.critical('Error:', exc_info=ex)
@@ -304,7 +846,10 @@ class WellFormedPost(object):
 
 
 def mk_log_request(log_dir, clock, event_label):
-    '''
+    '''Log each request to a file of its own.
+
+    .. note:: On a busy server, prefer `reqlog.RequestLog`.
+
     :param lafile.Editable log_dir: access to write log files
     :param clock: access to date and time of day
     :type clock: () => datetime
@@ -366,7 +911,16 @@ if __name__ == '__main__':
         from datetime import datetime
         from wsgiref.handlers import CGIHandler
 
+        from fcntl import flock
+        from subprocess import Popen
+        from time import sleep
         from mechanize import Browser
+        import httppool
+
+        def mkBrowser():
+            if '--pool' in argv:
+                return httppool.HTTPPool(httppool.connect)
+            return Browser()
 
         def mkCGIHandler(log_wr,
                          level=logging.INFO):
@@ -382,7 +936,8 @@ if __name__ == '__main__':
             cgi_main(argv, arg_wr,
                      mkCGIHandler=mkCGIHandler,
                      clock=datetime.now,
-                     mkBrowser=lambda: Browser())
+                     mkBrowser=mkBrowser,
+                     flock=flock, sleep=sleep, popen=Popen)
                        
         else:  # We're running from the command line
             raise NotImplementedError('No CLI usage. CGI only.')
@@ -0,0 +1,153 @@
+'''planwatch -- record execution plans of the big statements; spot regressions
+..........................................................................
+
+A few statements (building chi_pconcepts and chi_pcounts, merging a
+new cohort into chi_pcounts, ranking the output) take most of
+chinotype's time, and when Oracle picks a new plan for one of them, it
+can take ten times as long. With a plans table (chi_plans), statements
+that `do_log_sql` runs with a `tag` get their plan, with actual row
+counts and times per plan step (dbms_xplan ALLSTATS LAST), recorded
+along with the plan hash and elapsed time.
+
+Each new record is checked against the earlier ones with the same tag
+(latest first): a different plan hash, or an elapsed time more than
+`factor` times the median, raise an alert (a warning in the log, and
+noted in the plans table):
+
+  >>> earlier = [(1234, 10.0), (1234, 12.0), (1234, 11.0)]
+  >>> alerts('new_cohort', 1234, 13.0, earlier)
+  []
+  >>> alerts('new_cohort', 5678, 40.0, earlier)
+  ... # doctest: +NORMALIZE_WHITESPACE
+  ['new_cohort: plan changed from 1234 to 5678',
+   'new_cohort: 40.0s is more than 3 times the median of 3 runs (11.0s)']
+  >>> alerts('new_cohort', 5678, 40.0, [])
+  []
+
+'''
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def alerts(tag, plan_hash, elapsed, earlier,
+           factor=3.0):
+    '''Check a statement's plan and time against earlier runs.
+
+    :param earlier: (plan_hash, elapsed) of earlier runs, latest first
+    :type earlier: Seq[(Int, Float)]
+    :rtype: Seq[String]
+    '''
+    out = []
+    if earlier and earlier[0][0] != plan_hash:
+        out.append('{0}: plan changed from {1} to {2}'.format(
+            tag, earlier[0][0], plan_hash))
+    if earlier:
+        typical = median([e for _, e in earlier])
+        if elapsed > factor * typical:
+            out.append('{0}: {1:.1f}s is more than {2:g} times the median '
+                       'of {3} runs ({4:.1f}s)'.format(
+                           tag, elapsed, factor, len(earlier), typical))
+    return out
+
+
+def median(xs):
+    '''
+    >>> median([3, 1, 2]), median([4, 1, 2, 3])
+    (2, 2.5)
+    '''
+    xs = sorted(xs)
+    mid = len(xs) // 2
+    return xs[mid] if len(xs) % 2 else (xs[mid - 1] + xs[mid]) / 2.0
+
+
+class PlanWatch(object):
+    '''Record plans of tagged statements in a table, and check them.
+
+    Reading plans needs select on v_$session, v_$sql, v_$sql_plan and
+    v_$sql_plan_statistics_all; without them, nothing is recorded.
+    '''
+    def __init__(self, table,
+                 factor=3.0, history=5):
+        '''
+        :param String table: plans table, as made by `create_sql`
+        :param Float factor: elapsed time over median that's a regression
+        :param Int history: number of earlier runs to compare with
+        '''
+        self.table = table
+        self.factor = factor
+        self.history = history
+
+    def create_sql(self):
+        return '''
+        create table {0} (
+          tag varchar2(30) not null
+        , run_at date default sysdate not null
+        , sql_id varchar2(13)
+        , child_number number
+        , plan_hash number
+        , elapsed number           -- seconds
+        , alert varchar2(1000)
+        , plan clob                -- dbms_xplan ALLSTATS LAST
+        )
+        '''.format(self.table)
+
+    def prepare(self, cur):
+        '''Have Oracle gather row-source statistics for the next statement.
+        '''
+        _execute(cur, 'alter session set statistics_level = all')
+
+    def capture(self, cur, tag, elapsed):
+        '''Record the plan of the statement just run on `cur`.
+
+        :return: alerts, as from `alerts`
+        '''
+        # Another cursor of the same session, so `cur` keeps its rowcount.
+        cur = cur.connection.cursor()
+        try:
+            # While this runs, prev_sql_id is the statement just run.
+            rows = _execute(cur, '''
+            select s.prev_sql_id, s.prev_child_number, q.plan_hash_value
+            from v$session s
+            join v$sql q on q.sql_id = s.prev_sql_id
+                        and q.child_number = s.prev_child_number
+            where s.sid = sys_context('userenv', 'sid')
+            ''')
+            if not rows:
+                log.debug('no plan found for %s', tag)
+                return []
+            sql_id, child, plan_hash = rows[0]
+            plan = '\n'.join([line or '' for (line,) in _execute(cur, '''
+            select plan_table_output
+            from table(dbms_xplan.display_cursor(:0, :1, 'ALLSTATS LAST'))
+            ''', [sql_id, child])])
+            earlier = _execute(cur, '''
+            select plan_hash, elapsed from (
+              select plan_hash, elapsed from {0} where tag = :0
+              order by run_at desc
+            ) where rownum <= {1}
+            '''.format(self.table, int(self.history)), [tag])
+            found = alerts(tag, plan_hash, elapsed, earlier, self.factor)
+            for msg in found:
+                log.warning(msg)
+            _execute(cur, '''
+            insert into {0} (tag, sql_id, child_number, plan_hash, elapsed, alert, plan)
+            values (:0, :1, :2, :3, :4, :5, :6)
+            '''.format(self.table),
+                     [tag, sql_id, child, plan_hash, elapsed,
+                      '; '.join(found)[:1000] or None, plan])
+            log.info('%s: plan %s, %.1fs', tag, plan_hash, elapsed)
+            return found
+        except Exception as ex:
+            log.warning('could not record plan of %s: %s', tag, ex)
+            return []
+        finally:
+            _execute(cur, 'alter session set statistics_level = typical')
+            cur.close()
+
+
+def _execute(cur, sql, params=[]):
+    log.debug('    execute: %s', sql)
+    cur.execute(sql, params)
+    return cur.fetchall() if cur.description else None
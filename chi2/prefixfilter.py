@@ -0,0 +1,80 @@
+'''prefixfilter -- resolve -f concept patterns to scheme prefixes
+..............................................................
+
+Concept counts are filtered by data domain: each `-f` pattern selects
+the schemes (from `chi_schemes`) whose `c_key` starts with it. Rather
+than join every counts query with `c_key like :n || '%'`, resolve the
+patterns once per job, in one query of the (small) schemes table:
+
+  >>> sql, params = scheme_sql('chi_schemes', ['\\\\i2b2\\\\Diag', 'ND'])
+  >>> print sql
+  select distinct c_name from chi_schemes
+  where c_key like :0 || '%' or c_key like :1 || '%'
+  >>> params
+  ['\\\\i2b2\\\\Diag', 'ND']
+
+`ALL` (or no pattern at all) selects every scheme:
+
+  >>> scheme_sql('chi_schemes', ['ALL']) == scheme_sql('chi_schemes', [])
+  True
+  >>> print scheme_sql('chi_schemes', [])[0]
+  select distinct c_name from chi_schemes
+
+Then push the resolved prefixes down to the counts scan as an IN-list
+of bind variables, which the (prefix, ccd, total) key serves:
+
+  >>> in_list('prefix', ['ICD10', 'ICD9'])
+  ('prefix in (:0, :1)', ['ICD10', 'ICD9'])
+  >>> in_list('prefix', [])
+  ('1=0', [])
+
+Oracle takes at most 1000 expressions in a list, so longer lists are
+split:
+
+  >>> sql, params = in_list('prefix', [str(n) for n in range(1001)])
+  >>> sql.count(' in ('), sql.count(':'), len(params)
+  (2, 1001, 1001)
+
+'''
+
+# Oracle: ORA-01795: maximum number of expressions in a list is 1000
+MAX_IN_LIST = 1000
+
+
+def scheme_sql(schemes, patterns):
+    '''Make a query for the names of schemes whose keys start with
+    any pattern.
+
+    :param String schemes: chi_schemes table
+    :param Seq[String] patterns: key prefixes; `ALL` matches any key,
+                                 as does an empty list
+    :return: SQL and its bind parameters
+    :rtype: (String, Seq[String])
+    '''
+    patterns = list(patterns)
+    sql = 'select distinct c_name from {0}'.format(schemes)
+    if not patterns or 'ALL' in patterns:
+        return sql, []
+    return (sql + '\nwhere ' + ' or '.join(
+        ["c_key like :{0} || '%'".format(ix) for ix in range(len(patterns))]),
+            patterns)
+
+
+def in_list(column, values,
+            start=0):
+    '''Make an SQL condition that `column` is one of `values`.
+
+    :param Int start: number of the first bind variable
+    :return: SQL condition and its bind parameters
+    :rtype: (String, Seq[String])
+    '''
+    values = list(values)
+    if not values:
+        return '1=0', []
+    terms = []
+    for lo in range(0, len(values), MAX_IN_LIST):
+        chunk = range(lo, min(lo + MAX_IN_LIST, len(values)))
+        terms.append('{0} in ({1})'.format(
+            column, ', '.join([':{0}'.format(start + ix) for ix in chunk])))
+    sql = terms[0] if len(terms) == 1 else '(' + ' or '.join(terms) + ')'
+    return sql, values
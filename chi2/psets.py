@@ -0,0 +1,266 @@
+'''psets -- patient-set algebra on sorted arrays
+.............................................
+
+A `PatientSet` holds its patient_nums sorted, in an `array`, so it
+takes 8 bytes per patient whatever the patient_nums are, and union,
+intersection, difference and subset tests are each one merge pass
+over both sets:
+
+  >>> test = PatientSet.from_nums([11, 2, 3, 5, 7, 3])
+  >>> ref = PatientSet.from_nums(range(1, 10))
+  >>> len(test), len(ref)
+  (5, 9)
+  >>> list(test & ref), list(test - ref)
+  ([2, 3, 5, 7], [11])
+  >>> list(test | PatientSet.from_nums([1, 100]))
+  [1, 2, 3, 5, 7, 11, 100]
+  >>> test.issubset(ref), (test & ref).issubset(ref)
+  (False, True)
+
+Far-apart patient_nums cost no more than close ones:
+
+  >>> big = PatientSet.from_nums([3, 10 ** 12])
+  >>> len(big), list(big & test)
+  (2, [3])
+
+`PatientSets` loads sets (e.g. i2b2 result instances) on demand and
+keeps the most recently used ones:
+
+  >>> qt = {101: [2, 3, 5, 7, 11], 102: range(1, 10), 103: [5, 6, 7]}
+  >>> def load(psid):
+  ...     print 'loading', psid
+  ...     return qt[psid]
+  >>> psets = PatientSets(load, max_entries=2)
+  >>> psets.get(101).issubset(psets.get(102))
+  loading 101
+  loading 102
+  False
+  >>> len(psets.get(101))
+  5
+  >>> list(psets.get(103) - psets.get(101))
+  loading 103
+  [6]
+
+  >>> sorted(psets.stats().items())
+  ... # doctest: +NORMALIZE_WHITESPACE
+  [('evictions', 1), ('hits', 2), ('misses', 3), ('shared_hits', 0),
+   ('size', 2)]
+
+Each CGI request is a process of its own, so a cache in memory rarely
+lasts from one job to the next. Result instances never change once
+made, so loaded sets can be kept in a `SetStore`, a directory shared
+by all the processes:
+
+  >>> import os, tempfile, shutil
+  >>> import lafile
+  >>> tmp = tempfile.mkdtemp()
+  >>> store = SetStore(lafile.Editable(tmp, os, open), max_entries=2)
+  >>> list(PatientSets(load, store=store).get(101))
+  loading 101
+  [2, 3, 5, 7, 11]
+
+A later process finds it there, without loading it again:
+
+  >>> later = PatientSets(load, store=store)
+  >>> later.cached(101), later.cached(102)
+  (True, False)
+  >>> list(later.get(101))
+  [2, 3, 5, 7, 11]
+  >>> later.stats()['shared_hits']
+  1
+
+Beyond `max_entries`, the sets stored longest ago are dropped:
+
+  >>> for psid in [102, 103]:
+  ...     os.utime(os.path.join(tmp, '101'), (1, 1))
+  ...     _ = later.get(psid)
+  loading 102
+  loading 103
+  >>> sorted(os.listdir(tmp))
+  ['102', '103']
+  >>> shutil.rmtree(tmp)
+
+'''
+
+import logging
+import os
+from array import array
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class PatientSet(object):
+    '''Immutable set of patient_nums, sorted.
+    '''
+    def __init__(self, nums):
+        '''
+        :param array nums: patient_nums, ascending, without duplicates
+        '''
+        self.nums = nums
+
+    @classmethod
+    def from_nums(cls, nums):
+        '''
+        :type nums: Iterable[Int]
+        '''
+        return cls(array('l', sorted(set(nums))))
+
+    def __len__(self):
+        return len(self.nums)
+
+    def __iter__(self):
+        '''Generate the patient_nums in ascending order.
+        '''
+        return iter(self.nums)
+
+    def __or__(self, other):
+        return PatientSet(_merge(self.nums, other.nums, True, True, True))
+
+    def __and__(self, other):
+        return PatientSet(_merge(self.nums, other.nums, False, True, False))
+
+    def __sub__(self, other):
+        return PatientSet(_merge(self.nums, other.nums, True, False, False))
+
+    def __eq__(self, other):
+        return isinstance(other, PatientSet) and self.nums == other.nums
+
+    def __ne__(self, other):
+        return not self == other
+
+    def issubset(self, other):
+        return len(_merge(self.nums, other.nums, True, False, False)) == 0
+
+
+def _merge(a, b, only_a, both, only_b):
+    '''Merge two ascending arrays, keeping the elements that are
+    only in `a`, in both, and/or only in `b`.
+    '''
+    out = array('l')
+    i, j, na, nb = 0, 0, len(a), len(b)
+    while i < na and j < nb:
+        x, y = a[i], b[j]
+        if x < y:
+            if only_a:
+                out.append(x)
+            i += 1
+        elif y < x:
+            if only_b:
+                out.append(y)
+            j += 1
+        else:
+            if both:
+                out.append(x)
+            i += 1
+            j += 1
+    if only_a:
+        out.extend(a[i:])
+    if only_b:
+        out.extend(b[j:])
+    return out
+
+
+class PatientSets(object):
+    '''Patient sets by id, loaded on demand, least recently used evicted.
+
+    '''
+    def __init__(self, load, max_entries=32, store=None):
+        '''
+        :param load: access to the patient_nums of a patient set
+        :type load: (Int) => Iterable[Int]
+        :param Int max_entries: bound on number of cached sets
+        :param SetStore store: optional cache shared between processes
+        '''
+        self._load = load
+        self._max_entries = max_entries
+        self._store = store
+        self._entries = OrderedDict()
+        self._counts = dict(hits=0, misses=0, evictions=0, shared_hits=0)
+
+    def cached(self, key):
+        '''Can the set be had without loading it?
+        '''
+        return key in self._entries or (
+            self._store is not None and self._store.has(key))
+
+    def get(self, key):
+        '''Get a patient set, loading it if need be.
+
+        :rtype: PatientSet
+        '''
+        pset = self._entries.pop(key, None)
+        if pset is None and self._store is not None:
+            pset = self._store.get(key)
+            if pset is not None:
+                self._counts['shared_hits'] += 1
+        if pset is None:
+            self._counts['misses'] += 1
+            pset = PatientSet.from_nums(self._load(key))
+            log.info('loaded patient set %s: %d patients', key, len(pset))
+            if self._store is not None:
+                self._store.put(key, pset)
+        else:
+            self._counts['hits'] += 1
+        self._entries[key] = pset  # most recently used goes last
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self._counts['evictions'] += 1
+        return pset
+
+    def stats(self):
+        return dict(self._counts, size=len(self._entries))
+
+
+class SetStore(object):
+    '''Patient sets in files, one per set, shared between processes.
+    '''
+    def __init__(self, dir_wr, max_entries=200):
+        '''
+        :param lafile.Editable dir_wr: access to the set files
+        :param Int max_entries: bound on number of stored sets
+        '''
+        self._dir = dir_wr
+        self._max_entries = max_entries
+
+    def has(self, key):
+        return (self._dir / str(key)).ro().exists()
+
+    def get(self, key):
+        '''
+        :rtype: Option[PatientSet]
+        '''
+        try:
+            data = (self._dir / str(key)).ro().getBytes()
+        except (IOError, OSError):
+            return None  # not there, or removed meanwhile
+        nums = array('l')
+        nums.fromstring(data)
+        return PatientSet(nums)
+
+    def put(self, key, pset):
+        # readers never see a partial file
+        tmp = self._dir / ('.%s.%d.tmp' % (key, os.getpid()))
+        with tmp.outChannel() as out:
+            out.write(pset.nums.tostring())
+        tmp.renameTo(self._dir / str(key))
+        self._prune()
+
+    def _prune(self):
+        '''Drop the sets stored longest ago, beyond `max_entries`.
+        '''
+        stored = []
+        for rd in self._dir.ro().subRdFiles():
+            name = rd.fullPath().rsplit('/', 1)[-1]
+            if name.startswith('.'):
+                continue
+            try:
+                stored.append((rd.lastModified(), name))
+            except OSError:
+                pass  # removed meanwhile
+        stored.sort()
+        for _, name in stored[:max(0, len(stored) - self._max_entries)]:
+            try:
+                (self._dir / name).delete()
+            except OSError:
+                pass  # another process beat us to it
@@ -0,0 +1,221 @@
+'''replicas -- send read-only queries to standby databases, within limits
+...................................................................
+
+Looking up patient sets in the QT tables, and reading rankings, needn't
+load the primary databases; read-only standbys (Oracle Active Data
+Guard) will do, as long as they aren't too far behind. How far behind
+is acceptable depends on the class of query: a patient set, once made,
+never changes, while a ranking may have been stored a moment ago. The
+limits, in seconds, by query class, are in the same `name=seconds`
+form as call time budgets (cf. `jobctl.parse_budgets`); a class with
+no limit, or 0, always goes to the primary.
+
+A `Router` tries the standbys in turn and takes the first one that
+answers and whose apply lag is within the limit. Let's make some
+connections, with the lag each one reports:
+
+  >>> class Conn(object):
+  ...     def __init__(self, name, lag):
+  ...         self.name, self.lag = name, lag
+  >>> def connect(name, lag=None, up=True):
+  ...     def it():
+  ...         if not up:
+  ...             raise IOError('%s is down' % name)
+  ...         return Conn(name, lag)
+  ...     return it
+  >>> now = [1000.0]
+  >>> router = Router(connect('primary'),
+  ...                 [connect('standby1', up=False),
+  ...                  connect('standby2', lag=30.0)],
+  ...                 {'qt': 300, 'ranking': 10},
+  ...                 clock=lambda: now[0], lag=lambda conn: conn.lag)
+  >>> where = lambda connect: connect().name
+
+Patient set lookups go to the first standby that's up:
+
+  >>> router.read('qt', where)
+  'standby2'
+
+but standby2 is too far behind to rank results, and other queries
+always go to the primary:
+
+  >>> router.read('ranking', where), router.read('cohort', where)
+  ('primary', 'primary')
+
+A job reads its own writes: once it writes to the primary, a standby
+must have caught up since:
+
+  >>> router.wrote()
+  >>> now[0] += 20
+  >>> router.read('qt', where)
+  'primary'
+  >>> now[0] += 20
+  >>> router.read('qt', where)
+  'standby2'
+
+When a query fails on a standby, or finds nothing, which may be only
+because the standby is behind, it's run again on the primary:
+
+  >>> router.read('qt', lambda connect: connect().name == 'primary' or None,
+  ...             found=bool)
+  True
+
+'''
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# seconds behind the primary a standby may be, by query class
+STALENESS_DEFAULT = 'qt=300,patients=3600,ranking=60'
+
+# seconds not to try a standby again after it fails
+RETRY_DOWN = 60.0
+
+
+class Router(object):
+    '''Route read-only queries to standbys fit for their class.
+    '''
+    def __init__(self, primary, standbys, staleness, clock, lag,
+                 start=0, fatal=()):
+        '''
+        :param primary: access to connect to the primary
+        :type primary: () => Connection
+        :param standbys: access to connect to each standby
+        :type standbys: Seq[() => Connection]
+        :param staleness: seconds each class of query may lag the primary
+        :type staleness: Dict[String, Float]
+        :param clock: access to the time, in seconds
+        :type clock: () => Float
+        :param lag: access to how far behind a standby is, in seconds;
+                    None if it can't tell
+        :type lag: (Connection) => Option[Float]
+        :param Int start: which standby to try first, to spread load
+        :param fatal: exception types to raise, not fail over on
+                      (e.g. cancellation)
+        '''
+        self._primary = primary
+        self._standbys = standbys
+        self._staleness = staleness
+        self._clock = clock
+        self._lag = lag
+        self._start = start
+        self._fatal = fatal
+        self._down = {}  # standby index: time to try it again
+        self._written_at = None
+
+    def wrote(self):
+        '''Note that the job wrote to the primary, so standbys must
+        have caught up since to serve its reads.
+        '''
+        self._written_at = self._clock()
+
+    def read(self, query_class, run,
+             found=lambda out: True):
+        '''Run a read-only query on a standby fit for its class, else on
+        the primary.
+
+        :param run: the query, given access to connect
+        :type run: (() => Connection) => T
+        :param found: whether `run` found what it looked for; if not,
+                      it's run again on the primary
+        :type found: (T) => Boolean
+        :rtype: T
+        :forall: T
+        '''
+        standby = self._choose(query_class)
+        if standby is not None:
+            ix, conn = standby
+            try:
+                out = run(lambda: conn)
+            except self._fatal:
+                raise
+            except Exception as ex:
+                log.warning('%s query failed on standby %d; '
+                            'trying primary: %s', query_class, ix, ex)
+                self._down[ix] = self._clock() + RETRY_DOWN
+            else:
+                if found(out):
+                    return out
+                log.info('%s: not found on standby %d; trying primary',
+                         query_class, ix)
+        return run(self._primary)
+
+    def _choose(self, query_class):
+        '''The first standby that's up and lags less than allowed.
+
+        :rtype: Option[(Int, Connection)]
+        '''
+        limit = self._staleness.get(query_class, 0)
+        if self._written_at is not None:
+            limit = min(limit, self._clock() - self._written_at)
+        if limit <= 0 or not self._standbys:
+            return None
+        n = len(self._standbys)
+        for ix in [(self._start + k) % n for k in range(n)]:
+            if self._down.get(ix, 0) > self._clock():
+                continue
+            try:
+                conn = self._standbys[ix]()
+                lag = self._lag(conn)
+            except Exception as ex:
+                log.warning('standby %d unavailable: %s', ix, ex)
+                self._down[ix] = self._clock() + RETRY_DOWN
+                continue
+            if lag is None or lag > limit:
+                log.debug('standby %d lags %s; %s needs %gs or less',
+                          ix, lag, query_class, limit)
+                continue
+            log.debug('%s query on standby %d (lag %gs)', query_class, ix, lag)
+            return ix, conn
+        return None
+
+
+def parse_standbys(txt):
+    '''Parse `host:port/service, ...`.
+
+    >>> parse_standbys('db2:1521/chi, db3:1522/chi')
+    [('db2', '1521', 'chi'), ('db3', '1522', 'chi')]
+    >>> parse_standbys('')
+    []
+    '''
+    out = []
+    for item in txt.split(','):
+        if not item.strip():
+            continue
+        addr, service = item.strip().split('/')
+        host, port = addr.split(':')
+        out.append((host, port, service))
+    return out
+
+
+def interval_seconds(txt):
+    '''Seconds of an Oracle day to second interval, as text.
+
+    >>> interval_seconds('+00 00:01:05'), interval_seconds('+01 00:00:00.5')
+    (65.0, 86400.5)
+    '''
+    days, hms = txt.strip().lstrip('+').split(' ')
+    h, m, s = hms.split(':')
+    return ((int(days) * 24 + int(h)) * 60 + int(m)) * 60 + float(s)
+
+
+def apply_lag(conn):
+    '''How far an Active Data Guard standby is behind its primary.
+
+    Needs select on v_$dataguard_stats.
+
+    :return: seconds, or None if the standby can't tell
+    '''
+    cur = conn.cursor()
+    try:
+        cur.execute('''
+        select value from v$dataguard_stats where name = 'apply lag'
+        ''')
+        row = cur.fetchone()
+    except Exception as ex:
+        log.debug('no apply lag: %s', ex)
+        return None
+    finally:
+        cur.close()
+    return interval_seconds(row[0]) if row and row[0] else None
@@ -0,0 +1,249 @@
+'''reqlog -- append-only JSON-lines request log with rotation
+............................................................
+
+One JSON file per request leaves millions of tiny files in the log
+directory. A `RequestLog` instead appends one JSON line per request to
+a segment per day, and rotates segments that grow past `max_bytes`,
+optionally compressing them.
+
+Each CGI request is a process of its own, so writers take an exclusive
+`flock` on a lock file (cf. `admission.Admission`) for the whole of a
+flush: appending, and rotating, which happens only while no other
+process can be appending to the segment.
+
+Access to the filesystem is only through a `lafile.Editable` directory:
+
+  >>> import os, tempfile, shutil, fcntl
+  >>> import lafile
+  >>> tmp = tempfile.mkdtemp()
+  >>> log_dir = lafile.Editable(tmp, os, open)
+
+  >>> from datetime import datetime, timedelta
+  >>> now = [datetime(2001, 1, 1)]
+  >>> def clock():
+  ...     now[0] += timedelta(seconds=30)
+  ...     return now[0]
+  >>> rlog = RequestLog(log_dir, clock, 'logging', fcntl.flock,
+  ...                   max_bytes=200)
+  >>> for who in ['alice', 'bob', 'alice', 'alice']:
+  ...     rlog.log_request(who, dict(patient_set_1='123'))
+
+Full segments were rotated and compressed:
+
+  >>> sorted(os.listdir(tmp))
+  ... # doctest: +NORMALIZE_WHITESPACE
+  ['logging-2001-01-01.1.jsonl.gz', 'logging-2001-01-01.jsonl',
+   'logging-active', 'logging.lock']
+
+Rotated segments never change, so the first lookup of a day notes in
+an index, one line per segment, whose requests each one holds; later
+lookups read only the segments with the user's requests, and the
+active segment:
+
+  >>> [(r['time'], r['params']) for r in rlog.lookup('alice', '2001-01-01')]
+  ... # doctest: +NORMALIZE_WHITESPACE
+  [(u'2001-01-01T00:00:30', {u'patient_set_1': u'123'}),
+   (u'2001-01-01T00:01:30', {u'patient_set_1': u'123'}),
+   (u'2001-01-01T00:02:00', {u'patient_set_1': u'123'})]
+  >>> print (log_dir / 'logging-index.jsonl').ro().getBytes(),
+  {"segment": "logging-2001-01-01.1.jsonl.gz", "users": ["alice", "bob"]}
+  >>> rlog.lookup('bob', '2001-01-02')
+  []
+
+The next day's first request rotates the day before:
+
+  >>> now[0] += timedelta(days=1)
+  >>> rlog.log_request('bob', {})
+  >>> [len(rlog.lookup(who, '2001-01-01')) for who in ['alice', 'bob']]
+  [3, 1]
+
+  >>> shutil.rmtree(tmp)
+
+'''
+
+import gzip
+import json
+import logging
+import os
+from contextlib import contextmanager
+from StringIO import StringIO
+
+log = logging.getLogger(__name__)
+
+# fcntl.LOCK_EX, fcntl.LOCK_UN; so as not to import fcntl
+LOCK_EX, LOCK_UN = 2, 8
+
+
+class RequestLog(object):
+    '''Buffered, append-only JSON-lines log of requests.
+    '''
+    def __init__(self, log_dir, clock, event_label,
+                 flock=None,
+                 max_bytes=64 * 1024 * 1024,
+                 compress=True,
+                 buffer_records=1):
+        '''
+        :param lafile.Editable log_dir: access to write log files
+        :param clock: access to date and time of day
+        :type clock: () => datetime
+        :param String event_label: names the segments, e.g. `logging`
+        :param flock: access to lock files, a la `fcntl.flock`;
+                      None only if this is the one process writing
+        :param Int max_bytes: rotate segments bigger than this
+        :param Boolean compress: gzip rotated segments?
+        :param Int buffer_records: how many records to keep before
+                                   writing; 1 for CGI, where each
+                                   process handles just one request
+        '''
+        self._dir = log_dir
+        self._clock = clock
+        self._label = event_label
+        self._flock = flock
+        self._max_bytes = max_bytes
+        self._compress = compress
+        self._buffer_records = buffer_records
+        self._buffer = []
+        # day of the active segment, so old days rotate without a listing
+        self._active_day_ed = log_dir / ('%s-active' % event_label)
+        self._index_ed = log_dir / ('%s-index.jsonl' % event_label)
+
+    def log_request(self, username, params):
+        '''
+        :param String username: who is accountable for the request
+        :param Dict[String,String] params: request parameters
+        '''
+        timestamp = str(self._clock()).replace(' ', 'T')
+        log.info('%s request parameters to: %s', self._label,
+                 self._active_name(timestamp[:10]))
+        self._buffer.append(dict(time=timestamp, user=username,
+                                 event=self._label, params=params))
+        if len(self._buffer) >= self._buffer_records:
+            self.flush()
+
+    def flush(self):
+        '''Append buffered records to their segments.
+        '''
+        records, self._buffer = self._buffer, []
+        if not records:
+            return
+        by_day = {}
+        for rec in records:
+            by_day.setdefault(rec['time'][:10], []).append(rec)
+
+        with self._locked():
+            for day in sorted(by_day):
+                self._rotate_old_day(day)
+                active = self._dir / self._active_name(day)
+                if (active.ro().exists() and
+                        active.ro().length() >= self._max_bytes):
+                    self._rotate(day)
+                with active.appendChannel() as out:
+                    for rec in by_day[day]:
+                        out.write(json.dumps(rec, sort_keys=True) + '\n')
+
+    def lookup(self, username, day):
+        '''Get a user's logged requests for a day.
+
+        :param String day: as in `2001-01-31`
+        :rtype: Seq[Dict]
+        '''
+        self.flush()
+        with self._locked():
+            index = self._read_index()
+            found = []
+            for name in self._rotated(day):
+                if name not in index:
+                    recs = self._records(name)
+                    index[name] = sorted(set([r['user'] for r in recs]))
+                    with self._index_ed.appendChannel() as out:
+                        out.write(json.dumps(dict(segment=name,
+                                                  users=index[name]),
+                                             sort_keys=True) + '\n')
+                if username in index[name]:
+                    found.extend(self._records(name))
+            found.extend(self._records(self._active_name(day)))
+        return [rec for rec in found if rec['user'] == username]
+
+    @contextmanager
+    def _locked(self):
+        if self._flock is None:
+            yield
+            return
+        lock = (self._dir / ('%s.lock' % self._label)).appendChannel()
+        self._flock(lock.fileno(), LOCK_EX)
+        try:
+            yield
+        finally:
+            self._flock(lock.fileno(), LOCK_UN)
+            lock.close()
+
+    def _active_name(self, day):
+        return '%s-%s.jsonl' % (self._label, day)
+
+    def _rotated_name(self, day, n):
+        return '%s-%s.%d.jsonl%s' % (self._label, day, n,
+                                     '.gz' if self._compress else '')
+
+    def _rotated(self, day):
+        '''Names of the rotated segments of a day, in order.
+        '''
+        out = []
+        while True:
+            name = self._rotated_name(day, len(out) + 1)
+            if not (self._dir / name).ro().exists():
+                return out
+            out.append(name)
+
+    def _records(self, name):
+        ed = self._dir / name
+        if not ed.ro().exists():
+            return []
+        data = ed.ro().getBytes()
+        if name.endswith('.gz'):
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        return [json.loads(line) for line in data.splitlines() if line]
+
+    def _rotate_old_day(self, day):
+        '''Rotate the active segment of the day before `day`, if any.
+        '''
+        ed = self._active_day_ed
+        old = ed.ro().getBytes().strip() if ed.ro().exists() else None
+        if old and old < day:
+            self._rotate(old)
+        if old != day:
+            ed.setBytes(day)
+
+    def _rotate(self, day):
+        '''Rename (and maybe compress) the active segment of a day.
+
+        Only while holding the lock, so nobody is appending to it.
+        '''
+        active_name = self._active_name(day)
+        active = self._dir / active_name
+        if not active.ro().exists():
+            return
+        name = self._rotated_name(day, len(self._rotated(day)) + 1)
+        if self._compress:
+            # readers that don't lock never see a partial file
+            tmp = self._dir / ('.%s.%d.tmp' % (name, os.getpid()))
+            with tmp.outChannel() as raw:
+                out = gzip.GzipFile(fileobj=raw, mode='wb')
+                out.write(active.ro().getBytes())
+                out.close()
+            tmp.renameTo(self._dir / name)
+            active.delete()
+        else:
+            active.renameTo(self._dir / name)
+        log.info('rotated %s to %s', active_name, name)
+
+    def _read_index(self):
+        '''Users by rotated segment.
+        '''
+        if not self._index_ed.ro().exists():
+            return {}
+        out = {}
+        for line in self._index_ed.ro().getBytes().splitlines():
+            if line:
+                entry = json.loads(line)
+                out[entry['segment']] = entry['users']
+        return out
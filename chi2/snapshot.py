@@ -0,0 +1,317 @@
+'''snapshot -- chi_pconcepts as memory-mapped sparse matrix files
+.............................................................
+
+Analyses that run in python need the (patient_num, concept) relation
+of chi_pconcepts. Rather than each process loading it, `build` writes
+it once to files, in both compressed sparse row (by patient) and
+column (by concept) layout, and each process maps them read-only;
+the operating system's page cache holds one copy for all of them.
+
+  >>> import tempfile, shutil
+  >>> root = tempfile.mkdtemp()
+  >>> rows = [(11, 'DM'), (11, 'HTN'), (12, 'HTN'), (15, 'CKD'), (15, 'DM')]
+  >>> build(rows, root, source='chi_pconcepts')
+  1
+
+Readers open the current version, and get the concepts of a patient
+or the patients with a concept, decoded from the mapped files as they
+are asked for:
+
+  >>> snap = Snapshot.open(root)
+  >>> snap.version, snap.source, len(snap.patients), len(snap.concepts)
+  (1, u'chi_pconcepts', 3, 3)
+  >>> snap.concepts_of(15), snap.patients_of('DM')
+  (['CKD', 'DM'], [11, 15])
+  >>> snap.concepts_of(13), snap.patients_of('ASTHMA')
+  ([], [])
+
+A new build is a new version, written aside and published by renaming,
+so readers never see a partial snapshot; those with an older version
+open carry on with it:
+
+  >>> build(rows[:2], root)
+  2
+  >>> Snapshot.open(root).patients_of('DM'), snap.patients_of('DM')
+  ([11], [11, 15])
+  >>> snap.close()
+  >>> shutil.rmtree(root)
+
+'''
+
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+
+log = logging.getLogger(__name__)
+
+CURRENT = 'CURRENT'
+META = 'meta.json'
+
+# name: struct format of its items (little-endian, so files are portable)
+PATIENTS = ('patients.bin', 'q')     # patient_nums, ascending
+CSR_OFFSETS = ('csr_offsets.bin', 'Q')  # per patient: start in csr_indices
+CSR_INDICES = ('csr_indices.bin', 'I')  # concept ids
+CSC_OFFSETS = ('csc_offsets.bin', 'Q')  # per concept: start in csc_indices
+CSC_INDICES = ('csc_indices.bin', 'I')  # patient ids (positions in patients)
+CONCEPTS = 'concepts.txt'            # concept codes, one per line, by id
+
+
+def build(rows, root,
+          source='', keep=2):
+    '''Write a new snapshot version and make it current.
+
+    :param rows: (patient_num, concept) rows, ordered by patient_num
+    :type rows: Iterable[(Int, String)]
+    :param String root: snapshot directory (made if need be)
+    :param String source: where the rows came from, for the record
+    :param Int keep: number of versions to keep, counting the new one
+    :return: the new version number
+    :rtype: Int
+    '''
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    versions = _versions(root)
+    version = (versions[-1] if versions else 0) + 1
+    tmp = os.path.join(root, '.tmp-{0}-{1}'.format(os.getpid(), version))
+    os.mkdir(tmp)
+
+    # Row (patient) major first, in one pass over the rows.
+    ids = {}
+    counts = []   # patients per concept id
+    nnz = 0
+    with _writer(tmp, PATIENTS) as pats, \
+            _writer(tmp, CSR_OFFSETS) as offsets, \
+            _writer(tmp, CSR_INDICES) as indices:
+        offsets.write(_pack(CSR_OFFSETS, [0]))
+        for pn, group in groupby(rows, key=lambda row: row[0]):
+            row = sorted(set([ids.setdefault(ccd, len(ids)) for _, ccd in group]))
+            counts.extend([0] * (len(ids) - len(counts)))
+            for c in row:
+                counts[c] += 1
+            nnz += len(row)
+            pats.write(_pack(PATIENTS, [int(pn)]))
+            indices.write(_pack(CSR_INDICES, row))
+            offsets.write(_pack(CSR_OFFSETS, [nnz]))
+    npats = os.path.getsize(os.path.join(tmp, PATIENTS[0])) // 8
+
+    with open(os.path.join(tmp, CONCEPTS), 'w') as f:
+        for ccd in sorted(ids, key=ids.get):
+            f.write(ccd.encode('utf-8') if isinstance(ccd, unicode) else ccd)
+            f.write('\n')
+
+    # Then column major, by counting sort: each concept's patients go
+    # in their slice of a preallocated file, in patient order.
+    starts = [0]
+    for cnt in counts:
+        starts.append(starts[-1] + cnt)
+    with _writer(tmp, CSC_OFFSETS) as f:
+        f.write(_pack(CSC_OFFSETS, starts))
+    with _writer(tmp, CSC_INDICES) as f:
+        f.truncate(nnz * 4)
+    if nnz:
+        with open(os.path.join(tmp, CSC_INDICES[0]), 'r+b') as f:
+            out = mmap.mmap(f.fileno(), 0)
+            csr = _Mapped(tmp, CSR_INDICES)
+            csr_offsets = _Mapped(tmp, CSR_OFFSETS)
+            fill = starts[:-1]
+            for r in xrange(npats):
+                for c in csr.items(csr_offsets.item(r), csr_offsets.item(r + 1)):
+                    struct.pack_into('<I', out, fill[c] * 4, r)
+                    fill[c] += 1
+            out.flush()
+            out.close()
+            csr.close()
+            csr_offsets.close()
+            os.fsync(f.fileno())
+
+    with open(os.path.join(tmp, META), 'w') as f:
+        json.dump(dict(version=version, source=source, patients=npats,
+                       concepts=len(ids), nnz=nnz), f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(tmp, os.path.join(root, 'v{0}'.format(version)))
+    _publish(root, version)
+    log.info('snapshot %s version %d: %d patients, %d concepts, %d facts',
+             root, version, npats, len(ids), nnz)
+
+    for old in versions[:max(0, len(versions) + 1 - keep)]:
+        _remove(os.path.join(root, 'v{0}'.format(old)))
+    return version
+
+
+class Snapshot(object):
+    '''One version of a snapshot, mapped read-only.
+    '''
+    def __init__(self, path):
+        '''
+        :param String path: version directory, e.g. `root/v3`
+        '''
+        self.path = path
+        with open(os.path.join(path, META)) as f:
+            meta = json.load(f)
+        self.version = meta['version']
+        self.source = meta.get('source')
+        with open(os.path.join(path, CONCEPTS)) as f:
+            self.concepts = [line.rstrip('\n') for line in f]
+        self._ids = dict((ccd, ix) for ix, ccd in enumerate(self.concepts))
+        self.patients = _Mapped(path, PATIENTS)
+        self._csr_offsets = _Mapped(path, CSR_OFFSETS)
+        self._csr = _Mapped(path, CSR_INDICES)
+        self._csc_offsets = _Mapped(path, CSC_OFFSETS)
+        self._csc = _Mapped(path, CSC_INDICES)
+
+    @classmethod
+    def open(cls, root):
+        '''Open the current version of the snapshot in `root`.
+        '''
+        with open(os.path.join(root, CURRENT)) as f:
+            version = int(f.read().strip())
+        return cls(os.path.join(root, 'v{0}'.format(version)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for m in [self.patients, self._csr_offsets, self._csr,
+                  self._csc_offsets, self._csc]:
+            m.close()
+
+    def concepts_of(self, pn):
+        '''Concepts of a patient.
+
+        :rtype: Seq[String]
+        '''
+        r = self.position(pn)
+        if r is None:
+            return []
+        return sorted([self.concepts[c] for c in self.concept_ids_at(r)])
+
+    def position(self, pn):
+        '''Where a patient is in `patients`, if anywhere.
+
+        :rtype: Option[Int]
+        '''
+        r = bisect_left(self.patients, pn)
+        if r == len(self.patients) or self.patients.item(r) != pn:
+            return None
+        return r
+
+    def positions(self, pns):
+        '''Positions of those of some patients that are in the snapshot.
+
+        :type pns: Iterable[Int]
+        :rtype: array
+        '''
+        out = array('l')
+        for pn in pns:
+            r = self.position(pn)
+            if r is not None:
+                out.append(r)
+        return out
+
+    def concept_ids_at(self, r):
+        '''Ids (positions in `concepts`) of the concepts of the patient
+        at position r.
+
+        :rtype: Seq[Int]
+        '''
+        return self._csr.items(self._csr_offsets.item(r),
+                               self._csr_offsets.item(r + 1))
+
+    def patients_of(self, ccd):
+        '''Patients with a concept, ascending.
+
+        :rtype: Seq[Int]
+        '''
+        c = self._ids.get(ccd)
+        if c is None:
+            return []
+        item = self.patients.item
+        return [item(r) for r in self._csc.items(
+            self._csc_offsets.item(c), self._csc_offsets.item(c + 1))]
+
+
+class _Mapped(object):
+    '''Array of fixed-size items in a file, mapped read-only.
+    '''
+    def __init__(self, path, spec):
+        name, fmt = spec
+        self._fmt = '<' + fmt
+        self._size = struct.calcsize(self._fmt)
+        with open(os.path.join(path, name), 'rb') as f:
+            length = os.fstat(f.fileno()).st_size
+            # a zero-length file can't be mapped
+            self._buf = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                         if length else '')
+        self._len = length // self._size
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, ix):
+        # for bisect
+        if not 0 <= ix < self._len:
+            raise IndexError(ix)
+        return self.item(ix)
+
+    def item(self, ix):
+        return struct.unpack_from(self._fmt, self._buf, ix * self._size)[0]
+
+    def items(self, lo, hi):
+        return struct.unpack_from('<{0}{1}'.format(hi - lo, self._fmt[1:]),
+                                  self._buf, lo * self._size)
+
+    def close(self):
+        if self._buf:
+            self._buf.close()
+
+
+def _pack(spec, values):
+    name, fmt = spec
+    return struct.pack('<{0}{1}'.format(len(values), fmt), *values)
+
+
+class _writer(object):
+    '''Open a file for writing; on exit, flush it to disk.
+    '''
+    def __init__(self, path, spec):
+        self._f = open(os.path.join(path, spec[0]), 'wb')
+
+    def __enter__(self):
+        return self._f
+
+    def __exit__(self, *exc_info):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+
+
+def _versions(root):
+    return sorted(int(name[1:]) for name in os.listdir(root)
+                  if name.startswith('v') and name[1:].isdigit())
+
+
+def _publish(root, version):
+    # rename is atomic, so CURRENT is always the old or new version
+    tmp = os.path.join(root, '.{0}-{1}'.format(CURRENT, os.getpid()))
+    with open(tmp, 'w') as f:
+        f.write('{0}\n'.format(version))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, os.path.join(root, CURRENT))
+
+
+def _remove(path):
+    # Readers that have the files mapped keep them until they close.
+    for name in os.listdir(path):
+        os.remove(os.path.join(path, name))
+    os.rmdir(path)
@@ -13,6 +13,208 @@ TODO: localize jslint exceptions
 (function (exports, i2b2, tool_widgets, Ajax, $j) {
     var tw = tool_widgets;
 
+    var CGI_URL = '/cgi-bin/chi2.cgi',
+        EXPORT_URL = CGI_URL + '/export',
+        PAGE_ROWS = 100;  // rows per request for a page of results
+
+    function escapeHtml(txt) {
+        return String(txt).replace(/&/g, '&amp;').replace(/</g, '&lt;')
+            .replace(/>/g, '&gt;');
+    }
+
+    // Column labels, with the set names given in the UI
+    function colNames(cols) {
+        var p1name = $('chi2-p1-colname').value.toUpperCase().replace(/\W+/g, '_');
+        var p2name = $('chi2-p2-colname').value.toUpperCase().replace(/\W+/g, '_');
+        var out = cols.slice(0);
+        out[3] = p1name;
+        out[4] = 'FRC_' + p1name;
+        out[5] = p2name;
+        out[6] = 'FRC_' + p2name;
+        return out;
+    }
+
+    // Format a cell as the results table always has (c: column index).
+    function cellText(row, c) {
+        var data = row[c];
+        if (row[0] == 'TOTAL') {
+            // TOTAL row should only show CCD and counts
+            if (c != 1 && c != 3 && c != 5) { data = ''; }
+        } else {
+            if (data == null) { data = ''; }
+            // Frequencies rounded to 5 decimal places
+            else if ((c == 4 || c == 6) && !isNaN(data)) { data = data.toFixed(5); }
+            // Chi-squared rounded to 2 decimal places
+            else if (c == 7 && !isNaN(data)) { data = data.toFixed(2); }
+        }
+        return escapeHtml(data);
+    }
+
+    // A results table that scrolls through a whole stored ranking but
+    // has only the rows in view in the DOM, and keeps only a few pages
+    // of rows; others are fetched again when they come into view.
+    // Clicking the ODDS_RATIO heading sorts the other way.
+    var VirtualTable = (function () {
+        var ROW_HEIGHT = 22,   // px; must match td height in tools.css
+            VIEW_ROWS = 25,
+            MAX_PAGES = 6,
+            NCOLS = 10,        // PREFIX .. DIR; PREFIX isn't shown
+            WIDTHS = [0, 150, 320, 80, 90, 80, 90, 80, 90, 40];
+
+        // fetchPage: (after, direction, (resp) => unit) => unit
+        function VirtualTable(elt, fetchPage, cols) {
+            this.elt = elt;
+            this.fetchPage = fetchPage;
+            this.labels = colNames(cols);
+            this.direction = 'over';
+            this.generation = 0;
+            this.reset();
+        }
+
+        VirtualTable.prototype.reset = function () {
+            this.generation += 1;  // responses to earlier requests are stale
+            this.total = 0;
+            this.bounds = [0];     // page n starts after rank bounds[n]
+            this.pages = {};
+            this.pending = {};
+            this.lru = [];
+        };
+
+        // Get the first page; onEmpty(resp) if there's none.
+        VirtualTable.prototype.start = function (onEmpty) {
+            var that = this, gen = this.generation;
+            this.fetchPage(0, this.direction, function (resp) {
+                if (gen !== that.generation) { return; }
+                if (!resp.rows.length || !resp.bounds) {
+                    onEmpty(resp);
+                    return;
+                }
+                that.total = resp.total;
+                that.bounds = resp.bounds;
+                that.store(0, resp.rows);
+                that.layout();
+                that.render();
+            });
+        };
+
+        VirtualTable.prototype.colgroup = function () {
+            var c, out = '<colgroup>';
+            for (c = 1; c < NCOLS; c++) {
+                out += '<col style="width:' + WIDTHS[c] + 'px">';
+            }
+            return out + '</colgroup>';
+        };
+
+        VirtualTable.prototype.layout = function () {
+            var that = this, timer = null;
+            this.elt.innerHTML =
+                '<table id="chi2-result-hdr" class="chi2-vtable">'
+                + this.colgroup() + '<tr></tr></table>'
+                + '<div class="chi2-viewport" style="height:'
+                + (VIEW_ROWS * ROW_HEIGHT) + 'px">'
+                + '<div style="height:' + (this.total * ROW_HEIGHT)
+                + 'px"></div>'
+                + '<table id="chi2-result-tbl" class="chi2-vtable">'
+                + this.colgroup() + '<tbody></tbody></table></div>';
+            this.viewport = $j(this.elt).find('DIV.chi2-viewport')[0];
+            this.body = $j(this.elt).find('#chi2-result-tbl')[0];
+            this.header();
+            $j(this.viewport).scroll(function () {
+                // render once per burst of scroll events
+                if (timer === null) {
+                    timer = setTimeout(function () {
+                        timer = null;
+                        that.render();
+                    }, 30);
+                }
+            });
+        };
+
+        VirtualTable.prototype.header = function () {
+            var that = this, c, html = '';
+            for (c = 1; c < NCOLS; c++) {
+                html += '<th>' + escapeHtml(this.labels[c])
+                    + (c === 8 ? (this.direction === 'over' ? ' &#9660;'
+                                                         : ' &#9650;') : '')
+                    + '</th>';
+            }
+            $j(this.elt).find('#chi2-result-hdr tr').html(html);
+            $j(this.elt).find('#chi2-result-hdr th').eq(7)
+                .css('cursor', 'pointer').click(function () {
+                    that.sort(that.direction === 'over' ? 'under' : 'over');
+                });
+        };
+
+        VirtualTable.prototype.rename = function (cols) {
+            this.labels = colNames(cols || this.labels);
+            this.header();
+        };
+
+        VirtualTable.prototype.sort = function (direction) {
+            var that = this;
+            this.direction = direction;
+            this.reset();
+            this.start(function () {
+                that.elt.innerHTML = 'No results.';
+            });
+        };
+
+        VirtualTable.prototype.store = function (p, rows) {
+            this.pages[p] = rows;
+            this.touch(p);
+            while (this.lru.length > MAX_PAGES) {
+                delete this.pages[this.lru.shift()];
+            }
+        };
+
+        VirtualTable.prototype.touch = function (p) {
+            var ix = this.lru.indexOf(p);
+            if (ix >= 0) { this.lru.splice(ix, 1); }
+            this.lru.push(p);
+        };
+
+        VirtualTable.prototype.need = function (p) {
+            var that = this, gen = this.generation;
+            if (this.pages[p]) {
+                this.touch(p);
+                return;
+            }
+            if (this.pending[p] || p >= this.bounds.length) { return; }
+            this.pending[p] = true;
+            this.fetchPage(this.bounds[p], this.direction, function (resp) {
+                if (gen !== that.generation) { return; }
+                delete that.pending[p];
+                that.store(p, resp.rows);
+                that.render();
+            });
+        };
+
+        VirtualTable.prototype.render = function () {
+            var first = Math.floor(this.viewport.scrollTop / ROW_HEIGHT),
+                last = Math.min(this.total, first + VIEW_ROWS + 1),
+                p, i, c, rows, row, html = '';
+            for (p = Math.floor(first / PAGE_ROWS);
+                 p <= Math.floor((last - 1) / PAGE_ROWS); p++) {
+                this.need(p);
+            }
+            for (i = first; i < last; i++) {
+                p = Math.floor(i / PAGE_ROWS);
+                rows = this.pages[p];
+                row = rows ? rows[i - p * PAGE_ROWS] : null;
+                html += '<tr>';
+                for (c = 1; c < NCOLS; c++) {
+                    html += '<td>' + (row ? cellText(row, c) : '&hellip;')
+                        + '</td>';
+                }
+                html += '</tr>';
+            }
+            $j(this.body).find('tbody').html(html);
+            this.body.style.top = (first * ROW_HEIGHT) + 'px';
+        };
+
+        return VirtualTable;
+    }());
+
     var DFTool = (function (_super) {
 	tw.__extends(DFTool, _super);
 
@@ -55,36 +257,87 @@ TODO: localize jslint exceptions
 	    return true;
 	};
 
+	DFTool.prototype.psets = function () {
+            // reference set 0 is all patients
+            return {
+                patient_set_1: this.prs1 ? this.pw1.pset_id(this.prs1) : 0,
+                patient_set_2: this.pw2.pset_id(this.prs2),
+                // the server uses this project's tables
+                project: i2b2.PM.model.login_project
+            };
+	};
+
 	DFTool.prototype.params = function (choice){
-            var pset1 = null;
-            if (!this.prs1) {
-                pset1 = 0;
-            }
-            else {
-                pset1 = this.pw1.pset_id(this.prs1);
-            }
-            if (exports.model.toCsv) {
-                return {
-                    backend: 'chi2',
-                    patient_set_1: pset1,
-                    patient_set_2: this.pw2.pset_id(this.prs2),
-                    pgsize: 'ALL',
-                    cutoff: 1,
-                    concepts: 'ALL',
-                    extant: 1
-                };
-            }
-            else {
-                return {
-                    backend: 'chi2',
-                    patient_set_1: pset1,
-                    patient_set_2: this.pw2.pset_id(this.prs2),
-                    pgsize: exports.model.pgsize,
-                    cutoff: exports.model.cutoff,
-                    concepts: exports.model.concepts,
-                    extant: exports.model.extant
-                };
+            var psets = this.psets();
+            var params = {
+                backend: 'chi2',
+                patient_set_1: psets.patient_set_1,
+                patient_set_2: psets.patient_set_2,
+                project: psets.project,
+                pgsize: exports.model.pgsize,
+                cutoff: exports.model.cutoff,
+                concepts: exports.model.concepts,
+                extant: exports.model.extant
+            };
+            // count only facts in a date window (YYYY-MM-DD), if set
+            $j.each(['since', 'until'], function (i, name) {
+                if (exports.model[name]) {
+                    params[name] = exports.model[name];
+                }
+            });
+            return params;
+	};
+
+	// Get a page of the stored ranking: rows ranked after `after`.
+	DFTool.prototype.fetchPage = function (after, direction, k) {
+            var psets = this.psets();
+            var params = {
+                username: i2b2.h.getUser(),
+                password: i2b2.h.getPass(),
+                patient_set_1: psets.patient_set_1,
+                patient_set_2: psets.patient_set_2,
+                project: psets.project,
+                pgsize: PAGE_ROWS,
+                cutoff: exports.model.cutoff,
+                concepts: exports.model.concepts,
+                after: after,
+                direction: direction
+            };
+            this.pager.post(params, function (xhr) {
+                k($j.parseJSON(xhr.responseJSON.str));
+            }, function (xhr) {
+                k({cols: [], rows: [], status: xhr.responseText});
+            });
+	};
+
+	// Download the whole ranking as CSV. The server streams it and
+	// the browser saves it as it comes, via a hidden form and frame.
+	DFTool.prototype.exportCsv = function (direction) {
+            var psets = this.psets();
+            var params = {
+                username: i2b2.h.getUser(),
+                password: i2b2.h.getPass(),
+                patient_set_1: psets.patient_set_1,
+                patient_set_2: psets.patient_set_2,
+                project: psets.project,
+                cutoff: exports.model.cutoff,
+                concepts: exports.model.concepts,
+                direction: direction || 'over'
+            };
+            if ($j('#chi2-export-frame').length === 0) {
+                $j('<iframe id="chi2-export-frame" name="chi2-export-frame"'
+                   + ' style="display:none"></iframe>').appendTo('body');
             }
+            var form = $j('<form method="post" target="chi2-export-frame"'
+                          + ' style="display:none"></form>')
+                .attr('action', EXPORT_URL);
+            $j.each(params, function (name, value) {
+                form.append($j('<input type="hidden"/>')
+                            .attr('name', name).val(value));
+            });
+            form.appendTo('body');
+            form[0].submit();
+            form.remove();
 	};
 
 	DFTool.prototype.show_error = function (responseText) {
@@ -106,13 +359,10 @@ TODO: localize jslint exceptions
             //alert(resp.status);
 
             // Use UI defined column names
-            var p1name = $('chi2-p1-colname').value.toUpperCase().replace(/\W+/g, '_');
-            var p2name = $('chi2-p2-colname').value.toUpperCase().replace(/\W+/g, '_');
-            resp.cols[3] = p1name;
-            resp.cols[4] = 'FRC_' + p1name;
-            resp.cols[5] = p2name;
-            resp.cols[6] = 'FRC_' + p2name;
+            resp.cols = colNames(resp.cols);
 
+            var resultsDiv = $j("DIV#analysis-mainDiv DIV#chi2-TABS DIV.results-chi2")[0];
+            var that = this;
             if (resp.rows.length == 0) { 
                 if (resp.status.startsWith("No data for PSID")) { 
                     DFTool.prototype.show_504();
@@ -120,45 +370,38 @@ TODO: localize jslint exceptions
                 }
 
                 // No results, display status message
-                $j("DIV#analysis-mainDiv DIV#chi2-TABS DIV.results-chi2")[0].innerHTML = resp.status;
+                resultsDiv.innerHTML = resp.status;
             }
-            else if (exports.model.toCsv) { 
-                // Export results to csv file via data URI
-                var csvOut = resp.cols.join(',') + '\n';
-                resp.rows.forEach(function(rdata, ri) {
-                    var row = [];
-                    resp.cols.forEach(function(cdata, ci) {
-                        if (ci == 0 || ci == 1) {
-                            // Wrap PREFIX, CCD in quotes
-                            row.push('"' + resp.rows[ri][ci] + '"');
-                        }
-                        else if (resp.rows[ri][ci] != null && ci == 2) {
-                            // Wrap concept NAME in quotes, handle embedded quotes
-                            var rstr = resp.rows[ri][ci].replace(/\"/g, '""');
-                            row.push('"' + rstr + '"');
-                        }
-                        else {
-                            row.push(resp.rows[ri][ci]);
-                        }
-                    });
-                    var str = row.join(',');
-                    csvOut += ri < resp.rows.length ? str + '\n' : str;
-                });
-                // Create data URI
-                $j('#exportLink').attr('href', 
-                  'data:text/csv;charset=utf-8,' + encodeURIComponent(csvOut));
-                var filename = p1name + '_' +  p2name + '.csv';
-                $j('#exportLink').attr('download', filename);
-                //$j('#exportLink').click();  // doesn't work, use plain Javascript
-                document.getElementById("exportLink").click();
-                // Restore previously displayed data
-                $j("DIV#analysis-mainDiv DIV#chi2-TABS DIV.results-chi2")[0].innerHTML = 
-                    exports.model.saveHTML;
-                exports.model.toCsv = false;
+            else if (windowed()) {
+                // windowed counts aren't stored, so there's nothing to page
+                this.table = null;
+                this.show_rows(resp);
+                this.load_prefixes(resp);
             }
             else {
+                // Scroll through the whole stored ranking, if the server
+                // stores rankings; else show the rows we have.
+                this.table = new VirtualTable(
+                    resultsDiv, function (after, direction, k) {
+                        that.fetchPage(after, direction, k);
+                    }, resp.cols);
+                this.table.start(function () {
+                    that.table = null;
+                    that.show_rows(resp);
+                });
+                this.load_prefixes(resp);
+            }
+            // Enable/disable widgets
+            enableWidgets(false);
+            $j('#goButton').attr('disabled', true);
+            $j('#exportButton').attr('disabled', windowed());
+	};
+
+	// Show all the rows of a response at once.
+	DFTool.prototype.show_rows = function (resp) {
+            {
                 var tabstr = '<table id="chi2-result-tbl" border="1" border-collapse="collapse">';
-                var r, c, p;
+                var r, c;
                 tabstr += '\n<tr>';
                 // Header row (skip PREFIX, start at index==1)
                 for (c=1; c < resp.cols.length; c++) {
@@ -193,19 +436,19 @@ TODO: localize jslint exceptions
                 }
                 tabstr += '\n</table>';
                 $j("DIV#analysis-mainDiv DIV#chi2-TABS DIV.results-chi2")[0].innerHTML = tabstr;
+            }
+	};
 
-                // Load the concept category drop down, if not already loaded
-                if ($j('#concepts-select option').length == 1) {
-                    for (p=0; p < resp.prefixes.length; p++) {
-                        var code = resp.prefixes[p][0];
-                        var desc = resp.prefixes[p][1];
-                        $j('#concepts-select').append('<option value="' + code + '">' + desc + '</option>');
-                    }
+	// Load the concept category drop down, if not already loaded
+	DFTool.prototype.load_prefixes = function (resp) {
+            var p;
+            if ($j('#concepts-select option').length == 1) {
+                for (p=0; p < resp.prefixes.length; p++) {
+                    var code = resp.prefixes[p][0];
+                    var desc = resp.prefixes[p][1];
+                    $j('#concepts-select').append('<option value="' + code + '">' + desc + '</option>');
                 }
             }
-            // Enable/disable widgets
-            enableWidgets(false);
-            $j('#goButton').attr('disabled', true);
 	};
 	return DFTool;
     }(tw.RGateTool));
@@ -213,15 +456,15 @@ TODO: localize jslint exceptions
 
     exports.model = undefined;
     function Init(loadedDiv) {
-	var chi2 = tw.mkWebPostable('/cgi-bin/chi2.cgi', Ajax);
+	var chi2 = tw.mkWebPostable(CGI_URL, Ajax);
         //alert('chi here 3');
 	var dftool = new DFTool($j(loadedDiv), chi2);
+	dftool.pager = tw.mkWebPostable(CGI_URL + '/page', Ajax);
         //alert('chi here 4');
 	exports.model = dftool;
         exports.model.pgsize = 10;
         exports.model.cutoff = 10;
         exports.model.concepts = 'ALL';
-        exports.model.saveHTML = '';
         exports.model.extant = 0;
 
         // manage YUI tabs
@@ -242,7 +485,10 @@ TODO: localize jslint exceptions
                     else {
                         // allow user to reset column names in browser
                         var tabstr = $j("DIV#analysis-mainDiv DIV#chi2-TABS DIV.results-chi2")[0].innerHTML;
-                        if (tabstr.startsWith('<table id="chi2-result-tbl"')) {
+                        if (exports.model.table) {
+                            exports.model.table.rename();
+                        }
+                        else if (tabstr.startsWith('<table id="chi2-result-tbl"')) {
                             var c1 = $('chi2-p1-colname').value.toUpperCase().replace(/\W+/g, '_') + '_';
                             var c2 = $('chi2-p2-colname').value.toUpperCase().replace(/\W+/g, '_') + '_';
                             var tab = document.getElementById('chi2-result-tbl');
@@ -271,18 +517,26 @@ TODO: localize jslint exceptions
         //alert('chi here 6.1');
         $j('#exportButton').attr('disabled', true);
         $j('#exportButton').click(function() {
-            exports.model.toCsv = true;
-            pgGo();
+            var table = exports.model.table;
+            exports.model.exportCsv(table ? table.direction : 'over');
         });
         //alert('chi here 7');
         $j('#goButton').attr('disabled', true);
         $j('#goButton').click(function() {
             if (exports.model.pgsize != parseInt($('chi2-pgsize').value)
             || exports.model.cutoff != parseInt($('chi2-cutoff').value)
-            || exports.model.concepts != $j("#concepts-select").val()) {
+            || exports.model.concepts != $j("#concepts-select").val()
+            || windowChanged()) {
                 pgGo();
             }
         });
+        $j.each(['#chi2-since', '#chi2-until'], function (i, id) {
+            $j(id).attr('disabled', true);
+            $j(id).keyup(function(e) {
+                $j('#goButton').attr('disabled', !windowChanged());
+                if (e.which == 13) { $j('#goButton').click(); }  // Enter key
+            });
+        });
         //alert('chi here 8');
         $j('#chi2-pgsize').attr('disabled', true);
         $j('#chi2-pgsize').keyup(function(e) {
@@ -322,20 +576,23 @@ TODO: localize jslint exceptions
         $j('#chi2-pgsize').attr('disabled', disabled);
         $j('#chi2-cutoff').attr('disabled', disabled);
         $j('#concepts-select').attr('disabled', disabled);
+        $j('#chi2-since').attr('disabled', disabled);
+        $j('#chi2-until').attr('disabled', disabled);
+    }
+
+    // Count only facts in a date window? (see JobSetUp since, until)
+    function windowed() {
+        return !!(exports.model.since || exports.model.until);
+    }
+
+    function windowChanged() {
+        return (exports.model.since || '') != $j('#chi2-since').val()
+            || (exports.model.until || '') != $j('#chi2-until').val();
     }
     
 
     function pgGo() {
         enableWidgets(true);
-        if (exports.model.toCsv) {
-            $('chi2-pgsize').value = exports.model.pgsize.toString();
-            $('chi2-cutoff').value = exports.model.cutoff.toString();
-            $j("#concepts-select").val(exports.model.concepts);
-            exports.model.saveHTML = $j("DIV#analysis-mainDiv DIV#chi2-TABS DIV.results-chi2")[0].innerHTML; 
-            $j("DIV#analysis-mainDiv DIV#chi2-TABS DIV.results-chi2")[0].innerHTML = '<div class="results-progress">Exporting data, please wait...</div><div class="results-progressIcon"></div>';
-            exports.model.runTool();
-            return; // no UI update for export to CSV
-        } 
         var formSize = parseInt($('chi2-pgsize').value);
         if (!formSize || formSize < 1) {
             alert('View Results error: please enter a positive integer value for size');
@@ -350,6 +607,15 @@ TODO: localize jslint exceptions
             return;
         }
         exports.model.cutoff = cutoff;
+        var since = $j.trim($j('#chi2-since').val()),
+            until = $j.trim($j('#chi2-until').val());
+        if (!/^(\d{4}-\d\d-\d\d)?$/.test(since)
+            || !/^(\d{4}-\d\d-\d\d)?$/.test(until)) {
+            alert('View Results error: please enter dates as YYYY-MM-DD, or none');
+            return;
+        }
+        exports.model.since = since;
+        exports.model.until = until;
         exports.model.concepts = $j("#concepts-select").val();
         $('chi2-pgsize').value = formSize;
         $('chi2-cutoff').value = cutoff;